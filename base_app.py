@@ -1,7 +1,10 @@
+import time
+from contextlib import contextmanager
 from typing import *
 
 import requests
 
+from metrics import Metrics
 from utils import assert_type
 
 
@@ -12,12 +15,28 @@ class MinerError(Exception):
 class BaseApp:
     base_url: str = NotImplemented
 
+    @staticmethod
+    @contextmanager
+    def _measure_http(method: str, path: str):
+        # one histogram per endpoint; the rest of the path holds addresses and ids
+        endpoint = path.lstrip('/').split('/')[0]
+        start_ns = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            Metrics.observe_ns(f'http.{method} /{endpoint}', time.perf_counter_ns() - start_ns)
+        # endtry
+    # enddef
+
     def _get(self, path: str) -> dict:
         assert_type(path, str)
 
         url = self.base_url.rstrip('/') + '/' + path.lstrip('/')
-        resp = requests.get(url, timeout=5)
+        with self._measure_http('GET', path):
+            resp = requests.get(url, timeout=5)
+        # endwith
         if not resp.ok:
+            Metrics.inc('http.errors')
             raise MinerError(f'GET {url} failed: {resp.status_code} {resp.text}')
         # endif
 
@@ -32,8 +51,11 @@ class BaseApp:
         assert_type(path, str)
 
         url = self.base_url.rstrip('/') + '/' + path.lstrip('/')
-        resp = requests.post(url, json=data or {}, timeout=5)
+        with self._measure_http('POST', path):
+            resp = requests.post(url, json=data or {}, timeout=5)
+        # endwith
         if not resp.ok:
+            Metrics.inc('http.errors')
             raise MinerError(f'POST {url} failed: {resp.status_code} {resp.text}')
         # endif
 
@@ -1,6 +1,7 @@
 import argparse
 
 from base_app import BaseApp
+from midnight.ashmaize_rom_manager import AshMaizeBackend, AshMaizeROMManager
 from midnight.midnight_app import MidnightApp
 from project import Project
 
@@ -16,6 +17,14 @@ def build_parser() -> argparse.ArgumentParser:
         choices=['midnight', 'defensio'],
         help='Target project to use.',
         )
+    parser.add_argument(
+        '--backend',
+        type=str,
+        choices=[backend.value for backend in AshMaizeBackend],
+        help='AshMaize implementation (default: $ASHMAIZE_BACKEND or "native"). '
+             '"fake" is a deterministic stand-in for benchmarks without the binary; '
+             'its solutions are not valid on the server, so "mine" refuses it.',
+        )
     subparsers = parser.add_subparsers(
         dest='command',
         required=True,
@@ -113,10 +122,86 @@ def build_parser() -> argparse.ArgumentParser:
     mine_parser.add_argument(
         '-t', '--num_threads',
         type=int,
-        help='Number of miner threads to spawn.',
+        help='Number of compute slots (threads) to run. Defaults to the CPU count.',
+        )
+    mine_parser.add_argument(
+        '-e', '--engine',
+        type=str,
+        default='thread',
+        choices=['thread', 'process', 'packed'],
+        help='Solver engine. "process" runs each solver in a forked process to escape the GIL. '
+             '"packed" hashes wallets that share a ROM together in mixed batches.',
+        )
+    mine_parser.add_argument(
+        '--affinity',
+        type=str,
+        default='none',
+        choices=['none', 'core', 'node'],
+        help='Pin compute slots to CPUs, spread round-robin over NUMA nodes. '
+             '"core" pins each slot to one CPU, "node" lets it float over the CPUs of its node.',
+        )
+    mine_parser.add_argument(
+        '--avoid_smt',
+        action='store_true',
+        help='With --affinity, use only one logical CPU per physical core.',
+        )
+    mine_parser.add_argument(
+        '--max_rom_builds',
+        type=int,
+        help='Maximum number of ROMs built in parallel (default: 2). Cached ROMs are never blocked by a build.',
+        )
+    mine_parser.add_argument(
+        '--rom_budget_gb',
+        type=float,
+        help='Memory budget of the ROM cache in GiB (default: 70%% of the total memory). '
+             'ROMs no job needs are evicted first, then those cheapest to rebuild for the work left.',
         )
     mine_parser.set_defaults(handler='mine')
 
+    # -------------------------
+    # bench sub-command
+    # -------------------------
+    bench_parser = subparsers.add_parser(
+        'bench',
+        description='Measure the hashing throughput of the solver on this host against a synthetic challenge. '
+                    'The results are printed as a table and saved as JSON under logs/.',
+        help='Benchmark the solver.',
+        )
+    bench_parser.add_argument(
+        '-e', '--engines',
+        type=str,
+        nargs='+',
+        default=['thread'],
+        choices=['thread', 'process', 'packed'],
+        help='Solver engines to benchmark.',
+        )
+    bench_parser.add_argument(
+        '-t', '--num_threads',
+        type=int,
+        nargs='+',
+        default=[1],
+        help='Thread (or process) counts to sweep.',
+        )
+    bench_parser.add_argument(
+        '-b', '--batch_sizes',
+        type=int,
+        nargs='+',
+        default=[1_000, 10_000],
+        help='Batch sizes to sweep.',
+        )
+    bench_parser.add_argument(
+        '-s', '--seconds',
+        type=float,
+        default=10.0,
+        help='Duration of each run in seconds.',
+        )
+    bench_parser.add_argument(
+        '--rom_size_mb',
+        type=int,
+        help='ROM size in MiB. Defaults to the mining ROM size (1 GiB).',
+        )
+    bench_parser.set_defaults(handler='bench')
+
     return parser
 
 
@@ -144,7 +229,23 @@ def handle_show_results(app: BaseApp, args: argparse.Namespace) -> None:
 
 
 def handle_mine(app: BaseApp, args: argparse.Namespace) -> None:
-    app.handle_mine(num_threads=args.num_threads)
+    if AshMaizeROMManager.get_backend() == AshMaizeBackend.Fake:
+        # its hashes would be submitted for the real wallets and recorded as invalid in the real DB
+        raise SystemExit('mine: the "fake" AshMaize backend cannot mine (set by --backend or $ASHMAIZE_BACKEND).')
+    # endif
+    AshMaizeROMManager.get_ashmaize()  # fail here on a missing backend, not later in every compute slot
+    app.handle_mine(num_threads=args.num_threads, engine=args.engine, affinity=args.affinity, avoid_smt=args.avoid_smt,
+                    max_rom_builds=args.max_rom_builds, rom_budget_gb=args.rom_budget_gb)
+
+
+def handle_bench(app: BaseApp, args: argparse.Namespace) -> None:
+    AshMaizeROMManager.get_ashmaize()  # fail here on a missing backend, not later in every bench run
+    app.handle_bench(engines=args.engines,
+                     list__num_threads=args.num_threads,
+                     list__batch_size=args.batch_sizes,
+                     seconds=args.seconds,
+                     rom_size=args.rom_size_mb * 1024 * 1024 if args.rom_size_mb else None,
+                     )
 
 
 # -------------------------
@@ -154,6 +255,10 @@ def main(argv=None) -> int:
     parser = build_parser()
     args = parser.parse_args(argv)
 
+    if args.backend:
+        AshMaizeROMManager.set_backend(AshMaizeBackend(args.backend))
+    # endif
+
     if args.project == 'midnight':
         app = MidnightApp(project=Project.Midnight)
     elif args.project == 'defensio':
@@ -173,6 +278,8 @@ def main(argv=None) -> int:
         'show_results': handle_show_results,
         # mine
         'mine': handle_mine,
+        # bench
+        'bench': handle_bench,
         }
 
     handler_key = getattr(args, 'handler', None)
@@ -0,0 +1,175 @@
+import glob
+import os
+import re
+import threading
+from dataclasses import dataclass
+from typing import *
+
+from utils import assert_type
+
+NODE_ROOT = '/sys/devices/system/node'
+CPU_ROOT = '/sys/devices/system/cpu'
+
+_local = threading.local()
+_topology = None  # type: Optional[CpuTopology]
+
+
+# -------------------------
+# parsing
+# -------------------------
+def parse_cpulist(s: str) -> list[int]:
+    assert_type(s, str)
+
+    # "0-3,8-11" → [0, 1, 2, 3, 8, 9, 10, 11]
+    cpus = []
+    for part in s.strip().split(','):
+        if not part:
+            continue
+        # endif
+
+        if '-' in part:
+            lo, hi = part.split('-')
+            cpus += list(range(int(lo), int(hi) + 1))
+        else:
+            cpus.append(int(part))
+        # endif
+    # endfor
+
+    return cpus
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, 'rt') as f:
+            return f.read()
+        # endwith
+    except OSError:
+        return None
+    # endtry
+
+
+# -------------------------
+# topology
+# -------------------------
+@dataclass
+class CpuTopology:
+    cpus_by_node: dict[int, list[int]]  # only CPUs this process may run on
+    core_by_cpu: dict[int, int]  # logical CPU → first CPU of its SMT sibling group
+
+    @classmethod
+    def detect(cls) -> 'CpuTopology':
+        allowed = set(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else set(range(os.cpu_count() or 1))
+
+        cpus_by_node = dict()
+        for path in glob.glob(os.path.join(NODE_ROOT, 'node*', 'cpulist')):
+            m = re.search(r'node(\d+)', path)
+            cpus = [cpu for cpu in parse_cpulist(_read(path) or '') if cpu in allowed]
+            if m and cpus:
+                cpus_by_node[int(m.group(1))] = cpus
+            # endif
+        # endfor
+        if not cpus_by_node:
+            # no NUMA information (non-Linux, containers): one node with every allowed CPU
+            cpus_by_node = {0: sorted(allowed)}
+        # endif
+
+        core_by_cpu = dict()
+        for cpu in allowed:
+            siblings = _read(os.path.join(CPU_ROOT, f'cpu{cpu}', 'topology', 'thread_siblings_list'))
+            core_by_cpu[cpu] = min(parse_cpulist(siblings)) if siblings else cpu
+        # endfor
+
+        return cls(cpus_by_node=dict(sorted(cpus_by_node.items())), core_by_cpu=core_by_cpu)
+    # enddef
+
+    @classmethod
+    def get(cls) -> 'CpuTopology':
+        """
+        Topology detected once, before any thread narrows its own affinity.
+
+        """
+        global _topology
+        if _topology is None:
+            _topology = cls.detect()
+        # endif
+
+        return _topology
+    # enddef
+
+    @property
+    def nodes(self) -> list[int]:
+        return list(self.cpus_by_node.keys())
+    # enddef
+
+    def node_cpus(self, node: int, avoid_smt: bool) -> list[int]:
+        """
+        CPUs of `node`; with `avoid_smt`, only one logical CPU per physical core.
+
+        """
+        assert_type(node, int)
+        assert_type(avoid_smt, bool)
+
+        cpus = self.cpus_by_node[node]
+        if avoid_smt:
+            cpus = [cpu for cpu in cpus if self.core_by_cpu.get(cpu, cpu) == cpu]
+        # endif
+
+        return cpus
+    # enddef
+
+    def plan_slots(self, num_slots: int, affinity: str, avoid_smt: bool) -> list[tuple[int, list[int]]]:
+        """
+        Spread compute slots round-robin over the NUMA nodes.
+
+        Args:
+            affinity: 'core' pins every slot to one CPU, 'node' lets it float over the CPUs of its node
+
+        Returns:
+            (node, cpus) per slot
+
+        """
+        assert_type(num_slots, int)
+        assert_type(affinity, str)
+        assert_type(avoid_smt, bool)
+
+        nodes = self.nodes
+        plan = []
+        for idx_slot in range(num_slots):
+            node = nodes[idx_slot % len(nodes)]
+            cpus = self.node_cpus(node, avoid_smt=avoid_smt)
+            if affinity == 'core':
+                cpus = [cpus[(idx_slot // len(nodes)) % len(cpus)]]
+            elif affinity == 'node':
+                pass
+            else:
+                raise NotImplementedError(affinity)
+            # endif
+            plan.append((node, cpus))
+        # endfor
+
+        return plan
+    # enddef
+
+
+# -------------------------
+# pinning
+# -------------------------
+def pin_current_thread(cpus: list[int], node: Optional[int]):
+    """
+    Pin the calling thread (not the whole process) to `cpus` and remember its NUMA node.
+    Memory first touched by this thread, e.g. a ROM it builds, is then allocated on that node.
+
+    """
+    assert_type(cpus, list, int)
+    assert_type(node, int, allow_none=True)
+
+    os.sched_setaffinity(0, set(cpus))  # on Linux, pid 0 is the calling thread
+    _local.node = node
+
+
+def current_node() -> Optional[int]:
+    """
+    NUMA node the calling thread was pinned to, or None when it is not pinned.
+
+    """
+    return getattr(_local, 'node', None)
@@ -4,6 +4,7 @@ from enum import Enum
 from functools import wraps
 
 import constants
+from metrics import Metrics
 from project import Project
 from utils import assert_type, msg_with_time
 
@@ -11,6 +12,8 @@ from utils import assert_type, msg_with_time
 class LogType(Enum):
     # system
     System = ('00_system')
+    DB_Write_Error = ('01_db_write_error')
+    DB_Maintenance = ('02_db_maintenance')
 
     # work
     Worklist = ('10_worklist')
@@ -20,10 +23,14 @@ class LogType(Enum):
     System_Metrics = ('14_system_metrics')
     ROM_Cache_Status = ('15_rom_cache_status')
     ROM_Cache_Maintenance = ('16_rom_cache_maintenance')
+    Bench = ('17_bench')
+    Metrics = ('18_metrics')
+    Profiler = ('19_profiler')
 
     # main loop
     Fetch_New_Challenge = ('20_fetch_new_challenge')
     Fetch_New_Challenge_Error = ('21_fetch_new_challenge_error')
+    ROM_Prefetch = ('22_rom_prefetch')
 
     # mining loop
     Active_Workers = ('30_active_workers')
@@ -33,6 +40,9 @@ class LogType(Enum):
     Solution_Submission = ('34_solution_submission')
     Solution_Submission_Error = ('35_solution_submission_error')
     Challenge_Expired = ('36_challenge_expired')
+    Preempted = ('37_preempted')
+    Challenge_Abandoned = ('38_challenge_abandoned')
+    Solve_Error = ('39_solve_error')
 
     # wallet
     Wallet_List = ('80_wallet_list')
@@ -78,23 +88,31 @@ class Logger:
 
 
 def measure_time(func):
+    """
+    Always records the call latency into the `Metrics` registry (a few hundred ns per call).
+    With `constants.DEBUG`, every call is also written to its own log file.
+
+    """
+    funcname = func.__qualname__
+    histogram = Metrics.histogram(funcname)
+
     @wraps(func)
     def wrapper(self, *args, **kwargs):
-        if constants.DEBUG:
-            start = time.time()
-        # endif
+        start_ns = time.perf_counter_ns()
 
         try:
             return func(self, *args, **kwargs)
         finally:
+            elapsed_ns = time.perf_counter_ns() - start_ns
+            if Metrics.enabled:
+                histogram.observe_ns(elapsed_ns)
+            # endif
+
             if constants.DEBUG:
-                end = time.time()
-                elapsed = end - start
-                funcname = func.__qualname__
-                msg = f'[{funcname}] took {elapsed:.1f} sec'
+                msg = f'[{funcname}] took {elapsed_ns / 1e9:.1f} sec'
 
                 logger = self.logger  # type: Logger
-                logger.log(msg, log_type=LogType.Func_Time_Measure, suffix=funcname, now=end)
+                logger.log(msg, log_type=LogType.Func_Time_Measure, suffix=funcname, now=time.time())
             # endif
         # endtry
     return wrapper
@@ -0,0 +1,144 @@
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+import psutil
+
+from utils import assert_type
+
+PSI_MEMORY_PATH = '/proc/pressure/memory'
+
+
+@dataclass
+class MemorySample:
+    memory_total: int  # bytes
+    memory_available: int  # bytes
+    psi_some_avg10: Optional[float]  # % of the last 10 sec some task stalled on memory; None without PSI
+    psi_full_avg10: Optional[float]  # % of the last 10 sec all tasks stalled on memory
+
+    @classmethod
+    def read(cls) -> 'MemorySample':
+        vm = psutil.virtual_memory()  # MemTotal / MemAvailable of /proc/meminfo
+        psi = cls.read_psi()
+
+        return MemorySample(memory_total=vm.total,
+                            memory_available=vm.available,
+                            psi_some_avg10=psi.get('some'),
+                            psi_full_avg10=psi.get('full'),
+                            )
+    # enddef
+
+    @staticmethod
+    def read_psi() -> dict[str, float]:
+        """
+        Returns:
+            avg10 of the 'some' and 'full' lines of /proc/pressure/memory, or {} if the kernel has no PSI
+
+        """
+        try:
+            with open(PSI_MEMORY_PATH) as f:
+                lines = f.read().splitlines()
+            # endwith
+        except OSError:
+            return dict()
+        # endtry
+
+        psi = dict()
+        for line in lines:
+            kind, *fields = line.split()
+            values = dict(field.split('=') for field in fields)
+            psi[kind] = float(values['avg10'])
+        # endfor
+
+        return psi
+    # enddef
+
+    @property
+    def memory_available_ratio(self) -> float:
+        return self.memory_available / self.memory_total
+    # enddef
+
+    def __str__(self) -> str:
+        psi = '-' if self.psi_some_avg10 is None else f'some {self.psi_some_avg10:.2f} % / full {self.psi_full_avg10:.2f} %'
+
+        return (f'available {self.memory_available / (1024 ** 3):,.2f} / {self.memory_total / (1024 ** 3):,.2f} GiB '
+                f'({self.memory_available_ratio:.1%}) | PSI avg10: {psi}')
+    # enddef
+
+
+class MemoryWatchdog:
+    """
+    Samples memory pressure every `interval` seconds in a background thread.
+
+    `on_pressure` is called on a sample under pressure (PSI stall time or MemAvailable past the high marks), at most
+    once per `PRESSURE_COOLDOWN`: PSI avg10 is a 10-sec average, so it keeps reading high for a while after memory
+    was freed, and acting on every sample would shed more than needed.
+    `on_calm` is called once the pressure stayed below the low marks for `CALM_SAMPLES` samples in a row, and again
+    every `CALM_SAMPLES` samples after that, so that the caller can undo its actions step by step.
+
+    """
+    DEFAULT_INTERVAL = 3.0  # sec
+    PSI_SOME_HIGH = 10.0  # %
+    PSI_SOME_LOW = 1.0  # %
+    AVAILABLE_RATIO_LOW = 0.05  # under pressure below this share of MemTotal
+    AVAILABLE_RATIO_HIGH = 0.10  # calm above this share of MemTotal
+    CALM_SAMPLES = 5
+    PRESSURE_COOLDOWN = 12.0  # sec between two actions, longer than the avg10 window
+
+    def __init__(self, on_pressure: Callable[[MemorySample], None], on_calm: Callable[[MemorySample], None],
+                 interval: float = DEFAULT_INTERVAL):
+        assert_type(interval, float)
+
+        self.on_pressure = on_pressure
+        self.on_calm = on_calm
+        self.interval = interval
+
+        self._stop_event = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+    # enddef
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True, name='memory_watchdog')
+        self._thread.start()
+    # enddef
+
+    def stop(self):
+        self._stop_event.set()
+    # enddef
+
+    def is_under_pressure(self, sample: MemorySample) -> bool:
+        return ((sample.psi_some_avg10 is not None and sample.psi_some_avg10 > self.PSI_SOME_HIGH)
+                or sample.memory_available_ratio < self.AVAILABLE_RATIO_LOW)
+    # enddef
+
+    def is_calm(self, sample: MemorySample) -> bool:
+        return ((sample.psi_some_avg10 is None or sample.psi_some_avg10 < self.PSI_SOME_LOW)
+                and sample.memory_available_ratio > self.AVAILABLE_RATIO_HIGH)
+    # enddef
+
+    def _run(self):
+        num_calm = 0
+        last_pressure_action = None  # type: Optional[float]
+        while not self._stop_event.wait(timeout=self.interval):
+            sample = MemorySample.read()
+
+            if self.is_under_pressure(sample):
+                num_calm = 0
+                now = time.monotonic()
+                if last_pressure_action is None or now - last_pressure_action >= self.PRESSURE_COOLDOWN:
+                    last_pressure_action = now
+                    self.on_pressure(sample)
+                # endif
+            elif self.is_calm(sample):
+                num_calm += 1
+                if num_calm >= self.CALM_SAMPLES:
+                    num_calm = 0
+                    self.on_calm(sample)
+                # endif
+            else:
+                num_calm = 0
+            # endif
+        # endwhile
+    # enddef
@@ -0,0 +1,300 @@
+import bisect
+import threading
+import time
+from dataclasses import dataclass
+from typing import *
+
+from utils import assert_type
+
+# upper bounds of the latency buckets: 1 us .. ~137 sec, doubling
+BUCKET_BOUNDS_NS = tuple(1_000 << i for i in range(28))
+
+
+# -------------------------
+# metrics
+# -------------------------
+class Counter:
+    """
+    Monotonic counter, sharded per thread: `inc` only touches the shard of the calling thread, so it takes no lock.
+    The shards of finished threads are folded into `_retired`, so that short-lived threads do not pile up.
+
+    """
+
+    def __init__(self, name: str):
+        assert_type(name, str)
+
+        self.name = name
+        self._local = threading.local()
+        self._lock = threading.Lock()  # only to register a new shard
+        self._shards = []  # type: list[tuple[threading.Thread, list[int]]]
+        self._retired = 0
+    # enddef
+
+    def _shard(self) -> list[int]:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = [0]
+            with self._lock:
+                self._retire_finished()
+                self._shards.append((threading.current_thread(), shard))
+            # endwith
+            self._local.shard = shard
+        # endif
+
+        return shard
+    # enddef
+
+    def _retire_finished(self):
+        # under self._lock; a finished thread writes no more, so its shard can be folded
+        list__shard = []  # type: list[tuple[threading.Thread, list[int]]]
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                list__shard.append((thread, shard))
+            else:
+                self._retired += shard[0]
+            # endif
+        # endfor
+        self._shards = list__shard
+    # enddef
+
+    def inc(self, n: int = 1):
+        self._shard()[0] += n
+    # enddef
+
+    @property
+    def value(self) -> int:
+        with self._lock:
+            self._retire_finished()
+
+            return self._retired + sum(shard[0] for thread, shard in self._shards)
+        # endwith
+    # enddef
+
+
+@dataclass
+class HistogramSnapshot:
+    name: str
+    count: int
+    sum_ns: int
+    max_ns: int
+    counts: list[int]  # per bucket, the last one is the overflow
+
+    @property
+    def mean_ns(self) -> float:
+        return self.sum_ns / self.count if self.count else 0.0
+    # enddef
+
+    def percentile_ns(self, q: float) -> int:
+        """
+        Upper bound of the bucket that holds the q-th percentile (0 < q <= 100).
+
+        """
+        assert_type(q, float)
+
+        if self.count == 0:
+            return 0
+        # endif
+
+        rank = q / 100 * self.count
+        cum = 0
+        for idx_bucket, count in enumerate(self.counts):
+            cum += count
+            if cum >= rank:
+                return min(BUCKET_BOUNDS_NS[idx_bucket], self.max_ns) if idx_bucket < len(BUCKET_BOUNDS_NS) else self.max_ns
+            # endif
+        # endfor
+
+        return self.max_ns
+    # enddef
+
+
+class Histogram:
+    """
+    Latency histogram with fixed, doubling buckets, sharded per thread like `Counter` (including the folding of the
+    shards of finished threads). Each shard is [bucket counts..., count, sum_ns, max_ns].
+
+    """
+    NUM_BUCKETS = len(BUCKET_BOUNDS_NS) + 1
+    IDX_COUNT = NUM_BUCKETS
+    IDX_SUM = NUM_BUCKETS + 1
+    IDX_MAX = NUM_BUCKETS + 2
+
+    def __init__(self, name: str):
+        assert_type(name, str)
+
+        self.name = name
+        self._local = threading.local()
+        self._lock = threading.Lock()  # only to register a new shard
+        self._shards = []  # type: list[tuple[threading.Thread, list[int]]]
+        self._retired = [0] * (self.NUM_BUCKETS + 3)
+    # enddef
+
+    def _shard(self) -> list[int]:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = [0] * (self.NUM_BUCKETS + 3)
+            with self._lock:
+                self._retire_finished()
+                self._shards.append((threading.current_thread(), shard))
+            # endwith
+            self._local.shard = shard
+        # endif
+
+        return shard
+    # enddef
+
+    def _retire_finished(self):
+        # under self._lock; a finished thread writes no more, so its shard can be folded
+        list__shard = []  # type: list[tuple[threading.Thread, list[int]]]
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                list__shard.append((thread, shard))
+            else:
+                for idx in range(self.IDX_MAX):
+                    self._retired[idx] += shard[idx]
+                # endfor
+                self._retired[self.IDX_MAX] = max(self._retired[self.IDX_MAX], shard[self.IDX_MAX])
+            # endif
+        # endfor
+        self._shards = list__shard
+    # enddef
+
+    def observe_ns(self, elapsed_ns: int):
+        shard = self._shard()
+        shard[bisect.bisect_left(BUCKET_BOUNDS_NS, elapsed_ns)] += 1
+        shard[self.IDX_COUNT] += 1
+        shard[self.IDX_SUM] += elapsed_ns
+        if elapsed_ns > shard[self.IDX_MAX]:
+            shard[self.IDX_MAX] = elapsed_ns
+        # endif
+    # enddef
+
+    def snapshot(self) -> HistogramSnapshot:
+        with self._lock:
+            self._retire_finished()
+            shards = [list(self._retired)] + [list(shard) for thread, shard in self._shards]
+        # endwith
+
+        counts = [sum(shard[idx] for shard in shards) for idx in range(self.NUM_BUCKETS)]
+
+        return HistogramSnapshot(name=self.name,
+                                 count=sum(shard[self.IDX_COUNT] for shard in shards),
+                                 sum_ns=sum(shard[self.IDX_SUM] for shard in shards),
+                                 max_ns=max([shard[self.IDX_MAX] for shard in shards], default=0),
+                                 counts=counts,
+                                 )
+    # enddef
+
+
+# -------------------------
+# registry
+# -------------------------
+class Metrics:
+    """
+    Process-wide registry of counters and latency histograms, always on.
+    Recording costs a thread-local lookup and a few list updates; only `snapshot` and `report` take locks.
+
+    """
+    enabled = True
+
+    _lock = threading.Lock()
+    _counters = dict()  # type: dict[str, Counter]
+    _histograms = dict()  # type: dict[str, Histogram]
+    _started_at = time.time()
+
+    @classmethod
+    def counter(cls, name: str) -> Counter:
+        counter = cls._counters.get(name)
+        if counter is None:
+            with cls._lock:
+                counter = cls._counters.setdefault(name, Counter(name))
+            # endwith
+        # endif
+
+        return counter
+    # enddef
+
+    @classmethod
+    def histogram(cls, name: str) -> Histogram:
+        histogram = cls._histograms.get(name)
+        if histogram is None:
+            with cls._lock:
+                histogram = cls._histograms.setdefault(name, Histogram(name))
+            # endwith
+        # endif
+
+        return histogram
+    # enddef
+
+    # -------------------------
+    # recording
+    # -------------------------
+    @classmethod
+    def inc(cls, name: str, n: int = 1):
+        if cls.enabled:
+            cls.counter(name).inc(n)
+        # endif
+    # enddef
+
+    @classmethod
+    def observe_ns(cls, name: str, elapsed_ns: int):
+        if cls.enabled:
+            cls.histogram(name).observe_ns(elapsed_ns)
+        # endif
+    # enddef
+
+    # -------------------------
+    # reporting
+    # -------------------------
+    @classmethod
+    def snapshot(cls) -> tuple[dict[str, int], dict[str, HistogramSnapshot]]:
+        with cls._lock:
+            counters = list(cls._counters.values())
+            histograms = list(cls._histograms.values())
+        # endwith
+
+        return ({counter.name: counter.value for counter in counters},
+                {histogram.name: histogram.snapshot() for histogram in histograms})
+    # enddef
+
+    @classmethod
+    def report(cls) -> list[str]:
+        values_by_counter, snapshot_by_histogram = cls.snapshot()
+        uptime = max(time.time() - cls._started_at, 1e-9)
+
+        def fmt_ns(ns: float) -> str:
+            if ns >= 1e9:
+                return f'{ns / 1e9:,.2f} s'
+            elif ns >= 1e6:
+                return f'{ns / 1e6:,.2f} ms'
+            else:
+                return f'{ns / 1e3:,.1f} us'
+            # endif
+        # enddef
+
+        lines = []
+        if snapshot_by_histogram:
+            lines.append(f'{"latency":48} | {"count":>10} | {"mean":>10} | {"p50":>10} | {"p99":>10} | {"max":>10}')
+            lines.append('-' * 110)
+            for name in sorted(snapshot_by_histogram.keys()):
+                hs = snapshot_by_histogram[name]
+                if hs.count == 0:
+                    continue
+                # endif
+                lines.append(f'{name:48} | {hs.count:10,} | {fmt_ns(hs.mean_ns):>10} | {fmt_ns(hs.percentile_ns(50.0)):>10} | '
+                             f'{fmt_ns(hs.percentile_ns(99.0)):>10} | {fmt_ns(hs.max_ns):>10}')
+            # endfor
+        # endif
+
+        if values_by_counter:
+            lines.append('')
+            lines.append(f'{"counter":48} | {"value":>16} | {"per sec":>12}')
+            lines.append('-' * 82)
+            for name in sorted(values_by_counter.keys()):
+                value = values_by_counter[name]
+                lines.append(f'{name:48} | {value:16,} | {value / uptime:12,.1f}')
+            # endfor
+        # endif
+
+        return lines
+    # enddef
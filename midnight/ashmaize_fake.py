@@ -0,0 +1,117 @@
+import hashlib
+import time
+from typing import Optional
+
+import numpy as np
+
+from utils import assert_type
+
+
+class FakeRom:
+    """
+    Pure-Python/NumPy stand-in for the native `PyRom`.
+
+    The hash is blake2b-512 over the preimage, keyed by the ROM key and mixed with a few ROM words picked by the
+    preimage, so it is deterministic per (key, preimage) and has the same shape as the real one (128 hex chars).
+    It is NOT the AshMaize hash: solutions found with it are rejected by the server.
+    `hash_cost` emulates the per-hash cost of the native code with a sleep, which releases the GIL like the native code does.
+
+    """
+    NUM_ROM_READS = 4
+
+    def __init__(self, key: str, size: int, hash_cost: float):
+        assert_type(key, str)
+        assert_type(size, int)
+        assert_type(hash_cost, float)
+
+        self.key = key
+        self.size = size
+        self.hash_cost = hash_cost
+
+        self._key_bytes = hashlib.blake2b(key.encode(), digest_size=64).digest()
+
+        # deterministic content, allocated for real so that memory accounting behaves like the native ROM
+        seed = int.from_bytes(self._key_bytes[:8], 'little')
+        self.data = np.random.default_rng(seed).integers(0, 1 << 64, size=max(1, size // 8), dtype=np.uint64)
+    # enddef
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+    # enddef
+
+    def _hash(self, preimage: str) -> str:
+        h = hashlib.blake2b(preimage.encode(), digest_size=64, key=self._key_bytes)
+        digest = h.digest()
+
+        # depend on the ROM, not only on the key
+        for i in range(self.NUM_ROM_READS):
+            idx = int.from_bytes(digest[8 * i:8 * i + 8], 'little') % len(self.data)
+            h.update(self.data[idx].tobytes())
+        # endfor
+
+        return h.hexdigest()
+    # enddef
+
+    def _spend(self, num_hashes: int):
+        if self.hash_cost > 0:
+            time.sleep(self.hash_cost * num_hashes)
+        # endif
+    # enddef
+
+    # -------------------------
+    # PyRom
+    # -------------------------
+    def hash(self, preimage: str) -> str:
+        self._spend(1)
+
+        return self._hash(preimage)
+    # enddef
+
+    def hash_with_params(self, preimage: str, nb_loops: int, nb_instrs: int) -> str:
+        return self.hash(preimage)
+    # enddef
+
+    def hash_batch(self, preimages: list[str]) -> list[str]:
+        self._spend(len(preimages))
+
+        return [self._hash(preimage) for preimage in preimages]
+    # enddef
+
+    def hash_batch_with_params(self, preimages: list[str], nb_loops: int, nb_instrs: int) -> list[str]:
+        return self.hash_batch(preimages)
+    # enddef
+
+
+class FakeAshMaize:
+    """
+    Stand-in for the native `ashmaize_py` module, for load tests and benchmarks of everything around the native call
+    on machines without the binary.
+
+    Args:
+        rom_size: size of every ROM in bytes, regardless of the requested size; None builds the requested size
+        hash_cost: emulated native time per hash in seconds
+
+    """
+
+    def __init__(self, rom_size: Optional[int] = None, hash_cost: float = 0.0):
+        assert_type(rom_size, int, allow_none=True)
+        assert_type(hash_cost, float)
+
+        self.rom_size = rom_size
+        self.hash_cost = hash_cost
+    # enddef
+
+    # -------------------------
+    # PyAshMaize
+    # -------------------------
+    def build_rom(self, key: str, size: int) -> FakeRom:
+        assert_type(key, str)
+        assert_type(size, int)
+
+        return FakeRom(key=key, size=self.rom_size or size, hash_cost=self.hash_cost)
+    # enddef
+
+    def build_rom_twostep(self, key: str, size: int = 1073741824, pre_size=16777216, mixing_numbers: int = 4) -> FakeRom:
+        return self.build_rom(key=key, size=size)
+    # enddef
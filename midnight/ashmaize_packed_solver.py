@@ -0,0 +1,348 @@
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Optional
+
+from cpu_topology import CpuTopology, current_node, pin_current_thread
+from logger import Logger, measure_time
+from metrics import Metrics
+from midnight.ashmaize import PyRom
+from midnight.ashmaize_rom_manager import AshMaizeROMManager, RomLease
+from midnight.ashmaize_solver import AshMaizeSolver, WorkerProfile
+from midnight.challenge import Challenge
+from midnight.nonce_cursor import NonceCursor
+from midnight.solution import Solution
+from midnight.tracker import Tracker
+from utils import assert_type
+
+
+@dataclass
+class PackedJob:
+    address: str
+    worker_profile: WorkerProfile
+    cursor: NonceCursor
+    preimage_base: str
+    difficulty_mask: int
+    solution: Optional[Solution] = None
+    done: threading.Event = field(default_factory=threading.Event, repr=False)
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+
+
+class RomBatchPacker:
+    """
+    Hashes the jobs of every (address, challenge) that share one ROM with mixed batches.
+
+    Each lane takes a slice of nonces from every registered job, concatenates all preimages into one `hash_batch`
+    call, then splits the results by owner: each segment is screened with the owner's difficulty and hits are routed
+    back to that job. Lanes exit when there is no job left, so that the ROM can be released: while any lane runs,
+    the packer holds its own lease on the ROM, since a lane may still be hashing after the last job left.
+    The number of lanes follows the solver's share for each packer with jobs: a lane over the share exits after its
+    batch, and a lane under it starts another one.
+
+    """
+    IDLE_TIMEOUT = 5.0  # sec
+
+    def __init__(self, solver: 'AshMaizePackedSolver', key: str, rom: PyRom, node: Optional[int]):
+        assert_type(key, str)
+        assert_type(node, int, allow_none=True)
+
+        self.solver = solver
+        self.key = key
+        self.rom = rom
+        self.node = node
+
+        self._cond = threading.Condition()
+        self._jobs = []  # type: list[PackedJob]
+        self._num_running_lanes = 0
+        self._lease = None  # type: Optional[RomLease]
+    # enddef
+
+    # -------------------------
+    # jobs
+    # -------------------------
+    def add(self, job: PackedJob, lease: Optional[RomLease] = None):
+        assert_type(job, PackedJob)
+        assert_type(lease, RomLease, allow_none=True)
+
+        with self._cond:
+            if not self._jobs:
+                self.solver.count_active_packer(+1)
+            # endif
+            self._jobs.append(job)
+            if lease is not None and self._lease is None:
+                self._lease = lease.share()
+            # endif
+            self._start_lanes()
+            self._cond.notify_all()
+        # endwith
+    # enddef
+
+    def remove(self, job: PackedJob):
+        assert_type(job, PackedJob)
+
+        with self._cond:
+            if job in self._jobs:
+                self._jobs.remove(job)
+                if not self._jobs:
+                    self.solver.count_active_packer(-1)
+                # endif
+            # endif
+        # endwith
+    # enddef
+
+    def is_idle(self) -> bool:
+        with self._cond:
+            return not self._jobs and self._num_running_lanes == 0
+        # endwith
+    # enddef
+
+    # -------------------------
+    # lanes
+    # -------------------------
+    def _lane_loop(self):
+        if self.node is not None:
+            # serve the ROM only from the node it was built on
+            pin_current_thread(CpuTopology.get().node_cpus(self.node, avoid_smt=False), node=self.node)
+        # endif
+
+        is_counted = True
+        try:
+            while self.solver.is_running():
+                with self._cond:
+                    if not self._jobs:
+                        self._cond.wait(timeout=self.IDLE_TIMEOUT)
+                    # endif
+                    jobs = [job for job in self._jobs if not job.done.is_set()]
+                    if not jobs or self._num_running_lanes > self.solver.get_lane_share():
+                        # decided under the same lock as `add`, so a new job always finds a lane
+                        self._exit_lane()
+                        is_counted = False
+
+                        return
+                    # endif
+                    self._start_lanes()  # take over the lanes of packers that went idle
+                # endwith
+
+                self.hash_packed_batch(jobs)
+            # endwhile
+        finally:
+            if is_counted:
+                with self._cond:
+                    self._exit_lane()
+                # endwith
+            # endif
+        # endtry
+    # enddef
+
+    def _start_lanes(self):
+        # under self._cond
+        num_lanes = self.solver.get_lane_share()
+        while self._num_running_lanes < num_lanes:
+            self._num_running_lanes += 1
+            threading.Thread(target=self._lane_loop, daemon=True).start()
+        # endwhile
+    # enddef
+
+    def _exit_lane(self):
+        # under self._cond
+        self._num_running_lanes -= 1
+        if self._num_running_lanes == 0 and self._lease is not None:
+            self._lease.release()
+            self._lease = None
+        # endif
+    # enddef
+
+    @measure_time
+    def hash_packed_batch(self, jobs: list[PackedJob], batch_size: Optional[int] = None):
+        """
+        Args:
+            batch_size: total preimages of the mixed batch; defaults to the suggestion of the batch-size controller
+
+        """
+        assert_type(jobs, list, PackedJob)
+        assert_type(batch_size, int, allow_none=True)
+
+        controller = self.solver.batch_size_controller
+        batch_size = batch_size or controller.suggest(difficulty_mask=0xffffffff)
+        segment_size = max(1, batch_size // len(jobs))
+
+        # -------------------------
+        # pack: one segment per job
+        # -------------------------
+        time_start = time.time()
+
+        cpu_start = time.thread_time_ns()
+        t0 = time.perf_counter_ns()
+        preimages = []
+        segments = []  # type: list[tuple[PackedJob, int, int]]
+        for job in jobs:
+            size = min(segment_size, controller.cap(difficulty_mask=job.difficulty_mask))
+            nonce_batch_hex = job.cursor.render_hex(start=job.cursor.reserve(size), batch_size=size)
+
+            segments.append((job, len(preimages), size))
+            preimages += self.solver.build_preimages(nonce_batch_hex=nonce_batch_hex, preimage_base=job.preimage_base)
+        # endfor
+
+        t1 = time.perf_counter_ns()
+        list__hash_hex = self.rom.hash_batch(preimages)
+        t2 = time.perf_counter_ns()
+
+        Metrics.observe_ns('solver.build_preimages', t1 - t0)
+        Metrics.observe_ns('solver.hash_batch', t2 - t1)
+        Metrics.inc('solver.hashes', len(preimages))
+
+        time_end = time.time()
+        time_elapse = time_end - time_start
+        hashrate = len(preimages) / time_elapse
+        # credit the ladder size the batch was cut from; its actual length depends on the number of jobs and their caps
+        self.solver.observe_batch(batch_size=batch_size, hashrate=hashrate)
+
+        # -------------------------
+        # unpack: route results to their owners
+        # -------------------------
+        t3 = time.perf_counter_ns()
+        for job, pos, size in segments:
+            idx_hit = self.solver.screen_hashes(list__hash_hex=list__hash_hex[pos:pos + size], difficulty_mask=job.difficulty_mask)
+
+            with job.lock:
+                job_stats = job.worker_profile.job_stats
+                if job.done.is_set() or job_stats is None:
+                    continue
+                # endif
+
+                job.worker_profile.batch_size = size
+                job_stats.hashrate = size / time_elapse
+                job_stats.updated_at = time_end
+                if idx_hit is None:
+                    job_stats.tries += size
+                else:
+                    job_stats.tries += (idx_hit + 1)
+                    job.solution = Solution(nonce_hex=preimages[pos + idx_hit][:self.solver.NONCE_HEX_LEN],
+                                            hash_hex=list__hash_hex[pos + idx_hit],
+                                            tries=job_stats.tries)
+                    job.done.set()
+                # endif
+            # endwith
+        # endfor
+        t4 = time.perf_counter_ns()
+        cpu_end = time.thread_time_ns()
+        Metrics.observe_ns('solver.screen_hashes', t4 - t3)
+
+        # -------------------------
+        # phases: every job is charged its share of the mixed batch
+        # -------------------------
+        for job, pos, size in segments:
+            share = size / len(preimages) * 1e-9
+            job.worker_profile.phase_stats.observe(prep=(t1 - t0) * share, hash=(t2 - t1) * share, screen=(t4 - t3) * share,
+                                                   wall=(t4 - t0) * share, cpu=(cpu_end - cpu_start) * share)
+        # endfor
+    # enddef
+
+
+class AshMaizePackedSolver(AshMaizeSolver):
+    """
+    Instead of hashing in the caller's thread, `solve` registers the job with the `RomBatchPacker` of its ROM and waits.
+    Wallets whose challenges share a `no_pre_mine` are then hashed together by the lanes of that ROM; `num_lanes` is
+    the budget of all packers together, split evenly across the packers that have jobs (e.g. at a day rollover).
+
+    """
+    def __init__(self, worker_nicknames: dict[str, str], logger: Logger, tracker: Tracker, batch_size: Optional[int] = None,
+                 num_lanes: Optional[int] = None):
+        assert_type(num_lanes, int, allow_none=True)
+
+        super().__init__(worker_nicknames=worker_nicknames, logger=logger, tracker=tracker, batch_size=batch_size)
+
+        self.num_lanes = num_lanes or os.cpu_count() or 1
+
+        self._packers_lock = threading.Lock()
+        self._packers = dict()  # type: dict[tuple[str, Optional[int]], RomBatchPacker]
+        self._lanes_lock = threading.Lock()  # leaf lock: taken under a packer's lock, takes none itself
+        self._num_active_packers = 0
+    # enddef
+
+    # -------------------------
+    # lane budget
+    # -------------------------
+    def count_active_packer(self, delta: int):
+        assert_type(delta, int)
+
+        with self._lanes_lock:
+            self._num_active_packers += delta
+        # endwith
+    # enddef
+
+    def get_lane_share(self) -> int:
+        """
+        Lanes per packer with jobs, so that all packers together run about `num_lanes` lanes.
+
+        """
+        with self._lanes_lock:
+            return max(1, self.num_lanes // max(1, self._num_active_packers))
+        # endwith
+    # enddef
+
+    def _get_packer(self, key: str, rom: PyRom) -> RomBatchPacker:
+        assert_type(key, str)
+
+        packer_key = (key, current_node())
+        with self._packers_lock:
+            # forget the packers whose lanes have exited, so that their ROMs can be freed
+            for k in [k for k, packer in self._packers.items() if k != packer_key and packer.is_idle()]:
+                del self._packers[k]
+            # endfor
+
+            packer = self._packers.get(packer_key)
+            if packer is None or packer.rom is not rom:
+                packer = RomBatchPacker(solver=self, key=key, rom=rom, node=packer_key[1])
+                self._packers[packer_key] = packer
+            # endif
+
+            return packer
+        # endwith
+    # enddef
+
+    @measure_time
+    def solve(self, address: str, challenge: Challenge) -> Optional[Solution]:
+        assert_type(address, str)
+        assert_type(challenge, Challenge)
+
+        worker_profile = self.wp_by_address[address]
+        worker_profile.job_stats = self.start_job(address=address, challenge=challenge)
+
+        solution = None
+        try:
+            with AshMaizeROMManager.lease(challenge.no_pre_mine) as lease:
+                packer = self._get_packer(key=challenge.no_pre_mine, rom=lease.rom)
+
+                difficulty_value = int(challenge.difficulty[:8], 16)
+                job = PackedJob(address=address,
+                                worker_profile=worker_profile,
+                                cursor=worker_profile.job_stats.cursor,
+                                preimage_base=self.get_preimage_base(address=address, challenge=challenge),
+                                difficulty_mask=~difficulty_value & 0xffffffff,
+                                )
+                packer.add(job, lease=lease)  # from here on, the packer holds its own lease while its lanes run
+            # endwith
+            try:
+                while self.is_running() and challenge.is_valid() and not self.should_yield(address):
+                    if job.done.wait(timeout=1.0):
+                        break
+                    # endif
+
+                    self.report_progress(address=address, worker_profile=worker_profile)
+                # endwhile
+            finally:
+                packer.remove(job)
+            # endtry
+
+            with job.lock:
+                job.done.set()  # no more updates from the lanes
+                solution = job.solution
+            # endwith
+
+            return solution
+        finally:
+            self.finish_job(address=address, worker_profile=worker_profile, solution=solution)
+        # endtry
+    # enddef
@@ -0,0 +1,175 @@
+import multiprocessing as mp
+import queue
+from typing import Optional
+
+from logger import Logger, measure_time
+from metrics import Metrics
+from midnight.ashmaize import PyRom
+from midnight.ashmaize_rom_manager import AshMaizeROMManager
+from midnight.ashmaize_solver import AshMaizeSolver, WorkerProfile
+from midnight.challenge import Challenge
+from midnight.solution import Solution
+from midnight.tracker import Tracker
+from utils import assert_type
+
+
+class AshMaizeProcessSolver(AshMaizeSolver):
+    """
+    Runs every solve in a forked child process so that nonce generation, preimage building and screening escape the GIL.
+    The ROM is built in the parent before forking, so the child inherits it through copy-on-write instead of rebuilding it.
+    Progress and solutions flow back through a queue into `wp_by_address` of the parent.
+
+    """
+    CHILD_JOIN_TIMEOUT = 5.0
+
+    def __init__(self, worker_nicknames: dict[str, str], logger: Logger, tracker: Tracker, batch_size: Optional[int] = None):
+        super().__init__(worker_nicknames=worker_nicknames, logger=logger, tracker=tracker, batch_size=batch_size)
+
+        self._ctx = mp.get_context('fork')
+        self._stop_event = self._ctx.Event()  # shared with the children
+
+        # -------------------------
+        # set in the child only
+        # -------------------------
+        self._child_queue = None  # type: Optional[mp.Queue]
+        self._child_yield_event = None  # type: Optional[mp.Event]
+    # enddef
+
+    # -------------------------
+    # parent
+    # -------------------------
+    @measure_time
+    def solve(self, address: str, challenge: Challenge) -> Optional[Solution]:
+        assert_type(address, str)
+        assert_type(challenge, Challenge)
+
+        # the checkpoint and the ROM are loaded here, so that the child inherits both
+        worker_profile = self.wp_by_address[address]
+        worker_profile.job_stats = self.start_job(address=address, challenge=challenge)
+
+        solution = None
+        try:
+            # the parent holds the lease until the child is gone, since the child shares the ROM pages
+            lease = AshMaizeROMManager.lease(challenge.no_pre_mine)
+            try:
+                q = self._ctx.Queue()
+                yield_event = self._ctx.Event()
+                proc = self._ctx.Process(
+                    target=self._run_child,
+                    args=(address, lease.rom, q, yield_event),
+                    daemon=True,
+                    )
+                proc.start()
+
+                try:
+                    solution = self._receive_from_child(address=address, worker_profile=worker_profile, proc=proc, q=q, yield_event=yield_event)
+                finally:
+                    proc.join(timeout=self.CHILD_JOIN_TIMEOUT)
+                    if proc.is_alive():
+                        proc.terminate()
+                        proc.join()
+                    # endif
+                    q.close()
+                # endtry
+            finally:
+                lease.release()
+            # endtry
+
+            return solution
+        finally:
+            self.finish_job(address=address, worker_profile=worker_profile, solution=solution)
+        # endtry
+    # enddef
+
+    def _receive_from_child(self, address: str, worker_profile: WorkerProfile, proc: mp.Process, q: mp.Queue,
+                            yield_event: mp.Event) -> Optional[Solution]:
+        while True:
+            if self.should_yield(address) or not self.is_running():
+                # preemption and stop live in the parent; hand them over to the child
+                yield_event.set()
+            # endif
+
+            try:
+                msg = q.get(timeout=1.0)
+            except queue.Empty:
+                if not proc.is_alive():
+                    return None
+                # endif
+
+                continue
+            # endtry
+
+            kind = msg[0]
+            if kind == 'progress':
+                _, tries, hashrate, batch_size, updated_at, nonce_offset, phase_stats = msg
+                job_stats = worker_profile.job_stats
+                job_stats.tries = tries
+                job_stats.hashrate = hashrate
+                job_stats.updated_at = updated_at
+                job_stats.cursor.offset = nonce_offset
+                worker_profile.batch_size = batch_size
+                worker_profile.phase_stats = phase_stats
+
+                self.save_checkpoint(address=address, worker_profile=worker_profile, force=False)
+            elif kind == 'observe':
+                _, batch_size, hashrate = msg
+                self.batch_size_controller.observe(batch_size=batch_size, hashrate=hashrate)
+            elif kind == 'done':
+                return msg[1]
+            else:
+                raise NotImplementedError(kind)
+            # endif
+        # endwhile
+    # enddef
+
+    # -------------------------
+    # child
+    # -------------------------
+    def _run_child(self, address: str, rom: PyRom, q: mp.Queue, yield_event: mp.Event):
+        # never touch the ROM manager or the DB (and their locks) after fork; job_stats was inherited from the parent
+        self.batch_size_controller = self.batch_size_controller.detached()
+        Metrics.enabled = False  # the registry's locks are the parent's too, and the child's records would be lost anyway
+        self._child_queue = q
+        self._child_yield_event = yield_event
+
+        solution = None
+        try:
+            solution = self.search(address=address, worker_profile=self.wp_by_address[address], rom=rom)
+        finally:
+            q.put(('done', solution))
+        # endtry
+    # enddef
+
+    def should_yield(self, address: str) -> bool:
+        assert_type(address, str)
+
+        if self._child_yield_event is not None:
+            return self._child_yield_event.is_set()
+        # endif
+
+        return super().should_yield(address)
+    # enddef
+
+    def report_progress(self, address: str, worker_profile: WorkerProfile):
+        assert_type(address, str)
+        assert_type(worker_profile, WorkerProfile)
+
+        if self._child_queue is None:
+            super().report_progress(address=address, worker_profile=worker_profile)
+
+            return
+        # endif
+
+        job_stats = worker_profile.job_stats
+        self._child_queue.put(('progress', job_stats.tries, job_stats.hashrate, worker_profile.batch_size, job_stats.updated_at, job_stats.cursor.offset,
+                               worker_profile.phase_stats))
+    # enddef
+
+    def observe_batch(self, batch_size: int, hashrate: float):
+        super().observe_batch(batch_size=batch_size, hashrate=hashrate)
+
+        if self._child_queue is not None:
+            # let the parent's controller learn from the children as well
+            self._child_queue.put(('observe', batch_size, hashrate))
+        # endif
+    # enddef
@@ -1,69 +1,582 @@
-import sys
+import os
 import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass
+from enum import Enum
+from typing import Callable, Optional
 
+import psutil
+
+from cpu_topology import current_node, pin_current_thread
+from metrics import Metrics
 from midnight.ashmaize import PyAshMaize, PyRom
 from utils import assert_type
 
-try:
-    from midnight import ashmaize_loader
-    ashmaize_py = ashmaize_loader.init()  # type: PyAshMaize
-except ImportError:
-    sys.exit(1)
+
+class PrefetchResult(Enum):
+    Started = 'started'
+    Cached = 'cached'  # already cached or being built
+    Over_Budget = 'over_budget'
+
+
+class AshMaizeBackend(Enum):
+    Native = 'native'  # ashmaize_py binary of this platform
+    Fake = 'fake'  # deterministic pure-Python stand-in (see ashmaize_fake.py)
+
+
+@dataclass
+class RomEntry:
+    rom: PyRom
+    size: int  # bytes
+    build_seconds: float  # cost of a rebuild
+    last_used: float
+    num_leases: int = 0
+    is_evicted: bool = False  # evicted while leased; removed on the last release
+
+
+@dataclass
+class RomStatus:
+    size: int  # bytes
+    num_leases: int
+    is_evicted: bool
+    last_used: float
+
+    @property
+    def is_leased(self) -> bool:
+        return self.num_leases > 0
+    # enddef
+
+
+class RomLease:
+    """
+    A reference on a cached ROM: while any lease on it is held, the ROM stays in the cache (and is served to the
+    next caller of its key) instead of being evicted from under the worker that hashes with it.
+    Release it exactly once, or use it as a context manager.
+
+    """
+
+    def __init__(self, cache_key: tuple[str, Optional[int]], entry: RomEntry):
+        self.cache_key = cache_key
+        self._entry = entry
+        self._is_released = False
+    # enddef
+
+    @property
+    def rom(self) -> PyRom:
+        return self._entry.rom
+    # enddef
+
+    def share(self) -> 'RomLease':
+        """
+        Another lease on the same ROM, for a holder that may outlive this one.
+
+        """
+        return AshMaizeROMManager._share(self.cache_key, self._entry)
+    # enddef
+
+    def release(self):
+        if not self._is_released:
+            self._is_released = True
+            AshMaizeROMManager._release(self.cache_key, self._entry)
+        # endif
+    # enddef
+
+    def __enter__(self) -> 'RomLease':
+        return self
+    # enddef
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+    # enddef
 
 
 class AshMaizeROMManager:
-    _lock = threading.Lock()
-    _cache = {}  # type: dict[str, PyRom]
+    """
+    Cache of built ROMs. When the calling thread is pinned to a NUMA node, the ROM is cached per (key, node):
+    it is built (first-touched) by a thread of that node and only served to threads of that node.
+
+    The cache holds at most a byte budget (ROMs being built included). Room for a new ROM is made when its build
+    starts, by evicting first the ROMs no queued or running job needs (least recently used first), then those whose
+    outstanding work times rebuild cost is the lowest. Leased ROMs are never evicted to make room; an explicit
+    `drop` / `clear_all` of a leased ROM is deferred until its last lease is released, so that every resident ROM is
+    accounted for and no second copy of it is built meanwhile.
+
+    """
+    _lock = threading.Lock()  # guards the dicts only; never held while building
+    _cache = {}  # type: dict[tuple[str, Optional[int]], RomEntry]
+    _builds = {}  # type: dict[tuple[str, Optional[int]], Future]
 
     ROM_SIZE = 1_073_741_824
+    MAX_CONCURRENT_BUILDS = 2  # each build is CPU- and memory-bandwidth-heavy
+    PREFETCH_HEADROOM = 2 * 1_073_741_824  # MemAvailable that must be left after every in-flight build
+    _build_semaphore = threading.BoundedSemaphore(MAX_CONCURRENT_BUILDS)
+
+    # -------------------------
+    # budget / eviction
+    # -------------------------
+    DEFAULT_BUDGET_RATIO = 0.7  # of MemTotal, unless a budget is set
+    _budget = None  # type: Optional[int]
+    _demand_provider = None  # type: Optional[Callable[[], dict[str, int]]]
+    _eviction_listener = None  # type: Optional[Callable[[str, Optional[int], int, str], None]]
+
+    # -------------------------
+    # backend:
+    # loaded on first use, so that importing the solver does not need the binary
+    # -------------------------
+    BACKEND_ENV = 'ASHMAIZE_BACKEND'
+    FAKE_ROM_SIZE_ENV = 'ASHMAIZE_FAKE_ROM_SIZE'  # bytes
+    FAKE_HASH_COST_ENV = 'ASHMAIZE_FAKE_HASH_COST_US'  # microseconds per hash
+    _backend_lock = threading.Lock()
+    _backend = None  # type: Optional[AshMaizeBackend]
+    _ashmaize = None  # type: Optional[PyAshMaize]
+
+    @classmethod
+    def set_backend(cls, backend: AshMaizeBackend):
+        assert_type(backend, AshMaizeBackend)
+
+        with cls._backend_lock:
+            if backend != cls._backend:
+                cls._backend = backend
+                cls._ashmaize = None
+            # endif
+        # endwith
+    # enddef
+
+    @classmethod
+    def get_backend(cls) -> AshMaizeBackend:
+        with cls._backend_lock:
+            if cls._backend is None:
+                cls._backend = AshMaizeBackend(os.environ.get(cls.BACKEND_ENV, AshMaizeBackend.Native.value))
+            # endif
+
+            return cls._backend
+        # endwith
+    # enddef
+
+    @classmethod
+    def get_ashmaize(cls) -> PyAshMaize:
+        backend = cls.get_backend()
+        with cls._backend_lock:
+            if cls._ashmaize is None:
+                if backend == AshMaizeBackend.Native:
+                    from midnight import ashmaize_loader
+                    cls._ashmaize = ashmaize_loader.init()
+                elif backend == AshMaizeBackend.Fake:
+                    from midnight.ashmaize_fake import FakeAshMaize
+                    rom_size = os.environ.get(cls.FAKE_ROM_SIZE_ENV)
+                    cls._ashmaize = FakeAshMaize(rom_size=int(rom_size) if rom_size else None,
+                                                 hash_cost=float(os.environ.get(cls.FAKE_HASH_COST_ENV, 0)) * 1e-6,
+                                                 )
+                else:
+                    raise NotImplementedError(backend)
+                # endif
+            # endif
+
+            return cls._ashmaize
+        # endwith
+    # enddef
+
+    # -------------------------
+    # cache
+    # -------------------------
+    @classmethod
+    def set_max_concurrent_builds(cls, max_concurrent_builds: int):
+        assert_type(max_concurrent_builds, int)
+
+        cls.MAX_CONCURRENT_BUILDS = max(1, max_concurrent_builds)
+        cls._build_semaphore = threading.BoundedSemaphore(cls.MAX_CONCURRENT_BUILDS)
+    # enddef
+
+    @classmethod
+    def set_budget(cls, budget: Optional[int]):
+        assert_type(budget, int, allow_none=True)
+
+        cls._budget = budget
+    # enddef
+
+    @classmethod
+    def get_budget(cls) -> int:
+        return cls._budget or int(psutil.virtual_memory().total * cls.DEFAULT_BUDGET_RATIO)
+    # enddef
+
+    @classmethod
+    def set_demand_provider(cls, demand_provider: Callable[[], dict[str, int]]):
+        """
+        `demand_provider()` returns the outstanding work (e.g. queued and running jobs) per ROM key.
+
+        """
+        cls._demand_provider = demand_provider
+    # enddef
+
+    @classmethod
+    def set_eviction_listener(cls, eviction_listener: Callable[[str, Optional[int], int, str], None]):
+        """
+        `eviction_listener(key, node, size, reason)` is called after a ROM has been evicted.
+
+        """
+        cls._eviction_listener = eviction_listener
+    # enddef
+
+    @classmethod
+    def _get_demand(cls) -> dict[str, int]:
+        # called without the lock: the provider takes its own locks
+        return cls._demand_provider() if cls._demand_provider else dict()
+    # enddef
+
+    @classmethod
+    def _share(cls, cache_key: tuple[str, Optional[int]], entry: RomEntry) -> RomLease:
+        with cls._lock:
+            entry.num_leases += 1
+        # endwith
+
+        return RomLease(cache_key=cache_key, entry=entry)
+    # enddef
+
+    @classmethod
+    def _release(cls, cache_key: tuple[str, Optional[int]], entry: RomEntry):
+        with cls._lock:
+            entry.num_leases -= 1
+            entry.last_used = time.time()
+
+            is_removed = entry.num_leases == 0 and entry.is_evicted and cls._cache.get(cache_key) is entry
+            if is_removed:
+                del cls._cache[cache_key]
+            # endif
+        # endwith
+
+        if is_removed:
+            cls._notify_evicted([(cache_key, entry)], reason='deferred until released')
+        # endif
+    # enddef
+
+    @classmethod
+    def _bytes_used(cls) -> int:
+        return sum(entry.size for entry in cls._cache.values()) + len(cls._builds) * cls.ROM_SIZE
+    # enddef
+
+    @classmethod
+    def _eviction_order(cls, demand: dict[str, int]) -> list[tuple[str, Optional[int]]]:
+        """
+        Cache keys of the idle ROMs, cheapest to lose first: unneeded ROMs (LRU), then by outstanding work x rebuild cost.
+
+        """
+        def score(cache_key: tuple[str, Optional[int]]) -> tuple:
+            entry = cls._cache[cache_key]
+            num_jobs = demand.get(cache_key[0], 0)
+
+            return num_jobs > 0, num_jobs * entry.build_seconds, entry.last_used
+        # enddef
+
+        return sorted([cache_key for cache_key, entry in cls._cache.items() if entry.num_leases == 0], key=score)
+    # enddef
+
+    @classmethod
+    def _evict(cls, cache_key: tuple[str, Optional[int]]) -> Optional[RomEntry]:
+        """
+        Returns:
+            the removed entry, or None if it is leased: it is then removed on its last release
+
+        """
+        entry = cls._cache[cache_key]
+        if entry.num_leases > 0:
+            if not entry.is_evicted:
+                entry.is_evicted = True
+                Metrics.inc('rom.evictions_deferred')
+            # endif
+
+            return None
+        # endif
+
+        del cls._cache[cache_key]
+        Metrics.inc('rom.evictions')
+
+        return entry
+    # enddef
+
+    @classmethod
+    def _notify_evicted(cls, list__evicted: list[tuple[tuple[str, Optional[int]], Optional[RomEntry]]], reason: str):
+        if cls._eviction_listener:
+            for (key, node), entry in list__evicted:
+                if entry is not None:
+                    cls._eviction_listener(key, node, entry.size, reason)
+                # endif
+            # endfor
+        # endif
+    # enddef
+
+    @classmethod
+    def _evict_idle(cls, num_bytes: int, demand: dict[str, int]) -> list[tuple[tuple[str, Optional[int]], Optional[RomEntry]]]:
+        # under cls._lock
+        list__evicted = []  # type: list[tuple[tuple[str, Optional[int]], Optional[RomEntry]]]
+        for cache_key in cls._eviction_order(demand):
+            if num_bytes <= 0:
+                break
+            # endif
+
+            entry = cls._evict(cache_key)
+            num_bytes -= entry.size
+            list__evicted.append((cache_key, entry))
+        # endfor
+
+        return list__evicted
+    # enddef
+
+    @classmethod
+    def enforce_budget(cls, reason: str = 'budget') -> int:
+        """
+        Evict idle ROMs until the cache (builds included) fits in the budget. Leased ROMs count against the budget
+        but are never evicted, so the cache may stay over budget while they are in use.
+
+        Returns:
+            number of evicted ROMs
+
+        """
+        demand = cls._get_demand()
+        with cls._lock:
+            list__evicted = cls._evict_idle(num_bytes=cls._bytes_used() - cls.get_budget(), demand=demand)
+        # endwith
+        cls._notify_evicted(list__evicted, reason=reason)
+
+        return len(list__evicted)
+    # enddef
+
+    @classmethod
+    def shed(cls, num_bytes: int, reason: str) -> int:
+        """
+        Evict idle ROMs, cheapest to lose first, until `num_bytes` are freed, regardless of the budget.
+
+        Returns:
+            number of evicted ROMs
+
+        """
+        assert_type(num_bytes, int)
+        assert_type(reason, str)
+
+        demand = cls._get_demand()
+        with cls._lock:
+            list__evicted = cls._evict_idle(num_bytes=num_bytes, demand=demand)
+        # endwith
+        cls._notify_evicted(list__evicted, reason=reason)
+
+        return len(list__evicted)
+    # enddef
+
+    @classmethod
+    def evict_unneeded(cls, idle_seconds: float) -> int:
+        """
+        Evict the ROMs no job needs any more (e.g. of expired or solved challenges) that were idle for `idle_seconds`.
+
+        Returns:
+            number of evicted ROMs
+
+        """
+        assert_type(idle_seconds, float)
+
+        demand = cls._get_demand()
+        now = time.time()
+        with cls._lock:
+            list__evicted = [
+                (cache_key, cls._evict(cache_key))
+                for cache_key, entry in list(cls._cache.items())
+                if entry.num_leases == 0 and demand.get(cache_key[0], 0) == 0 and now - entry.last_used > idle_seconds
+                ]
+        # endwith
+        cls._notify_evicted(list__evicted, reason='unneeded')
+
+        return len(list__evicted)
+    # enddef
 
     @classmethod
     def get_rom(cls, key: str) -> PyRom:
+        """
+        The ROM without a lease: it may be evicted while the caller still uses it. Workers use `lease`.
+
+        """
+        assert_type(key, str)
+
+        with cls.lease(key) as lease:
+            return lease.rom
+        # endwith
+    # enddef
+
+    @classmethod
+    def lease(cls, key: str) -> RomLease:
+        """
+        Cache hits return at once. On a miss, the first caller builds the ROM in its own thread (so that the ROM is
+        first-touched on its node) while later callers of the same key wait for that build instead of starting another.
+        Builds of different keys run in parallel, up to `MAX_CONCURRENT_BUILDS`.
+
+        """
         assert_type(key, str)
 
+        cache_key = (key, current_node())
+        while True:
+            with cls._lock:
+                entry = cls._cache.get(cache_key)
+                if entry is not None:
+                    entry.num_leases += 1
+                    entry.last_used = time.time()
+
+                    return RomLease(cache_key=cache_key, entry=entry)
+                # endif
+
+                future = cls._builds.get(cache_key)
+                is_builder = future is None
+                if is_builder:
+                    future = Future()
+                    cls._builds[cache_key] = future
+                # endif
+            # endwith
+
+            if is_builder:
+                break
+            # endif
+
+            # take the lease from the cache, in the unlikely case it was evicted in between it is built again
+            future.result()
+        # endwhile
+
+        try:
+            # make room at insert time; the build in flight already counts against the budget
+            cls.enforce_budget(reason=f'room for {key[:8]}...')
+
+            with cls._build_semaphore:
+                time_start = time.time()
+                rom = cls.get_ashmaize().build_rom_twostep(key=key,
+                                                           size=cls.ROM_SIZE,
+                                                           pre_size=16_777_216,
+                                                           mixing_numbers=4,
+                                                           )
+                build_seconds = time.time() - time_start
+            # endwith
+        except BaseException as e:
+            with cls._lock:
+                del cls._builds[cache_key]
+            # endwith
+            future.set_exception(e)
+
+            raise
+        # endtry
+
+        entry = RomEntry(rom=rom,
+                         size=getattr(rom, 'nbytes', cls.ROM_SIZE),
+                         build_seconds=build_seconds,
+                         last_used=time.time(),
+                         num_leases=1,
+                         )
         with cls._lock:
-            rom = cls._cache.get(key)
-            if rom is None:
-                rom = ashmaize_py.build_rom_twostep(key=key,
-                                                    size=cls.ROM_SIZE,
-                                                    pre_size=16_777_216,
-                                                    mixing_numbers=4,
-                                                    )
-                cls._cache[key] = rom
+            cls._cache[cache_key] = entry
+            del cls._builds[cache_key]
+        # endwith
+        future.set_result(rom)
+
+        return RomLease(cache_key=cache_key, entry=entry)
+    # enddef
+
+    @classmethod
+    def prefetch(cls, key: str, placement: Optional[tuple[int, list[int]]],
+                 on_done: Callable[[str, Optional[int], float, Optional[Exception]], None]) -> PrefetchResult:
+        """
+        Build the ROM of `key` in a background thread, so that the first worker finds it ready.
+
+        Args:
+            placement: (node, cpus) the build thread is pinned to, so that the ROM is first-touched on that node;
+                       None builds on any CPU
+            on_done: called with (key, node, seconds until ready, error) when the build ends
+
+        """
+        assert_type(key, str)
+        assert_type(placement, tuple, allow_none=True)
+
+        node = placement[0] if placement else None
+        demand = cls._get_demand()
+        with cls._lock:
+            if (key, node) in cls._cache or (key, node) in cls._builds:
+                return PrefetchResult.Cached
             # endif
+            num_building = len(cls._builds)
+
+            # a prefetch may only push out ROMs that no job needs
+            reclaimable = sum(entry.size for (k, n), entry in cls._cache.items() if entry.num_leases == 0 and demand.get(k, 0) == 0)
+            is_over_budget = cls._bytes_used() + cls.ROM_SIZE - reclaimable > cls.get_budget()
         # endwith
 
-        return rom
+        if is_over_budget or psutil.virtual_memory().available < cls.ROM_SIZE * (1 + num_building) + cls.PREFETCH_HEADROOM:
+            return PrefetchResult.Over_Budget
+        # endif
+
+        def run():
+            if placement:
+                pin_current_thread(cpus=placement[1], node=node)
+            # endif
+
+            time_start = time.time()
+            try:
+                cls.get_rom(key)
+            except Exception as e:
+                on_done(key, node, time.time() - time_start, e)
+
+                return
+            # endtry
+            on_done(key, node, time.time() - time_start, None)
+        # enddef
+
+        threading.Thread(target=run, daemon=True, name=f'rom_prefetch_{key[:8]}').start()
+
+        return PrefetchResult.Started
     # enddef
 
     @classmethod
-    def clear_all(cls):
+    def building(cls) -> tuple[str]:
+        """
+        Keys whose ROM is being built, or waiting for a build slot.
+
+        """
         with cls._lock:
-            cls._cache.clear()
+            return tuple({key: None for key, node in cls._builds.keys()}.keys())
         # endwith
     # enddef
 
+    @classmethod
+    def clear_all(cls):
+        cls.drop(*cls.keys())
+    # enddef
+
     @classmethod
     def drop(cls, *keys: tuple[str]):
+        """
+        Evict every copy of `keys`; the leased ones are removed when their last lease is released.
+
+        """
         assert_type(keys, tuple, str)
 
         with cls._lock:
-            for key in keys:
-                cls._cache.pop(key, None)
-            # endfor
+            list__evicted = [
+                (cache_key, cls._evict(cache_key))
+                for cache_key in [cache_key for cache_key in cls._cache.keys() if cache_key[0] in keys]
+                ]
         # endwith
+        cls._notify_evicted(list__evicted, reason='dropped')
     # enddef
 
     @classmethod
     def keys(cls) -> tuple[str]:
         with cls._lock:
-            return tuple(cls._cache.keys())
+            return tuple({key: None for key, node in cls._cache.keys()}.keys())
         # endwith
     # enddef
 
     @classmethod
-    def status(cls) -> dict[str, int]:
+    def status(cls) -> dict[tuple[str, Optional[int]], RomStatus]:
+        """
+        Every resident ROM, including the evicted ones still leased.
+
+        """
         with cls._lock:
-            return {key: cls.ROM_SIZE for key, rom in cls._cache.items()}
+            return {
+                cache_key: RomStatus(size=entry.size, num_leases=entry.num_leases, is_evicted=entry.is_evicted, last_used=entry.last_used)
+                for cache_key, entry in cls._cache.items()
+                }
         # endwith
     # enddef
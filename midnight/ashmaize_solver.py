@@ -1,4 +1,3 @@
-import secrets
 import threading
 import time
 from collections import defaultdict
@@ -7,11 +6,16 @@ from typing import Callable, Optional
 
 import numpy as np
 
+from cpu_topology import current_node
 from logger import LogType, Logger, measure_time
+from metrics import Metrics
 from midnight.ashmaize import PyRom
 from midnight.ashmaize_rom_manager import AshMaizeROMManager
+from midnight.batch_size_controller import BatchSizeController
 from midnight.challenge import Challenge
+from midnight.nonce_cursor import NonceCursor
 from midnight.solution import Solution
+from midnight.tracker import Tracker
 from utils import assert_type
 
 
@@ -22,27 +26,102 @@ class JobStats:
     hashrate: float
     started_at: float
     updated_at: float
+    cursor: NonceCursor
+    checkpointed_at: float
+    node: Optional[int] = None  # NUMA node of the compute slot
+
+
+@dataclass
+class PhaseStats:
+    """
+    Rolling (EWMA) time per batch of each phase, in seconds.
+
+    prep   : nonce + preimage generation (Python)
+    hash   : native hash_batch (GIL released)
+    screen : difficulty check (NumPy)
+    wall   : whole batch
+    cpu    : CPU time of the hashing thread; wall - cpu is time spent waiting for the GIL or a CPU
+
+    """
+    prep: float = 0.0
+    hash: float = 0.0
+    screen: float = 0.0
+    wall: float = 0.0
+    cpu: float = 0.0
+    num_batches: int = 0
+
+    EWMA_ALPHA = 0.2
+
+    def observe(self, prep: float, hash: float, screen: float, wall: float, cpu: float):
+        if self.num_batches == 0:
+            self.prep, self.hash, self.screen, self.wall, self.cpu = prep, hash, screen, wall, cpu
+        else:
+            a = self.EWMA_ALPHA
+            self.prep = (1 - a) * self.prep + a * prep
+            self.hash = (1 - a) * self.hash + a * hash
+            self.screen = (1 - a) * self.screen + a * screen
+            self.wall = (1 - a) * self.wall + a * wall
+            self.cpu = (1 - a) * self.cpu + a * cpu
+        # endif
+        self.num_batches += 1
+    # enddef
+
+    @property
+    def python_share(self) -> float:
+        """
+        Share of the wall time spent outside the native hash.
+
+        """
+        return 1.0 - self.hash / self.wall if self.wall > 0 else 0.0
+    # enddef
+
+    @property
+    def wait_share(self) -> float:
+        """
+        Share of the wall time the thread did not run: GIL contention or an oversubscribed CPU.
+
+        """
+        return max(0.0, 1.0 - self.cpu / self.wall) if self.wall > 0 else 0.0
+    # enddef
+
+    def __str__(self) -> str:
+        if self.num_batches == 0 or self.wall <= 0:
+            return 'N/A'
+        # endif
+
+        return ' | '.join([f'prep {self.prep / self.wall:4.0%}',
+                           f'hash {self.hash / self.wall:4.0%}',
+                           f'screen {self.screen / self.wall:4.0%}',
+                           f'off-CPU {self.wait_share:4.0%}',
+                           ])
+    # enddef
 
 
 @dataclass
 class WorkerProfile:
     job_stats: Optional[JobStats] = None
-    best_batch_size: Optional[int] = None
-    batch_size_search: dict[int, list[float]] = field(default_factory=lambda: defaultdict(list))
+    batch_size: Optional[int] = None
+    phase_stats: PhaseStats = field(default_factory=PhaseStats)  # kept across jobs
 
     def clear(self):
         self.job_stats = None
-        self.best_batch_size = None
-        self.batch_size_search.clear()
+        self.batch_size = None
     # enddef
 
 
 class AshMaizeSolver:
-    RANDOM_BUFFER_SIZE = 1_048_576
+    NONCE_BYTES = 8
+    NONCE_HEX_LEN = 2 * NONCE_BYTES
+    CHECKPOINT_INTERVAL = 60.0  # sec
+
+    def __init__(self, worker_nicknames: dict[str, str], logger: Logger, tracker: Tracker, batch_size: Optional[int] = None):
+        assert_type(tracker, Tracker)
+        assert_type(batch_size, int, allow_none=True)
 
-    def __init__(self, worker_nicknames: dict[str, str], logger: Logger):
         self.worker_nicknames = worker_nicknames
         self.logger = logger
+        self.tracker = tracker
+        self.batch_size_controller = BatchSizeController(logger=logger, batch_size=batch_size)
 
         # -------------------------
         # event handling
@@ -51,10 +130,13 @@ class AshMaizeSolver:
         self.wp_by_address = defaultdict(WorkerProfile)  # type: dict[str, WorkerProfile]
 
         # -------------------------
-        # generate nonces
+        # preemption: yield the current job once
+        # -------------------------
+        self.preempt_event_by_address = {address: threading.Event() for address in worker_nicknames.keys()}  # type: dict[str, threading.Event]
+
+        # -------------------------
+        # generate preimages
         # -------------------------
-        self.rb_by_address = {address: [bytearray(self.RANDOM_BUFFER_SIZE)] for address in worker_nicknames.keys()}  # type: dict[str, list[bytearray]]
-        self.rbpos_by_address = {address: [len(self.rb_by_address[address][0])] for address in worker_nicknames.keys()}  # type: dict[str, list[int]]
         self.preimage_base_cache = dict()
     # enddef
 
@@ -75,6 +157,28 @@ class AshMaizeSolver:
         return not self._stop_event.is_set()
     # enddef
 
+    # -------------------------
+    # preemption
+    # -------------------------
+    def preempt(self, address: str):
+        """
+        Ask the current job of `address` to yield at the next batch boundary, e.g. for a more urgent challenge.
+        The progress is checkpointed, so the job resumes where it stopped when it is picked up again.
+
+        """
+        assert_type(address, str)
+
+        if self.wp_by_address[address].job_stats is not None:
+            self.preempt_event_by_address[address].set()
+        # endif
+    # enddef
+
+    def should_yield(self, address: str) -> bool:
+        assert_type(address, str)
+
+        return self.preempt_event_by_address[address].is_set()
+    # enddef
+
     # -------------------------
     # solve
     # -------------------------
@@ -83,106 +187,161 @@ class AshMaizeSolver:
         assert_type(address, str)
         assert_type(challenge, Challenge)
 
-        nickname = f'[{self.worker_nicknames[address]}]'
         worker_profile = self.wp_by_address[address]
+        worker_profile.job_stats = self.start_job(address=address, challenge=challenge)
+
+        solution = None
+        try:
+            with AshMaizeROMManager.lease(challenge.no_pre_mine) as lease:
+                solution = self.search(address=address, worker_profile=worker_profile, rom=lease.rom)
+            # endwith
+
+            return solution
+        finally:
+            self.finish_job(address=address, worker_profile=worker_profile, solution=solution)
+        # endtry
+    # enddef
+
+    @measure_time
+    def start_job(self, address: str, challenge: Challenge) -> JobStats:
+        """
+        Resume the nonce cursor and tries of (address, challenge) from the last checkpoint, or start a fresh cursor.
+
+        """
+        assert_type(address, str)
+        assert_type(challenge, Challenge)
+
+        self.preempt_event_by_address[address].clear()
+
         now = time.time()
-        worker_profile.job_stats = JobStats(challenge=challenge, tries=0, hashrate=None, started_at=now, updated_at=now)
+        progress = self.tracker.get_progress(address=address, challenge=challenge)
+        if progress:
+            cursor, tries = progress
+
+            nickname = f'[{self.worker_nicknames[address]}]'
+            self.logger.log('\n'.join([
+                f'=== {nickname} Resume Challenge ===',
+                f'address   : {address}',
+                f'challenge : {challenge.challenge_id}',
+                f'tries     : {tries:,}',
+                ]), log_type=LogType.Start_New_Challenge, suffix=nickname, stdout=False)
+        else:
+            cursor, tries = NonceCursor.new(), 0
+        # endif
+
+        return JobStats(challenge=challenge, tries=tries, hashrate=None, started_at=now, updated_at=now,
+                        cursor=cursor, checkpointed_at=now, node=current_node())
+    # enddef
+
+    @measure_time
+    def finish_job(self, address: str, worker_profile: WorkerProfile, solution: Optional[Solution]):
+        assert_type(address, str)
+        assert_type(worker_profile, WorkerProfile)
+        assert_type(solution, Solution, allow_none=True)
+
+        if solution is None:
+            self.save_checkpoint(address=address, worker_profile=worker_profile, force=True)
+
+            job_stats = worker_profile.job_stats
+            if self.is_running() and self.should_yield(address) and job_stats is not None:
+                nickname = f'[{self.worker_nicknames[address]}]'
+                self.logger.log('\n'.join([
+                    f'=== {nickname} Preempted ===',
+                    f'address   : {address}',
+                    f'challenge : {job_stats.challenge.challenge_id}',
+                    f'tries     : {job_stats.tries:,} (saved)',
+                    ]), log_type=LogType.Preempted, suffix=nickname, stdout=False)
+            # endif
+        # endif
+
+        self.preempt_event_by_address[address].clear()
+        worker_profile.clear()
+    # enddef
+
+    def search(self, address: str, worker_profile: WorkerProfile, rom: PyRom) -> Optional[Solution]:
+        assert_type(address, str)
+        assert_type(worker_profile, WorkerProfile)
+
+        job_stats = worker_profile.job_stats
+        challenge = job_stats.challenge
 
         # -------------------------
         # pre compute:
-        # ROM, preimage_base, difficuly_value
+        # preimage_base, difficuly_value
         # -------------------------
-        key_cache = (address, challenge.challenge_id)
-        preimage_base = self.preimage_base_cache.get(key_cache)
-        if preimage_base is None:
-            preimage_base = (
-                    address
-                    + challenge.challenge_id
-                    + challenge.difficulty
-                    + challenge.no_pre_mine
-                    + challenge.latest_submission
-                    + challenge.no_pre_mine_hour
-            )
-            self.preimage_base_cache[key_cache] = preimage_base
-        # endif
-        rom = AshMaizeROMManager.get_rom(challenge.no_pre_mine)
-        get_fast_nonce = lambda: self.get_fast_nonce(random_buffer=self.rb_by_address[address],
-                                                     random_buffer_pos=self.rbpos_by_address[address])
+        preimage_base = self.get_preimage_base(address=address, challenge=challenge)
+        get_nonce_batch = job_stats.cursor.next_batch_hex
         difficulty_value = int(challenge.difficulty[:8], 16)
         difficulty_mask = ~difficulty_value & 0xffffffff
 
         # -------------------------
         # try to find a solution
         # -------------------------
-        try:
-            list__batch_size = [100, 1_000, 10_000, 100_000]
-
-            # -------------------------
-            # search for the best batch-size
-            # -------------------------
-            for _ in range(3):
-                for batch_size in list__batch_size:
-                    if not challenge.is_valid():
-                        break
-                    # endif
-
-                    solution = self.try_once_with_batch(worker_profile=worker_profile, preimage_base=preimage_base, get_fast_nonce=get_fast_nonce,
-                                                        rom=rom, difficulty_mask=difficulty_mask, batch_size=batch_size,
-                                                        is_search=True)
-
-                    if solution:
-                        return solution
-                    # endif
-                # endfor
-            # endtry
-
-            # -------------------------
-            # choose the best batch-size
-            # -------------------------
-            ms_by_bs = {bs: (np.mean(scores), np.std(scores)) for bs, scores in worker_profile.batch_size_search.items() if scores}
-            best_bs = max(ms_by_bs, key=lambda bs: ms_by_bs[bs][0] - ms_by_bs[bs][1], default=None)
-            worker_profile.best_batch_size = best_bs
-
-            msg = [
-                f'=== {nickname} Batch-size Search ===',
-                f'address   : {address}',
-                f'challenge : {challenge.challenge_id}',
-                f'(bs | hr) : {", ".join([f"({bs:,} | {ms[0]:,.0f}+/-{ms[1]:,.0f} H/s)" for bs, ms in ms_by_bs.items()])}',
-                f'-> best batch-size = {best_bs:,} (~{ms_by_bs[best_bs][0] - ms_by_bs[best_bs][1]:,.0f} H/s) through {worker_profile.job_stats.tries:,} tries.'
-                ]
-            self.logger.log('\n'.join(msg), log_type=LogType.Batch_Size_Search, suffix=nickname)
-
-            # -------------------------
-            # find a solution
-            # -------------------------
-            while self.is_running():
-                if not challenge.is_valid():
-                    break
-                # endif
-
-                solution = self.try_once_with_batch(worker_profile=worker_profile, preimage_base=preimage_base, get_fast_nonce=get_fast_nonce,
-                                                    rom=rom, difficulty_mask=difficulty_mask, batch_size=best_bs,
-                                                    is_search=False)
-
-                if solution:
-                    return solution
-                # endif
-            # endwhile
+        while self.is_running():
+            if not challenge.is_valid():
+                break
+            # endif
 
-            return None
-        finally:
-            worker_profile.clear()
-        # endtry
+            if self.should_yield(address):
+                break
+            # endif
+
+            batch_size = self.batch_size_controller.suggest(difficulty_mask=difficulty_mask)
+            worker_profile.batch_size = batch_size
+
+            solution = self.try_once_with_batch(worker_profile=worker_profile, preimage_base=preimage_base, get_nonce_batch=get_nonce_batch,
+                                                rom=rom, difficulty_mask=difficulty_mask, batch_size=batch_size)
+            self.report_progress(address=address, worker_profile=worker_profile)
+
+            if solution:
+                return solution
+            # endif
+        # endwhile
+
+        return None
+    # enddef
+
+    # -------------------------
+    # progress
+    # -------------------------
+    def report_progress(self, address: str, worker_profile: WorkerProfile):
+        """
+        Called after every batch. Subclasses that run the search elsewhere forward the progress to the owner of `wp_by_address`.
+
+        """
+        self.save_checkpoint(address=address, worker_profile=worker_profile, force=False)
+    # enddef
+
+    def save_checkpoint(self, address: str, worker_profile: WorkerProfile, force: bool):
+        assert_type(address, str)
+        assert_type(worker_profile, WorkerProfile)
+        assert_type(force, bool)
+
+        job_stats = worker_profile.job_stats
+        if job_stats is None:
+            return
+        # endif
+
+        now = time.time()
+        if not force and now - job_stats.checkpointed_at < self.CHECKPOINT_INTERVAL:
+            return
+        # endif
+
+        self.tracker.save_progress(address=address, challenge=job_stats.challenge, cursor=job_stats.cursor, tries=job_stats.tries)
+        job_stats.checkpointed_at = now
+    # enddef
+
+    def observe_batch(self, batch_size: int, hashrate: float):
+        self.batch_size_controller.observe(batch_size=batch_size, hashrate=hashrate)
     # enddef
 
     @measure_time
-    def try_once_with_batch(self, worker_profile: WorkerProfile, preimage_base: str, get_fast_nonce: Callable[[], int],
-                            rom: PyRom, difficulty_mask: int, batch_size: int, is_search: bool) -> Optional[Solution]:
+    def try_once_with_batch(self, worker_profile: WorkerProfile, preimage_base: str, get_nonce_batch: Callable[[int], str],
+                            rom: PyRom, difficulty_mask: int, batch_size: int) -> Optional[Solution]:
         assert_type(worker_profile, WorkerProfile)
         assert_type(preimage_base, str)
         assert_type(difficulty_mask, int)
         assert_type(batch_size, int)
-        assert_type(is_search, bool)
 
         # -------------------------
         # prep
@@ -194,18 +353,33 @@ class AshMaizeSolver:
         # -------------------------
         time_start = time.time()
 
-        preimages = [('%016x' % get_fast_nonce()) + preimage_base for _ in range(batch_size)]
+        cpu_start = time.thread_time_ns()
+        t0 = time.perf_counter_ns()
+        preimages = self.build_preimages(nonce_batch_hex=get_nonce_batch(batch_size), preimage_base=preimage_base)
+        t1 = time.perf_counter_ns()
         list__hash_hex = rom.hash_batch(preimages)
-        for idx_hash_hex, hash_hex in enumerate(list__hash_hex):
-            if (int(hash_hex[:8], 16) & difficulty_mask) == 0:
-                nonce_hex = preimages[idx_hash_hex][:16]
-
-                job_stats.tries += (idx_hash_hex + 1)
-                job_stats.updated_at = time.time()
-
-                return Solution(nonce_hex=nonce_hex, hash_hex=hash_hex, tries=job_stats.tries)
-            # endif
-        # endfor
+        t2 = time.perf_counter_ns()
+        idx_hit = self.screen_hashes(list__hash_hex=list__hash_hex, difficulty_mask=difficulty_mask)
+        t3 = time.perf_counter_ns()
+        cpu_end = time.thread_time_ns()
+
+        Metrics.observe_ns('solver.build_preimages', t1 - t0)
+        Metrics.observe_ns('solver.hash_batch', t2 - t1)
+        Metrics.observe_ns('solver.screen_hashes', t3 - t2)
+        Metrics.inc('solver.hashes', batch_size)
+        worker_profile.phase_stats.observe(prep=(t1 - t0) * 1e-9, hash=(t2 - t1) * 1e-9, screen=(t3 - t2) * 1e-9,
+                                           wall=(t3 - t0) * 1e-9, cpu=(cpu_end - cpu_start) * 1e-9)
+
+        if idx_hit is not None:
+            nonce_hex = preimages[idx_hit][:self.NONCE_HEX_LEN]
+            hash_hex = list__hash_hex[idx_hit]
+
+            # count only up to (and including) the first hit
+            job_stats.tries += (idx_hit + 1)
+            job_stats.updated_at = time.time()
+
+            return Solution(nonce_hex=nonce_hex, hash_hex=hash_hex, tries=job_stats.tries)
+        # endif
 
         time_end = time.time()
         time_elapse = time_end - time_start
@@ -214,9 +388,7 @@ class AshMaizeSolver:
         # save the data
         # -------------------------
         hashrate = batch_size / time_elapse
-        if is_search:
-            worker_profile.batch_size_search[batch_size].append(hashrate)
-        # endif
+        self.observe_batch(batch_size=batch_size, hashrate=hashrate)
         job_stats.hashrate = hashrate
         job_stats.tries += batch_size
         job_stats.updated_at = time_end
@@ -224,14 +396,63 @@ class AshMaizeSolver:
         return None
     # enddef
 
-    def get_fast_nonce(self, random_buffer: list[bytearray], random_buffer_pos: list[int]) -> int:
-        if random_buffer_pos[0] >= len(random_buffer[0]):
-            random_buffer[0] = bytearray(secrets.token_bytes(self.RANDOM_BUFFER_SIZE))
-            random_buffer_pos[0] = 0
+    # -------------------------
+    # preimage
+    # -------------------------
+    def get_preimage_base(self, address: str, challenge: Challenge) -> str:
+        assert_type(address, str)
+        assert_type(challenge, Challenge)
+
+        key_cache = (address, challenge.challenge_id)
+        preimage_base = self.preimage_base_cache.get(key_cache)
+        if preimage_base is None:
+            preimage_base = (
+                    address
+                    + challenge.challenge_id
+                    + challenge.difficulty
+                    + challenge.no_pre_mine
+                    + challenge.latest_submission
+                    + challenge.no_pre_mine_hour
+            )
+            self.preimage_base_cache[key_cache] = preimage_base
+        # endif
+
+        return preimage_base
+    # enddef
+
+    def build_preimages(self, nonce_batch_hex: str, preimage_base: str) -> list[str]:
+        """
+        Split the concatenated hex nonces into 16-char chunks and prepend each to `preimage_base`.
+        Same result as `'%016x' % nonce + preimage_base`, without per-nonce int formatting.
+
+        """
+        assert_type(nonce_batch_hex, str)
+        assert_type(preimage_base, str)
+
+        n = self.NONCE_HEX_LEN
+
+        return [nonce_batch_hex[i:i + n] + preimage_base for i in range(0, len(nonce_batch_hex), n)]
+    # enddef
+
+    @staticmethod
+    def screen_hashes(list__hash_hex: list[str], difficulty_mask: int) -> Optional[int]:
+        """
+        Check a whole batch against the difficulty at once.
+        The 8-char prefixes are joined, decoded into a big-endian uint32 array and masked in one operation.
+
+        Returns:
+            index of the first hash that meets the difficulty, or None
+
+        """
+        assert_type(list__hash_hex, list, str)
+        assert_type(difficulty_mask, int)
+
+        if not list__hash_hex:
+            return None
         # endif
 
-        nonce_bytes = random_buffer[0][random_buffer_pos[0]:random_buffer_pos[0] + 8]
-        random_buffer_pos[0] += 8
+        prefixes = np.frombuffer(bytes.fromhex(''.join([hash_hex[:8] for hash_hex in list__hash_hex])), dtype='>u4')
+        hits = np.flatnonzero((prefixes & np.uint32(difficulty_mask)) == 0)
 
-        return int.from_bytes(nonce_bytes, 'big')
+        return int(hits[0]) if hits.size else None
     # enddef
@@ -0,0 +1,170 @@
+import copy
+import threading
+from typing import Optional
+
+from logger import LogType, Logger
+from utils import assert_type
+
+
+class BatchSizeController:
+    """
+    Online hill-climb over a ladder of batch sizes, shared by every worker of this host.
+
+    Each finished batch reports its hashrate; an EWMA is kept per batch size.
+    After `SAMPLES_PER_STEP` batches at the current size, the neighbour in the current direction is probed
+    for `PROBE_SAMPLES` batches. The controller moves there if it is faster, otherwise it turns around.
+    Because the probing never stops, the batch size follows the machine when it gets busier or idler.
+
+    """
+    LADDER = (100, 200, 500, 1_000, 2_000, 5_000, 10_000, 20_000, 50_000, 100_000)
+    DEFAULT_BATCH_SIZE = 10_000
+    EWMA_ALPHA = 0.2
+    SAMPLES_PER_STEP = 12
+    PROBE_SAMPLES = 4
+    MIN_GAIN = 0.02  # move only if the probe is faster by 2% or more
+
+    def __init__(self, logger: Logger, batch_size: Optional[int] = None):
+        assert_type(batch_size, int, allow_none=True)
+
+        self.logger = logger
+
+        self._lock = threading.Lock()
+        self._idx = self._nearest_idx(batch_size or self.DEFAULT_BATCH_SIZE)
+        self._direction = +1
+        self._probe_idx = None  # type: Optional[int]
+        self._num_samples = 0
+        self.hashrate_by_bs = dict()  # type: dict[int, float]
+    # enddef
+
+    def detached(self) -> 'BatchSizeController':
+        """
+        A copy of the current state with its own lock, for a forked child: the parent's lock may have been held by
+        another thread at the time of the fork, and would then stay locked in the child forever.
+
+        """
+        controller = copy.copy(self)
+        controller._lock = threading.Lock()
+        controller.hashrate_by_bs = dict(self.hashrate_by_bs)
+
+        return controller
+    # enddef
+
+    @classmethod
+    def _nearest_idx(cls, batch_size: int) -> int:
+        return min(range(len(cls.LADDER)), key=lambda idx: abs(cls.LADDER[idx] - batch_size))
+    # enddef
+
+    # -------------------------
+    # state
+    # -------------------------
+    @property
+    def batch_size(self) -> int:
+        """
+        The batch size the controller currently considers the best.
+
+        """
+        return self.LADDER[self._idx]
+    # enddef
+
+    @property
+    def hashrate(self) -> Optional[float]:
+        return self.hashrate_by_bs.get(self.batch_size)
+    # enddef
+
+    # -------------------------
+    # suggest / observe
+    # -------------------------
+    @staticmethod
+    def expected_tries(difficulty_mask: int) -> int:
+        """
+        Each masked bit must be zero, so a hash meets the difficulty with probability 2^-popcount(mask).
+
+        """
+        assert_type(difficulty_mask, int)
+
+        return 1 << bin(difficulty_mask & 0xffffffff).count('1')
+    # enddef
+
+    def suggest(self, difficulty_mask: int) -> int:
+        """
+        Batch size for the next batch. On easy difficulties the batch is capped at about half the expected tries,
+        so that a hit early in the batch does not waste the rest of it.
+
+        """
+        assert_type(difficulty_mask, int)
+
+        with self._lock:
+            idx = self._idx if self._probe_idx is None else self._probe_idx
+        # endwith
+
+        return min(self.LADDER[idx], self.cap(difficulty_mask))
+    # enddef
+
+    @classmethod
+    def cap(cls, difficulty_mask: int) -> int:
+        assert_type(difficulty_mask, int)
+
+        return max(cls.LADDER[0], cls.expected_tries(difficulty_mask) // 2)
+    # enddef
+
+    def observe(self, batch_size: int, hashrate: float):
+        assert_type(batch_size, int)
+        assert_type(hashrate, float)
+
+        if batch_size not in self.LADDER:
+            return  # a capped batch decides nothing, and would only fill the table
+        # endif
+
+        with self._lock:
+            prev = self.hashrate_by_bs.get(batch_size)
+            self.hashrate_by_bs[batch_size] = hashrate if prev is None else (1 - self.EWMA_ALPHA) * prev + self.EWMA_ALPHA * hashrate
+
+            if self._probe_idx is None:
+                if batch_size != self.LADDER[self._idx]:
+                    return
+                # endif
+
+                self._num_samples += 1
+                if self._num_samples >= self.SAMPLES_PER_STEP:
+                    probe_idx = self._idx + self._direction
+                    if not (0 <= probe_idx < len(self.LADDER)):
+                        self._direction = -self._direction
+                        probe_idx = self._idx + self._direction
+                    # endif
+                    self._probe_idx = probe_idx
+                    self._num_samples = 0
+                # endif
+            else:
+                if batch_size != self.LADDER[self._probe_idx]:
+                    return
+                # endif
+
+                self._num_samples += 1
+                if self._num_samples >= self.PROBE_SAMPLES:
+                    self._finish_probe()
+                # endif
+            # endif
+        # endwith
+    # enddef
+
+    def _finish_probe(self):
+        bs_cur = self.LADDER[self._idx]
+        bs_probe = self.LADDER[self._probe_idx]
+        hr_cur = self.hashrate_by_bs.get(bs_cur, 0.0)
+        hr_probe = self.hashrate_by_bs.get(bs_probe, 0.0)
+
+        if hr_probe > hr_cur * (1 + self.MIN_GAIN):
+            self._idx = self._probe_idx
+
+            self.logger.log('\n'.join([
+                f'=== Batch-size Controller ===',
+                f'batch-size : {bs_cur:,} -> {bs_probe:,}',
+                f'hashrate   : {hr_cur:,.0f} -> {hr_probe:,.0f} H/s',
+                ]), log_type=LogType.Batch_Size_Search, stdout=False)
+        else:
+            self._direction = -self._direction
+        # endif
+
+        self._probe_idx = None
+        self._num_samples = 0
+    # enddef
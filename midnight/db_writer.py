@@ -0,0 +1,276 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Callable, Hashable, Optional
+
+from peewee import Database
+
+from logger import LogType, Logger
+from metrics import Metrics
+from utils import assert_type
+
+
+@dataclass
+class DBWrite:
+    write: Callable[[], Any]
+    coalesce_key: Optional[Hashable] = None
+    future: Optional[Future] = None  # set if the caller waits for the commit
+    enqueued_ns: int = field(default_factory=time.perf_counter_ns)
+
+
+@dataclass
+class DBWriterStats:
+    queue_depth: int
+    max_queue_depth: int
+    num_writes: int
+    num_commits: int
+    num_errors: int
+
+    def __str__(self) -> str:
+        return (f'queue {self.queue_depth:,} (max {self.max_queue_depth:,}) | '
+                f'{self.num_writes:,} writes in {self.num_commits:,} commits '
+                f'({self.num_writes / max(1, self.num_commits):,.1f} per commit) | errors {self.num_errors:,}')
+    # enddef
+
+
+class DBWriter:
+    """
+    The only thread that writes to the database. Writes are queued by the callers and committed in groups: a group
+    collects what arrives within `FLUSH_LATENCY` after its first write (at most `MAX_BATCH` writes), and is committed
+    in one transaction, so that many small writes share one fsync.
+
+    A write submitted with `wait=True` (or `flush`) closes its group at once and returns the result after the commit.
+    Queued writes with the same `coalesce_key` (e.g. the progress checkpoints of one job) are committed only once,
+    the last one winning.
+
+    """
+    FLUSH_LATENCY = 0.2  # sec
+    MAX_BATCH = 1_000
+
+    def __init__(self, db: Database, lock: threading.Lock, logger: Logger):
+        self.db = db
+        self.lock = lock
+        self.logger = logger
+
+        self._queue = queue.Queue()  # type: queue.Queue[Optional[DBWrite]]
+        self._close_lock = threading.Lock()
+        self._is_closed = False
+
+        self.max_queue_depth = 0
+        self.num_writes = 0
+        self.num_commits = 0
+        self.num_errors = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True, name='db_writer')
+        self._thread.start()
+    # enddef
+
+    # -------------------------
+    # callers
+    # -------------------------
+    def submit(self, write: Callable[[], Any], coalesce_key: Optional[Hashable] = None, wait: bool = False) -> Any:
+        """
+        Returns:
+            the result of `write` if `wait`, else None
+
+        """
+        assert_type(wait, bool)
+
+        item = DBWrite(write=write, coalesce_key=coalesce_key, future=Future() if wait else None)
+        with self._close_lock:
+            is_closed = self._is_closed
+            if not is_closed:
+                self._queue.put(item)
+            # endif
+        # endwith
+
+        if is_closed:
+            # late writes of threads still winding down: commit them in the caller
+            with self.lock:
+                with self.db.atomic():
+                    return write()
+                # endwith
+            # endwith
+        # endif
+
+        queue_depth = self._queue.qsize()
+        if queue_depth > self.max_queue_depth:
+            self.max_queue_depth = queue_depth
+        # endif
+
+        return item.future.result() if wait else None
+    # enddef
+
+    def flush(self):
+        """
+        Wait until every write queued so far is committed.
+
+        """
+        self.submit(lambda: None, wait=True)
+    # enddef
+
+    def close(self):
+        """
+        Commit what is queued and stop the writer thread.
+
+        """
+        with self._close_lock:
+            if self._is_closed:
+                return
+            # endif
+            self._is_closed = True
+            self._queue.put(None)
+        # endwith
+
+        self._thread.join()
+    # enddef
+
+    def stats(self) -> DBWriterStats:
+        return DBWriterStats(queue_depth=self._queue.qsize(),
+                             max_queue_depth=self.max_queue_depth,
+                             num_writes=self.num_writes,
+                             num_commits=self.num_commits,
+                             num_errors=self.num_errors,
+                             )
+    # enddef
+
+    # -------------------------
+    # writer thread
+    # -------------------------
+    def _run(self):
+        batch = []  # type: list[DBWrite]
+        try:
+            is_stopping = False
+            while not is_stopping:
+                item = self._queue.get()
+                if item is None:
+                    break
+                # endif
+
+                batch = [item]
+                time_flush = time.monotonic() + self.FLUSH_LATENCY
+                while item.future is None and len(batch) < self.MAX_BATCH:
+                    try:
+                        item = self._queue.get(timeout=max(0.0, time_flush - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    # endtry
+
+                    if item is None:
+                        is_stopping = True
+                        break
+                    # endif
+                    batch.append(item)
+                # endwhile
+
+                self._commit(batch)
+                batch = []
+            # endwhile
+        finally:
+            self._abandon(batch)
+            self.db.close()  # the connection of this thread
+        # endtry
+    # enddef
+
+    def _abandon(self, batch: list[DBWrite]):
+        """
+        Fail every write still waiting, so that no caller blocks forever on a writer thread that is gone.
+        Later writes are committed in the callers, as after `close`.
+
+        """
+        with self._close_lock:
+            self._is_closed = True
+        # endwith
+
+        list__item = list(batch)
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            # endtry
+
+            if item is not None:
+                list__item.append(item)
+            # endif
+        # endwhile
+
+        for item in list__item:
+            if item.future is not None and not item.future.done():
+                item.future.set_exception(RuntimeError('DB writer stopped before the write was committed'))
+            # endif
+        # endfor
+    # enddef
+
+    def _commit(self, batch: list[DBWrite]):
+        # coalesce: the last write of each key, at the position of the first one
+        list__item = []  # type: list[DBWrite]
+        idx_by_key = dict()  # type: dict[Hashable, int]
+        for item in batch:
+            if item.coalesce_key is None:
+                list__item.append(item)
+            elif item.coalesce_key in idx_by_key:
+                list__item[idx_by_key[item.coalesce_key]] = item
+            else:
+                idx_by_key[item.coalesce_key] = len(list__item)
+                list__item.append(item)
+            # endif
+        # endfor
+
+        t0 = time.perf_counter_ns()
+        with self.lock:
+            try:
+                with self.db.atomic():
+                    results = [(item.write(), None) for item in list__item]
+                # endwith
+            except Exception:
+                # one bad write must not take the others down: retry each one in its own transaction
+                results = [self._commit_one(item) for item in list__item]
+            # endtry
+        # endwith
+        t1 = time.perf_counter_ns()
+
+        self.num_writes += len(batch)
+        self.num_commits += 1
+        Metrics.observe_ns('db.commit', t1 - t0)
+        Metrics.inc('db.writes', len(batch))
+        for item in batch:
+            Metrics.observe_ns('db.write_latency', t1 - item.enqueued_ns)
+        # endfor
+
+        result_by_item = {id(item): result for item, result in zip(list__item, results)}
+        for item in batch:
+            if item.future is None:
+                continue
+            # endif
+
+            result, error = result_by_item.get(id(item), (None, None))  # a coalesced write was superseded
+            if error is None:
+                item.future.set_result(result)
+            else:
+                item.future.set_exception(error)
+            # endif
+        # endfor
+    # enddef
+
+    def _commit_one(self, item: DBWrite) -> tuple[Any, Optional[Exception]]:
+        try:
+            with self.db.atomic():
+                return item.write(), None
+            # endwith
+        except Exception as e:
+            self.num_errors += 1
+            if item.future is None:
+                # nobody waits for this write: report it here
+                self.logger.log('\n'.join([
+                    f'=== DB Write Error ===',
+                    f'write : {getattr(item.write, "__qualname__", item.write)}',
+                    f'error : {e}',
+                    ]), log_type=LogType.DB_Write_Error)
+            # endif
+
+            return None, e
+        # endtry
+    # enddef
@@ -0,0 +1,213 @@
+import heapq
+import threading
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Optional
+
+from midnight.challenge import Challenge
+from utils import assert_type
+
+
+@dataclass(order=True)
+class Job:
+    priority: tuple
+    address: str = field(compare=False)
+    challenge: Challenge = field(compare=False)
+
+    @property
+    def key(self) -> tuple[str, str]:
+        return self.address, self.challenge.challenge_id
+    # enddef
+
+
+class JobQueue:
+    """
+    Central priority queue of (address, challenge) jobs for the compute pool.
+
+    `refill` replaces the pending jobs with a fresh ranking, `get` hands the best pending job to an idle compute slot,
+    and `done` releases it. A job that is in progress is never handed out twice, and an address never has two jobs
+    in progress at once, since the solver state is kept per address.
+    `set_capacity` limits the number of jobs in progress, e.g. to pause compute slots under memory pressure.
+    `close` hands out no more jobs and wakes every waiting slot, e.g. to stop the compute pool.
+
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._heap = []  # type: list[Job]
+        self._in_progress = dict()  # type: dict[tuple[str, str], Job]
+        self._num_waiting = 0
+        self._capacity = None  # type: Optional[int]
+        self._is_closed = False
+    # enddef
+
+    def __len__(self) -> int:
+        with self._cond:
+            return len(self._heap)
+        # endwith
+    # enddef
+
+    # -------------------------
+    # producer
+    # -------------------------
+    def refill(self, list__job: list[Job]):
+        assert_type(list__job, list, Job)
+
+        with self._cond:
+            self._heap = [job for job in list__job if job.key not in self._in_progress]
+            heapq.heapify(self._heap)
+            self._cond.notify_all()
+        # endwith
+    # enddef
+
+    def set_capacity(self, capacity: Optional[int]):
+        """
+        At most `capacity` jobs in progress; None for no limit. Running jobs are not stopped, but their slots
+        get no new job until the number in progress is below the capacity.
+
+        """
+        assert_type(capacity, int, allow_none=True)
+
+        with self._cond:
+            self._capacity = capacity
+            self._cond.notify_all()
+        # endwith
+    # enddef
+
+    def close(self):
+        with self._cond:
+            self._is_closed = True
+            self._cond.notify_all()
+        # endwith
+    # enddef
+
+    @property
+    def capacity(self) -> Optional[int]:
+        return self._capacity
+    # enddef
+
+    def _busy_addresses(self) -> set[str]:
+        return {job.address for job in self._in_progress.values()}
+    # enddef
+
+    def _is_full(self) -> bool:
+        return self._capacity is not None and len(self._in_progress) >= self._capacity
+    # enddef
+
+    def _pop_startable(self) -> Optional[Job]:
+        """
+        Pops the best pending job whose address has no job in progress. Jobs of busy addresses stay pending.
+
+        """
+        if self._is_closed or self._is_full():
+            return None
+        # endif
+
+        busy_addresses = self._busy_addresses()
+        list__skipped = []  # type: list[Job]
+        job_startable = None
+        while self._heap:
+            job = heapq.heappop(self._heap)
+            if job.key in self._in_progress:
+                continue
+            # endif
+
+            if job.address in busy_addresses:
+                list__skipped.append(job)
+            else:
+                job_startable = job
+                self._in_progress[job.key] = job
+                break
+            # endif
+        # endwhile
+
+        for job in list__skipped:
+            heapq.heappush(self._heap, job)
+        # endfor
+
+        return job_startable
+    # enddef
+
+    # -------------------------
+    # consumer
+    # -------------------------
+    def get(self, timeout: Optional[float] = None) -> Optional[Job]:
+        """
+        Returns:
+            the best pending job of an idle address, or None if nothing could start within `timeout`
+
+        """
+        assert_type(timeout, float, allow_none=True)
+
+        with self._cond:
+            self._num_waiting += 1
+            try:
+                job = self._pop_startable()
+                if job is None:
+                    self._cond.wait(timeout=timeout)
+                    job = self._pop_startable()
+                # endif
+
+                return job
+            finally:
+                self._num_waiting -= 1
+            # endtry
+        # endwith
+    # enddef
+
+    def done(self, job: Job):
+        assert_type(job, Job)
+
+        with self._cond:
+            self._in_progress.pop(job.key, None)
+            self._cond.notify_all()  # a job of the same address may be pending
+        # endwith
+    # enddef
+
+    # -------------------------
+    # status
+    # -------------------------
+    def num_in_progress(self) -> int:
+        with self._cond:
+            return len(self._in_progress)
+        # endwith
+    # enddef
+
+    def get_worst_in_progress(self) -> Optional[Job]:
+        with self._cond:
+            return max(self._in_progress.values(), default=None)
+        # endwith
+    # enddef
+
+    def demand_by_rom_key(self) -> dict[str, int]:
+        """
+        Returns:
+            number of pending and in-progress jobs per ROM key (challenge.no_pre_mine)
+
+        """
+        with self._cond:
+            list__job = self._heap + list(self._in_progress.values())
+        # endwith
+
+        return dict(Counter(job.challenge.no_pre_mine for job in list__job))
+    # enddef
+
+    def get_outranked(self) -> Optional[Job]:
+        """
+        Returns:
+            the worst job in progress if the best pending job outranks it and no compute slot is idle, else None
+
+        """
+        with self._cond:
+            if (self._num_waiting > 0 and not self._is_full()) or not self._heap or not self._in_progress:
+                return None
+            # endif
+
+            # the best pending job that could start once the worst one yields
+            worst = max(self._in_progress.values())
+            busy_addresses = self._busy_addresses() - {worst.address}
+            best = min((job for job in self._heap if job.address not in busy_addresses and job.key not in self._in_progress), default=None)
+
+            return worst if best is not None and best < worst else None
+        # endwith
+    # enddef
@@ -1,25 +1,53 @@
+import json
+import os
+import socket
 import sys
 import threading
 import time
+import traceback
+from collections import defaultdict
+from datetime import timedelta
 from typing import *
 
 from base_app import BaseApp
+from cpu_topology import CpuTopology, pin_current_thread
 from logger import LogType, Logger, measure_time
-from midnight.ashmaize_rom_manager import AshMaizeROMManager
+from memory_watchdog import MemorySample, MemoryWatchdog
+from metrics import Metrics
+from midnight.ashmaize_packed_solver import AshMaizePackedSolver
+from midnight.ashmaize_process_solver import AshMaizeProcessSolver
+from midnight.ashmaize_rom_manager import AshMaizeROMManager, PrefetchResult, RomStatus
 from midnight.ashmaize_solver import AshMaizeSolver
 from midnight.challenge import Challenge
+from midnight.job_queue import Job, JobQueue
+from midnight.scheduler import ChallengeScheduler
 from midnight.solution import Solution
+from midnight.solver_bench import SolverBench
 from midnight.tracker import SolutionStatus, Tracker
+from profiler import MemoryTracer, StackSampler
 from project import Project
 from system_metrics import SystemMetrics
 from utils import assert_type, async_run_func, print_with_time, safefstr, timestamp_to_str
 
 
 class MidnightApp(BaseApp):
+    PROFILE_SECONDS = 60.0
+    ROM_IDLE_SECONDS = 600.0  # unneeded ROMs are kept this long, in case their challenge comes back
+
+    # challenges are published at the top of the hour: poll faster around it
+    CHALLENGE_FETCH_INTERVAL = 60.0
+    CHALLENGE_FETCH_INTERVAL_AT_HOUR = 5.0
+    CHALLENGE_FETCH_WINDOW_AT_HOUR = (-10.0, 120.0)  # sec around the hour
+
+    # settled challenges are moved to the archive DB this long after their deadline
+    ARCHIVE_EXPIRED_FOR = timedelta(days=2)
+    COMPUTE_JOIN_TIMEOUT = 30.0  # sec for the compute slots to checkpoint and finish at shutdown
+
     def __init__(self, project: Project):
         self.project = project
         self.base_url = self.project.base_url
         self.logger = Logger(project=self.project)
+        self.hostname = socket.gethostname()
         self.tracker = Tracker(project=self.project, logger=self.logger)
 
         # workers
@@ -27,8 +55,20 @@ class MidnightApp(BaseApp):
         self.worker_nicknames = {address: f'Worker-#{idx_addr:02}' for idx_addr, address in enumerate(self.list__address)}
 
         # solver
-        self.solver = AshMaizeSolver(worker_nicknames=self.worker_nicknames, logger=self.logger)
-        self.worker_active_events = dict()  # type: dict[str, threading.Event]
+        self.solver = AshMaizeSolver(worker_nicknames=self.worker_nicknames, logger=self.logger, tracker=self.tracker)
+        self.job_queue = JobQueue()
+        self._refill_lock = threading.Lock()
+
+        # (node, cpus) of every NUMA node with a compute slot, or None without affinity
+        self.rom_placements = [None]  # type: list[Optional[tuple[int, list[int]]]]
+
+        # on-demand profiling
+        self.stack_sampler = StackSampler(log_dirname=self.logger.log_dirname)
+        self.memory_tracer = MemoryTracer(log_dirname=self.logger.log_dirname)
+
+        # memory pressure: sheds idle ROMs, then pauses compute slots
+        self.num_slots = 1
+        self.memory_watchdog = MemoryWatchdog(on_pressure=self.on_memory_pressure, on_calm=self.on_memory_calm)
     # enddef
 
     # -------------------------
@@ -200,36 +240,155 @@ class MidnightApp(BaseApp):
     # enddef
 
     @measure_time
-    def handle_mine(self, num_threads: Optional[int]):
+    def handle_bench(self, engines: list[str], list__num_threads: list[int], list__batch_size: list[int], seconds: float,
+                     rom_size: Optional[int] = None):
+        assert_type(engines, list, str)
+        assert_type(list__num_threads, list, int)
+        assert_type(list__batch_size, list, int)
+        assert_type(seconds, float)
+        assert_type(rom_size, int, allow_none=True)
+
+        if rom_size:
+            AshMaizeROMManager.ROM_SIZE = rom_size
+        # endif
+
+        # a fixed batch size per run; the controller still observes, but is never asked
+        bench = SolverBench(solver=AshMaizeSolver(worker_nicknames=dict(), logger=self.logger, tracker=self.tracker), seconds=seconds)
+        bench.build_rom()
+        print_with_time(f'ROM built: {AshMaizeROMManager.ROM_SIZE / (1024 ** 2):,.0f} MiB in {bench.rom_build_seconds:,.2f} sec')
+
+        list__result = []
+        for engine in engines:
+            for num_threads in list__num_threads:
+                for batch_size in list__batch_size:
+                    try:
+                        result = bench.run(engine=engine, num_threads=num_threads, batch_size=batch_size)
+                    except RuntimeError as e:
+                        # e.g. a bench process was killed; the other runs are still worth reporting
+                        print_with_time(f'{engine:7} | threads={num_threads:3} | batch_size={batch_size:7,} | failed: {e}')
+
+                        continue
+                    # endtry
+                    list__result.append(result)
+                    print_with_time(f'{engine:7} | threads={num_threads:3} | batch_size={batch_size:7,} | {result.hashrate:10,.0f} H/s')
+                # endfor
+            # endfor
+        # endfor
+
+        # -------------------------
+        # report: table + JSON
+        # -------------------------
+        msg = [
+            f'=== Bench ===',
+            f'host      : {self.hostname} ({os.cpu_count()} CPUs)',
+            f'backend   : {AshMaizeROMManager.get_backend().value}',
+            f'rom       : {AshMaizeROMManager.ROM_SIZE / (1024 ** 2):,.0f} MiB, built in {bench.rom_build_seconds:,.2f} sec',
+            f'duration  : {seconds:,.1f} sec per run',
+            f'',
+            f'{"engine":7} | {"threads":>7} | {"batch":>7} | {"H/s":>10} | {"p50 ms":>9} | {"p99 ms":>9} | {"py overhead":>11}',
+            f'-' * 80,
+            ]
+        for result in list__result:
+            msg.append(f'{result.engine:7} | {result.num_threads:7} | {result.batch_size:7,} | {result.hashrate:10,.0f} | '
+                       f'{result.latency_p50_ms:9,.1f} | {result.latency_p99_ms:9,.1f} | {result.python_overhead:11.1%}')
+        # endfor
+
+        bench_dict = bench.to_dict(list__result)
+        bench_dict['host']['hostname'] = self.hostname
+        filepath = os.path.join(self.logger.log_dirname, f'bench_{timestamp_to_str(time.time(), fmt="%Y%m%d_%H%M%S")}.json')
+        with open(filepath, 'wt') as f:
+            json.dump(bench_dict, f, indent=2)
+        # endwith
+        msg.append(f'')
+        msg.append(f'saved: {filepath}')
+
+        self.logger.log('\n'.join(msg), log_type=LogType.Bench)
+    # enddef
+
+    @measure_time
+    def handle_mine(self, num_threads: Optional[int], engine: str = 'thread', affinity: str = 'none', avoid_smt: bool = False,
+                    max_rom_builds: Optional[int] = None, rom_budget_gb: Optional[float] = None):
+        assert_type(num_threads, int, allow_none=True)
+        assert_type(engine, str)
+        assert_type(affinity, str)
+        assert_type(avoid_smt, bool)
+        assert_type(max_rom_builds, int, allow_none=True)
+        assert_type(rom_budget_gb, float, allow_none=True)
+
+        if max_rom_builds:
+            AshMaizeROMManager.set_max_concurrent_builds(max_rom_builds)
+        # endif
+        if rom_budget_gb:
+            AshMaizeROMManager.set_budget(int(rom_budget_gb * 1024 ** 3))
+        # endif
+        AshMaizeROMManager.set_demand_provider(self.job_queue.demand_by_rom_key)
+        AshMaizeROMManager.set_eviction_listener(self.on_rom_evicted)
+
+        list__compute_thread = []  # type: list[threading.Thread]
         try:
             # -------------------------
-            # prepare threads
+            # prepare solver
             # -------------------------
-            threads = [threading.Thread(target=self.input_loop, daemon=True)]
-            for address in self.list__address:
-                run_event = threading.Event()
-                if num_threads:
-                    run_event.clear()  # stop
-                else:
-                    run_event.set()  # run
-                # endif
-                self.worker_active_events[address] = run_event
+            batch_size = self.tracker.get_batch_size(hostname=self.hostname)
+            if engine == 'thread':
+                self.solver = AshMaizeSolver(worker_nicknames=self.worker_nicknames, logger=self.logger, tracker=self.tracker, batch_size=batch_size)
+            elif engine == 'process':
+                self.solver = AshMaizeProcessSolver(worker_nicknames=self.worker_nicknames, logger=self.logger, tracker=self.tracker, batch_size=batch_size)
+            elif engine == 'packed':
+                self.solver = AshMaizePackedSolver(worker_nicknames=self.worker_nicknames, logger=self.logger, tracker=self.tracker, batch_size=batch_size,
+                                                   num_lanes=num_threads)
+            else:
+                raise NotImplementedError(engine)
+            # endif
 
-                threads.append(threading.Thread(
-                    target=self.mine_loop,
-                    args=(address, num_threads),
+            # -------------------------
+            # prepare threads:
+            # a fixed-size compute pool, independent of the number of wallets
+            # -------------------------
+            num_slots = num_threads or os.cpu_count() or 1
+            self.num_slots = num_slots
+            topology = CpuTopology.get()
+            if affinity == 'none':
+                plan = [None] * num_slots
+            else:
+                plan = topology.plan_slots(num_slots=num_slots, affinity=affinity, avoid_smt=avoid_smt)
+                self.rom_placements = [(node, topology.node_cpus(node, avoid_smt=False)) for node in sorted({node for node, cpus in plan})]
+            # endif
+
+            threads = [threading.Thread(target=self.input_loop, daemon=True), threading.Thread(target=self.work_loop, daemon=True)]
+            for idx_slot in range(num_slots):
+                list__compute_thread.append(threading.Thread(
+                    target=self.compute_loop,
+                    args=(idx_slot, plan[idx_slot]),
                     daemon=True,
                     ))
             # endfor
+            threads += list__compute_thread
+
+            msg = [
+                f'=== Compute Pool ===',
+                f'engine  : {engine}',
+                f'slots   : {num_slots}',
+                f'wallets : {len(self.list__address)}',
+                f'affinity: {affinity}{" (avoid SMT)" if avoid_smt else ""} | NUMA nodes: {topology.nodes}',
+                ]
+            for idx_slot, placement in enumerate(plan):
+                if placement:
+                    node, cpus = placement
+                    msg.append(f'- slot {idx_slot}: node={node} cpus={cpus}')
+                # endif
+            # endfor
+            self.logger.log('\n'.join(msg), log_type=LogType.Active_Workers)
 
             # -------------------------
             # start mining !!
             # -------------------------
-            self.set_active_workers(num_threads=num_threads)
             self.solver.start()
+            self.refill_job_queue()
             for thread in threads:
                 thread.start()
             # endfor
+            self.memory_watchdog.start()
             time.sleep(3)
 
             # -------------------------
@@ -237,18 +396,32 @@ class MidnightApp(BaseApp):
             # -------------------------
             now = time.time()
             last_retrieve_new_challenge = 0
+            last_preempt = now
+            last_refill_job_queue = now
             last_show_worklist = 0
             last_show_hashrate = now
             last_show_results = now
+            last_show_metrics = now
             last_maintain_cache = now
+            last_maintain_db = 0
             while self.solver.is_running():
                 now = time.time()
 
-                if now - last_retrieve_new_challenge > 60 * 1:
+                if now - last_retrieve_new_challenge > self.get_challenge_fetch_interval(now):
                     async_run_func(self.retrieve_new_challenge)
                     last_retrieve_new_challenge = now
                 # endif
 
+                if now - last_preempt > 60 * 1:
+                    async_run_func(self.preempt_outranked_solvers)
+                    last_preempt = now
+                # endif
+
+                if now - last_refill_job_queue > 30:
+                    async_run_func(self.refill_job_queue)
+                    last_refill_job_queue = now
+                # endif
+
                 if now - last_show_worklist > 60 * 20:
                     async_run_func(self.show_worklist)
                     last_show_worklist = now
@@ -256,6 +429,7 @@ class MidnightApp(BaseApp):
 
                 if now - last_show_hashrate > 60 * 10:
                     async_run_func(self.show_hashrate)
+                    async_run_func(self.save_batch_size)
                     last_show_hashrate = now
                 # endif
 
@@ -264,16 +438,29 @@ class MidnightApp(BaseApp):
                     last_show_results = now
                 # endif
 
-                if now - last_maintain_cache > 60 * 30:
+                if now - last_show_metrics > 60 * 10:
+                    async_run_func(self.show_metrics)
+                    last_show_metrics = now
+                # endif
+
+                if now - last_maintain_cache > 60 * 5:
                     async_run_func(self.maintain_rom_cache)
                     last_maintain_cache = now
                 # endif
 
+                if now - last_maintain_db > 60 * 60 * 6:
+                    async_run_func(self.maintain_db)
+                    last_maintain_db = now
+                # endif
+
                 time.sleep(0.5)
             # endwhile
 
             self.logger.log('=== Miner Stopped ===', log_type=LogType.System)
         finally:
+            self.memory_watchdog.stop()
+            self.stop_compute_pool(list__compute_thread)
+            self.save_batch_size()
             self.tracker.close()
         # endtry
     # enddef
@@ -414,6 +601,7 @@ class MidnightApp(BaseApp):
 
             # save
             if self.tracker.add_challenge(challenge):
+                # the tracker wakes up work_loop, which hands the new jobs to the compute pool
                 self.logger.log('\n'.join([
                     '=== New Challenge ===',
                     f'{challenge}',
@@ -524,73 +712,226 @@ class MidnightApp(BaseApp):
     # enddef
 
     @measure_time
-    def pause_solver(self, address: str):
-        ev = self.worker_active_events.get(address)
-        if ev is not None:
-            ev.clear()
+    def preempt_outranked_solvers(self):
+        """
+        Abandon running challenges that can no longer finish before their deadline,
+        and preempt the worst running job when a better one is waiting and no compute slot is idle.
+
+        """
+        hashrate = self.solver.batch_size_controller.hashrate
+        for address in self.list__address:
+            job_stats = self.solver.wp_by_address[address].job_stats
+            if job_stats is None:
+                continue
+            # endif
+
+            solving_challenge = job_stats.challenge
+            if not ChallengeScheduler.is_feasible(solving_challenge, hashrate=hashrate):
+                nickname = f'[{self.worker_nicknames[address]}]'
+                self.logger.log('\n'.join([
+                    f'=== {nickname} Challenge Abandoned ===',
+                    f'address        : {address}',
+                    f'challenge      : {solving_challenge.challenge_id} ({solving_challenge.difficulty})',
+                    f'expected tries : {ChallengeScheduler.expected_tries(solving_challenge):,.0f}',
+                    f'time left      : {ChallengeScheduler.seconds_left(solving_challenge):,.0f} sec',
+                    f'hashrate       : {safefstr(hashrate, ",.0f")} H/s',
+                    ]), log_type=LogType.Challenge_Abandoned, suffix=nickname)
+
+                self.solver.preempt(address)
+
+                continue
+            # endif
+        # endfor
+
+        job = self.job_queue.get_outranked()
+        if job is not None:
+            self.solver.preempt(job.address)
         # endif
     # enddef
 
     @measure_time
-    def resume_solver(self, address: str):
-        ev = self.worker_active_events.get(address)
-        if ev is not None:
-            ev.set()
-        # endif
+    def save_batch_size(self):
+        controller = self.solver.batch_size_controller
+        self.tracker.save_batch_size(hostname=self.hostname, batch_size=controller.batch_size, hashrate=controller.hashrate)
     # enddef
 
     @measure_time
-    def set_active_workers(self, num_threads: Optional[int]):
-        if num_threads is None:
-            return
+    def refill_job_queue(self, blocking: bool = False):
+        """
+        Rank every unsolved (address, challenge) pair with one tracker query and hand them to the compute pool.
+
+        Args:
+            blocking: wait for a refill in progress instead of skipping, e.g. when the tracker state has just changed
+
+        """
+        assert_type(blocking, bool)
+
+        if not self._refill_lock.acquire(blocking=blocking):
+            return  # another thread is refilling right now
         # endif
 
-        msg = [f'=== Active Workers (<= {num_threads}) ===']
+        try:
+            hashrate = self.solver.batch_size_controller.hashrate
+            list__pair = self.tracker.get_unsolved_pairs(list__address=self.list__address)
+            rank_by_challenge_id = {
+                ch.challenge_id: rank
+                for rank, ch in enumerate(ChallengeScheduler.rank(list({ch.challenge_id: ch for _, ch in list__pair}.values()), hashrate=hashrate))
+                }
+            idx_by_address = {address: idx for idx, address in enumerate(self.list__address)}
+
+            list__job = [
+                Job(priority=(rank_by_challenge_id[ch.challenge_id], idx_by_address[address]), address=address, challenge=ch)
+                for address, ch in list__pair
+                if ch.challenge_id in rank_by_challenge_id
+                ]
+            self.job_queue.refill(list__job)
 
-        counts = {addr: len(self.tracker.get_challenges(address=addr, list__status=[SolutionStatus.Found, SolutionStatus.Invalid])) for addr in self.list__address}
-        list_active_address = [addr for addr, _ in sorted(counts.items(), key=lambda kv: kv[1], reverse=True)[:num_threads]]
+            # build the ROMs of new or pending challenges before a slot needs them, best-ranked first
+            list__key = list({job.challenge.no_pre_mine: None for job in sorted(list__job)}.keys())
+            self.prefetch_roms(list__key=list__key)
+        finally:
+            self._refill_lock.release()
+        # endtry
+    # enddef
 
-        changed = False
-        for address in self.list__address:
-            ev = self.worker_active_events[address]
-            is_active = address in list_active_address
-
-            if is_active and not ev.is_set():
-                ev.set()
-                changed = True
-            elif not is_active and ev.is_set():
-                ev.clear()
-                changed = True
+    def prefetch_roms(self, list__key: list[str]):
+        assert_type(list__key, list, str)
+
+        for key in list__key:
+            for placement in self.rom_placements:
+                result = AshMaizeROMManager.prefetch(key=key, placement=placement, on_done=self.on_rom_prefetched)
+                if result == PrefetchResult.Over_Budget:
+                    self.logger.log('\n'.join([
+                        f'=== ROM Prefetch: Over Budget ===',
+                        f'key       : {key[:16]}...',
+                        f'node      : {placement[0] if placement else "-"}',
+                        f'-> Left for the first worker that needs it.',
+                        ]), log_type=LogType.ROM_Prefetch, stdout=False)
+
+                    return
+                # endif
+            # endfor
+        # endfor
+    # enddef
+
+    def on_rom_prefetched(self, key: str, node: Optional[int], seconds: float, error: Optional[Exception]):
+        if error is None:
+            Metrics.observe_ns('rom.prefetch', int(seconds * 1e9))
+        # endif
+
+        self.logger.log('\n'.join([
+            f'=== ROM Prefetch{": Error" if error else ""} ===',
+            f'key       : {key[:16]}...',
+            f'node      : {"-" if node is None else node}',
+            f'ready in  : {seconds:,.1f} sec',
+            ] + ([f'error     : {error}'] if error else [])), log_type=LogType.ROM_Prefetch, stdout=False)
+    # enddef
+
+    def on_rom_evicted(self, key: str, node: Optional[int], size: int, reason: str):
+        self.logger.log('\n'.join([
+            f'=== ROM Evicted ===',
+            f'key       : {key[:16]}...',
+            f'node      : {"-" if node is None else node}',
+            f'size      : {size / (1024 ** 3):,.2f} GiB',
+            f'reason    : {reason}',
+            ]), log_type=LogType.ROM_Cache_Maintenance, stdout=False)
+    # enddef
+
+    def get_challenge_fetch_interval(self, now: float) -> float:
+        sec_from_hour = (now + 1800) % 3600 - 1800  # -1800 .. 1800
+        begin, end = self.CHALLENGE_FETCH_WINDOW_AT_HOUR
+        if begin <= sec_from_hour <= end:
+            return self.CHALLENGE_FETCH_INTERVAL_AT_HOUR
+        # endif
+
+        return self.CHALLENGE_FETCH_INTERVAL
+    # enddef
+
+    @measure_time
+    def work_loop(self):
+        """
+        Refill the job queue the moment the tracker reports new work (a new challenge, a rejected or accepted solution),
+        so that idle compute slots, blocked in `JobQueue.get`, start on it at once.
+
+        """
+        version = 0
+        while self.solver.is_running():
+            new_version = self.tracker.wait_for_work(version=version, timeout=1.0)
+            if new_version == version:
+                continue
             # endif
+            version = new_version
 
-            nickname = f'[{self.worker_nicknames[address]}]'
-            msg.append(f'{nickname}: {"*active*" if is_active else ""}')
+            self.refill_job_queue(blocking=True)
+            self.preempt_outranked_solvers()
+        # endwhile
+    # enddef
+
+    def stop_compute_pool(self, list__compute_thread: list[threading.Thread]):
+        """
+        Stop the solver and wait for the compute slots, so that their last checkpoints and results are queued
+        before the tracker closes.
+
+        """
+        assert_type(list__compute_thread, list, threading.Thread)
+
+        self.solver.stop()
+        self.job_queue.close()  # wake the idle slots
+
+        deadline = time.monotonic() + self.COMPUTE_JOIN_TIMEOUT
+        for thread in list__compute_thread:
+            if thread.is_alive():
+                thread.join(timeout=max(0.0, deadline - time.monotonic()))
+            # endif
         # endfor
 
-        if changed:
-            self.logger.log('\n'.join(msg), log_type=LogType.Active_Workers)
+        num_alive = sum(thread.is_alive() for thread in list__compute_thread)
+        if num_alive > 0:
+            self.logger.log('\n'.join([
+                f'=== Compute Pool: Shutdown Timeout ===',
+                f'{num_alive} of {len(list__compute_thread)} slots still running after {self.COMPUTE_JOIN_TIMEOUT:.0f} sec',
+                ]), log_type=LogType.System)
         # endif
     # enddef
 
     @measure_time
-    def mine_loop(self, address: str, num_threads: Optional[int]):
-        assert_type(address, str)
-        assert_type(num_threads, int, allow_none=True)
+    def compute_loop(self, idx_slot: int, placement: Optional[tuple[int, list[int]]] = None):
+        assert_type(idx_slot, int)
+        assert_type(placement, tuple, allow_none=True)
+
+        if placement:
+            # pin before the first job, so that the ROMs this slot builds are first-touched on its node
+            node, cpus = placement
+            pin_current_thread(cpus=cpus, node=node)
+        # endif
 
-        active_worker_event = self.worker_active_events[address]
         while self.solver.is_running():
-            active_worker_event.wait()  # run when 'set'; stop when 'clear'
+            job = self.job_queue.get(timeout=10.0)
 
-            challenge = self.tracker.get_oldest_unsolved_challenge(address)
+            if job is None:
+                if len(self.job_queue) == 0:  # not merely paused
+                    self.refill_job_queue()
+                # endif
 
-            if challenge is None:
-                time.sleep(10)
-            else:
-                self.solve_challenge(address=address, challenge=challenge)
-                self.set_active_workers(num_threads=num_threads)
+                continue
             # endif
 
-            time.sleep(0.5)
+            try:
+                self.solve_challenge(address=job.address, challenge=job.challenge)
+            except Exception as e:
+                # keep the slot alive: the job goes back to the queue with the next refill
+                self.logger.log('\n'.join([
+                    f'=== Solve: Error ===',
+                    f'slot     : {idx_slot}',
+                    f'address  : {job.address}',
+                    f'challenge: {job.challenge.challenge_id}',
+                    f'error    : {e!r}',
+                    traceback.format_exc(),
+                    ]), log_type=LogType.Solve_Error)
+                time.sleep(1.0)  # do not spin on a job that fails at once
+            finally:
+                self.job_queue.done(job)
+            # endtry
         # endwhile
     # enddef
 
@@ -600,7 +941,7 @@ class MidnightApp(BaseApp):
     @measure_time
     def input_loop(self):
         for line in sys.stdin:
-            cmd = line.strip().lower()
+            cmd, *args = line.strip().lower().split() or ['']
 
             if cmd == 'w':
                 async_run_func(self.show_worklist)
@@ -614,12 +955,18 @@ class MidnightApp(BaseApp):
                 async_run_func(self.show_system_metrics)
             elif cmd == 'c':
                 async_run_func(self.show_rom_cache_status)
+            elif cmd == 'i':
+                async_run_func(self.show_metrics)
+            elif cmd == 'p':
+                self.toggle_profiler(profiler=self.stack_sampler, name='Stack Sampler', args=args)
+            elif cmd == 't':
+                self.toggle_profiler(profiler=self.memory_tracer, name='tracemalloc', args=args)
             elif cmd == 'q':
                 self.logger.log('=== Stopping miner... ===', log_type=LogType.System)
                 self.solver.stop()
                 break
             else:
-                print(f"Invalid command: '{cmd}'. Available: [W]orklist | [H]ashrate | [R]esults | [S]tatistics | System [M]etrics | ROM [C]ache | [Q]uit")
+                print(f"Invalid command: '{cmd}'. Available: [W]orklist | [H]ashrate | [R]esults | [S]tatistics | System [M]etrics | ROM [C]ache | [I]nstrumentation | [P]rofile [sec|stop] | [T]racemalloc [sec|stop] | [Q]uit")
             # endif
         # endfor
     # enddef
@@ -628,10 +975,11 @@ class MidnightApp(BaseApp):
     def show_worklist(self):
         msg = ['=== [W]orklist ===']
 
+        unsolved_by_address = self.tracker.get_unsolved_challenges_by_address(list__address=self.list__address)
         for idx_address, address in enumerate(self.list__address):
             msg.append(f'[{self.worker_nicknames[address]}] {address}')
 
-            list__challenge = self.tracker.get_challenges(address=address, list__status=[ss for ss in SolutionStatus if ss != SolutionStatus.Validated])
+            list__challenge = unsolved_by_address[address]
             worker_profile = self.solver.wp_by_address[address]
             job_stats = worker_profile.job_stats
             if job_stats:
@@ -648,7 +996,8 @@ class MidnightApp(BaseApp):
                         mark = '*'
                         msg_info.append(f'hashrate={safefstr(job_stats.hashrate, ",.0f")} H/s')
                         msg_info.append(f'tries={job_stats.tries:,}')
-                        msg_info.append(f'batch_size={safefstr(worker_profile.best_batch_size, ",")}')
+                        msg_info.append(f'batch_size={safefstr(worker_profile.batch_size, ",")}')
+                        msg_info.append(f'phases=[{worker_profile.phase_stats}]')
                         msg_info.append(f'{timestamp_to_str(job_stats.started_at)} - {timestamp_to_str(job_stats.updated_at)}')
                     else:
                         mark = ' '
@@ -669,6 +1018,8 @@ class MidnightApp(BaseApp):
         msg = ['=== Hashrate ===']
 
         list__hashrate = []
+        list__phase_stats = []
+        hashrate_by_node = defaultdict(list)  # type: dict[int, list[float]]
         for address in self.list__address:
             nickname = f'[{self.worker_nicknames[address]}]'
 
@@ -683,9 +1034,16 @@ class MidnightApp(BaseApp):
 
                 if hashrate:
                     list__hashrate.append(hashrate)
+                    if job_stats.node is not None:
+                        hashrate_by_node[job_stats.node].append(hashrate)
+                    # endif
                 # endif
 
                 msg.append(f'{nickname} challenge={solving_challenge.challenge_id} | {safefstr(hashrate, "7,.0f")} H/s | {tries:10,.0f} tries | {started_at} - {updated_at}')
+                if work_profile.phase_stats.num_batches > 0:
+                    list__phase_stats.append(work_profile.phase_stats)
+                    msg.append(f'{" " * len(nickname)} {work_profile.phase_stats}')
+                # endif
             else:
                 msg.append(f'{nickname} Waiting...')
             # endif
@@ -702,6 +1060,21 @@ class MidnightApp(BaseApp):
             msg.append(f'avg: {hashrate_avg:,.0f} H/s | max: {hashrate_max:,.0f} H/s | min: {hashrate_min:,.0f} H/s')
         # endif
 
+        if list__phase_stats:
+            python_share = sum(ps.python_share for ps in list__phase_stats) / len(list__phase_stats)
+            wait_share = sum(ps.wait_share for ps in list__phase_stats) / len(list__phase_stats)
+
+            msg.append(f'-' * 21)
+            msg.append(f'outside native hash: {python_share:.0%} | off-CPU (GIL/CPU wait): {wait_share:.0%}')
+        # endif
+
+        if hashrate_by_node:
+            msg.append(f'-' * 21)
+            for node, list__node_hashrate in sorted(hashrate_by_node.items()):
+                msg.append(f'node {node}: {sum(list__node_hashrate):,.0f} H/s ({len(list__node_hashrate)} jobs)')
+            # endfor
+        # endif
+
         self.logger.log('\n'.join(msg), log_type=LogType.Hashrate)
     # enddef
 
@@ -709,27 +1082,40 @@ class MidnightApp(BaseApp):
         msg = ['=== Mining Results ===']
 
         list__challenge = self.tracker.get_all_challenges()
-        sum_num_validted = 0
-        for challenge in list__challenge:
-            num_validated = 0
-            num_solving = 0
-            for address in self.list__address:
-                ss = self.tracker.get_solution_status(address=address, challenge=challenge)
-                if ss and ss == SolutionStatus.Validated:
-                    num_validated += 1
-                # endif
+        status_by_pair = self.tracker.get_status_matrix(list__address=self.list__address)
 
-                job_stats = self.solver.wp_by_address[address].job_stats
-                if job_stats and challenge == job_stats.challenge:
-                    num_solving += 1
-                # endif
-            # endfor
-            sum_num_validted += num_validated
+        num_validated_by_challenge_id = defaultdict(int)  # type: dict[str, int]
+        for (address, challenge_id), ss in status_by_pair.items():
+            if ss == SolutionStatus.Validated:
+                num_validated_by_challenge_id[challenge_id] += 1
+            # endif
+        # endfor
 
+        num_solving_by_challenge_id = defaultdict(int)  # type: dict[str, int]
+        for address in self.list__address:
+            job_stats = self.solver.wp_by_address[address].job_stats
+            if job_stats:
+                num_solving_by_challenge_id[job_stats.challenge.challenge_id] += 1
+            # endif
+        # endfor
+
+        for challenge in list__challenge:
+            num_validated = num_validated_by_challenge_id[challenge.challenge_id]
+            num_solving = num_solving_by_challenge_id[challenge.challenge_id]
             msg.append(f'{challenge.challenge_id} ({challenge.difficulty}): {"*" * num_validated}{"." * num_solving}')
         # endfor
         msg.append(f'-' * 21)
-        msg.append(f'sum: {sum_num_validted}')
+        msg.append(f'sum: {sum(num_validated_by_challenge_id.values())}')
+
+        # per wallet, over the whole history
+        msg.append(f'-' * 21)
+        count_by_address = self.tracker.count_statuses_by_address(list__address=self.list__address)
+        archived_count_by_address = self.tracker.count_archived_statuses_by_address(list__address=self.list__address)
+        for address in self.list__address:
+            msg.append(f'[{self.worker_nicknames[address]}] ' + ' | '.join(
+                f'{ss.name.lower()}={count_by_address[address][ss] + archived_count_by_address[address][ss]:,}' for ss in SolutionStatus
+                ))
+        # endfor
 
         self.logger.log('\n'.join(msg), log_type=LogType.Results)
     # enddef
@@ -814,24 +1200,164 @@ class MidnightApp(BaseApp):
         self.logger.log('\n'.join(msg), log_type=LogType.System_Metrics)
     # enddef
 
+    def toggle_profiler(self, profiler: Union[StackSampler, MemoryTracer], name: str, args: list[str]):
+        """
+        `p 60` / `t 60` profile the live miner for 60 seconds, `p stop` / `t stop` end it early (the report is still written).
+
+        """
+        assert_type(name, str)
+        assert_type(args, list, str)
+
+        if args and args[0] == 'stop':
+            profiler.stop()
+
+            return
+        # endif
+
+        try:
+            seconds = float(args[0]) if args else self.PROFILE_SECONDS
+        except ValueError:
+            print(f"Invalid duration: '{args[0]}'")
+
+            return
+        # endtry
+
+        def on_done(list__filepath: list[str]):
+            self.logger.log('\n'.join([f'=== {name} Done ==='] + [f'saved: {filepath}' for filepath in list__filepath]),
+                            log_type=LogType.Profiler)
+        # enddef
+
+        if profiler.start(seconds=seconds, on_done=on_done):
+            self.logger.log(f'=== {name} Started ({seconds:,.0f} sec) ===', log_type=LogType.Profiler)
+        else:
+            self.logger.log(f'=== {name} Already Running ===', log_type=LogType.Profiler)
+        # endif
+    # enddef
+
+    def show_metrics(self):
+        msg = ['=== [I]nstrumentation ===']
+        msg += Metrics.report() or ['No metrics yet.']
+        msg += ['', f'db writer: {self.tracker.get_writer_stats()}']
+
+        self.logger.log('\n'.join(msg), log_type=LogType.Metrics)
+    # enddef
+
     @measure_time
     def show_rom_cache_status(self):
-        rom_cache_info = AshMaizeROMManager.status()
-        size_gb = sum(rom_cache_info.values()) / (1024 ** 3)
+        rom_status = AshMaizeROMManager.status()
+        list__leased = [rs for rs in rom_status.values() if rs.is_leased]
+        list__idle = [rs for rs in rom_status.values() if not rs.is_leased]
+
+        def gb(list__rs: list[RomStatus]) -> str:
+            return f'{sum(rs.size for rs in list__rs) / (1024 ** 3):,.2f} GiB'
+        # enddef
 
         self.logger.log('\n'.join([
             '=== [R]OM Cache Status ===',
-            f'num  : {len(rom_cache_info)}',
-            f'used : {size_gb:,.2f} GiB',
+            f'num  : {len(rom_status)} ({len(list__leased)} leased, {len(list__idle)} idle)',
+            f'used : {gb(list(rom_status.values()))} (leased {gb(list__leased)}, idle {gb(list__idle)}) / budget {AshMaizeROMManager.get_budget() / (1024 ** 3):,.2f} GiB',
+            f'evicted, awaiting release : {sum(1 for rs in list__leased if rs.is_evicted)}',
+            f'building : {len(AshMaizeROMManager.building())} (max {AshMaizeROMManager.MAX_CONCURRENT_BUILDS} at once)',
             ]
             ), log_type=LogType.ROM_Cache_Status)
     # enddef
 
+    # -------------------------
+    # memory pressure
+    # -------------------------
+    def get_max_running(self) -> int:
+        """
+        Jobs that can run at once: one per slot, and at most one per wallet.
+
+        """
+        return max(1, min(self.num_slots, len(self.list__address)))
+    # enddef
+
+    def on_memory_pressure(self, sample: MemorySample):
+        """
+        Called by the watchdog on every sample under pressure: first shed one idle ROM, and only when none is idle,
+        pause the compute slot of the lowest-priority job (its ROM lease is released, so the next sample can shed it).
+
+        """
+        Metrics.inc('memory.pressure_samples')
+
+        num_evicted = AshMaizeROMManager.shed(num_bytes=AshMaizeROMManager.ROM_SIZE, reason='memory pressure')
+        if num_evicted:
+            action = f'-> {num_evicted} idle ROM {"cache has" if num_evicted == 1 else "caches have"} been evicted.'
+        else:
+            # count down from the jobs actually running: with fewer wallets than slots, some slots are idle anyway
+            num_running = self.job_queue.num_in_progress()
+            capacity = min(self.job_queue.capacity or self.get_max_running(), num_running)
+            if capacity <= 1:
+                return  # keep one slot running; nothing else to shed
+            # endif
+
+            capacity -= 1
+            self.job_queue.set_capacity(capacity)
+            worst = None
+            if capacity < num_running:
+                worst = self.job_queue.get_worst_in_progress()
+                if worst:
+                    self.solver.preempt(worst.address)
+                # endif
+            # endif
+            Metrics.inc('memory.slots_paused')
+
+            action = (f'-> 1 compute slot has been paused ({num_running} -> {capacity} jobs running)'
+                      + (f', preempting {worst.challenge.challenge_id} of [{self.worker_nicknames[worst.address]}].' if worst else '.'))
+        # endif
+
+        self.logger.log('\n'.join([
+            f'=== ROM Cache Maintenance: Memory Pressure ===',
+            f'memory : {sample}',
+            action,
+            ]), log_type=LogType.ROM_Cache_Maintenance)
+    # enddef
+
+    def on_memory_calm(self, sample: MemorySample):
+        """
+        Called by the watchdog while the pressure stays low: resume the paused compute slots one at a time.
+
+        """
+        capacity = self.job_queue.capacity
+        if capacity is None:
+            return
+        # endif
+
+        capacity += 1
+        max_running = self.get_max_running()
+        self.job_queue.set_capacity(capacity if capacity < max_running else None)
+
+        self.logger.log('\n'.join([
+            f'=== ROM Cache Maintenance: Memory Pressure Cleared ===',
+            f'memory : {sample}',
+            f'-> 1 compute slot has been resumed (up to {min(capacity, max_running)} / {max_running} jobs running).',
+            ]), log_type=LogType.ROM_Cache_Maintenance)
+    # enddef
+
     # -------------------------
     # other scheduled commands
     # -------------------------
+    @measure_time
+    def maintain_db(self):
+        result = self.tracker.archive(expired_for=self.ARCHIVE_EXPIRED_FOR)
+        db_size = self.tracker.compact()
+
+        self.logger.log('\n'.join([
+            '=== DB Maintenance ===',
+            f'archived : {result.num_challenges:,} challenges, {result.num_solutions:,} solutions ({result.num_progress:,} checkpoints deleted)',
+            f'live DB  : {db_size / (1024 ** 2):,.1f} MiB',
+            f'writer   : {self.tracker.get_writer_stats()}',
+            ]), log_type=LogType.DB_Maintenance, stdout=False)
+    # enddef
+
     @measure_time
     def maintain_rom_cache(self):
+        """
+        Room for new ROMs is made when they are built; this only drops the ROMs no job needs any more,
+        and re-applies the budget in case it was lowered.
+
+        """
         def memory_stats_str(sm: SystemMetrics) -> list[str]:
             return [
                 f'memory total     : {sm.memory_total_gb:,.2f} GiB',
@@ -841,47 +1367,23 @@ class MidnightApp(BaseApp):
                 ]
         # enddef
 
-        # -------------------------
-        # check if ROM caches need to be deleted
-        # -------------------------
-        sm = SystemMetrics.init()
-        rom_cache = AshMaizeROMManager.status()
-        rom_cache_size_avg = (sum(rom_cache.values()) / len(rom_cache)) if rom_cache else 0
-
-        is_clear_needed = (sm.memory_used_percent > 80) or (sm.memory_available < rom_cache_size_avg)
-
-        # -------------------------
-        # take an action
-        # -------------------------
         msg = ['=== ROM Cache Maintenance ===']
-        msg += memory_stats_str(sm)
-        if is_clear_needed:
-            AshMaizeROMManager.clear_all()
-
-            msg.append(f'-> All ROM caches have been cleared.')
-        else:
-            keys_need = {
-                ch.no_pre_mine
-                for address in self.list__address
-                for ch in self.tracker.get_challenges(address=address, list__status=[SolutionStatus.Invalid])
-                }
-            keys_drop = {key for key in AshMaizeROMManager.keys() if key not in keys_need}
+        msg += memory_stats_str(SystemMetrics.init())
+        msg.append(f'budget           : {AshMaizeROMManager.get_budget() / (1024 ** 3):,.2f} GiB')
 
-            if keys_drop:
-                AshMaizeROMManager.drop(*keys_drop)
+        num_evicted = AshMaizeROMManager.evict_unneeded(idle_seconds=self.ROM_IDLE_SECONDS)
+        num_evicted += AshMaizeROMManager.enforce_budget()
 
-                msg.append('-' * 21)
-                msg.append(f'-> {len(keys_drop)} ROM {"cache has" if len(keys_drop) == 1 else "caches have"} been cleared.')
-                msg.append('-' * 21)
-            else:
-                is_clear_needed = False
-            # endif
+        if num_evicted:
+            msg.append('-' * 21)
+            msg.append(f'-> {num_evicted} ROM {"cache has" if num_evicted == 1 else "caches have"} been evicted.')
+            msg.append('-' * 21)
+            msg += memory_stats_str(SystemMetrics.init())
         # endif
-        msg += memory_stats_str(SystemMetrics.init())
 
         self.logger.log('\n'.join(msg), log_type=LogType.ROM_Cache_Maintenance)
 
-        if is_clear_needed:
+        if num_evicted:
             self.show_rom_cache_status()
         # endif
     # enddef
@@ -0,0 +1,62 @@
+import secrets
+import threading
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from utils import assert_type
+
+
+@dataclass
+class NonceCursor:
+    """
+    Sequential 64-bit nonce counter for one (address, challenge).
+
+    Nonces are `base + offset` (mod 2^64). `base` is drawn once per (address, challenge) so that two hosts mining the
+    same wallet do not walk the same range, and `reserve` hands out disjoint [offset, offset + n) slices to every
+    consumer of the cursor. The counter is cheap to advance and is checkpointed as (base, offset) to resume a search.
+
+    """
+    base: int
+    offset: int = 0
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False, repr=False, compare=False)
+
+    MASK = (1 << 64) - 1
+
+    @classmethod
+    def new(cls) -> 'NonceCursor':
+        return cls(base=secrets.randbits(64))
+    # enddef
+
+    def reserve(self, batch_size: int) -> int:
+        assert_type(batch_size, int)
+
+        with self._lock:
+            start = self.offset
+            self.offset += batch_size
+        # endwith
+
+        return start
+    # enddef
+
+    def next_batch_hex(self, batch_size: int) -> str:
+        """
+        Reserve the next `batch_size` nonces and return them as one concatenated hex string (16 chars each).
+
+        """
+        assert_type(batch_size, int)
+
+        start = self.reserve(batch_size)
+
+        return self.render_hex(start=start, batch_size=batch_size)
+    # enddef
+
+    def render_hex(self, start: int, batch_size: int) -> str:
+        assert_type(start, int)
+        assert_type(batch_size, int)
+
+        nonces = np.arange(batch_size, dtype=np.uint64)
+        nonces += np.uint64((self.base + start) & self.MASK)  # wraps around mod 2^64
+
+        return nonces.astype('>u8').tobytes().hex()
+    # enddef
@@ -0,0 +1,101 @@
+import math
+from datetime import datetime, timedelta
+from typing import Optional
+
+from midnight.challenge import Challenge
+from utils import assert_type
+
+
+class ChallengeScheduler:
+    """
+    Orders the unsolved challenges of a worker by expected reward per CPU-second within their deadlines.
+
+    A hash meets the difficulty with probability p = 2^-popcount(mask), so a worker hashing at H H/s finds a solution
+    at rate r = p * H. Over the time T left before the deadline, it succeeds with probability 1 - exp(-r * T) and spends
+    (1 - exp(-r * T)) / r seconds on average, i.e. it earns r solutions per CPU-second. Easier challenges therefore
+    come first, and challenges that are unlikely to finish in time are skipped (or abandoned while being solved).
+
+    """
+    MIN_SUCCESS_PROBABILITY = 0.05
+    SUBMISSION_MARGIN = timedelta(seconds=60)  # same margin as Challenge.is_valid
+
+    @staticmethod
+    def success_probability_per_hash(challenge: Challenge) -> float:
+        assert_type(challenge, Challenge)
+
+        difficulty_mask = ~int(challenge.difficulty[:8], 16) & 0xffffffff
+
+        return 2.0 ** -bin(difficulty_mask).count('1')
+    # enddef
+
+    @classmethod
+    def expected_tries(cls, challenge: Challenge) -> float:
+        assert_type(challenge, Challenge)
+
+        return 1.0 / cls.success_probability_per_hash(challenge)
+    # enddef
+
+    @classmethod
+    def seconds_left(cls, challenge: Challenge, now: Optional[datetime] = None) -> float:
+        assert_type(challenge, Challenge)
+
+        now = now or datetime.utcnow()
+
+        return (challenge.latest_submission_dt - cls.SUBMISSION_MARGIN - now).total_seconds()
+    # enddef
+
+    @classmethod
+    def reward_rate(cls, challenge: Challenge, hashrate: float) -> float:
+        """
+        Expected solutions per CPU-second.
+
+        """
+        assert_type(challenge, Challenge)
+        assert_type(hashrate, float)
+
+        return cls.success_probability_per_hash(challenge) * hashrate
+    # enddef
+
+    @classmethod
+    def success_probability(cls, challenge: Challenge, hashrate: Optional[float], now: Optional[datetime] = None) -> float:
+        """
+        Probability to find a solution before the deadline. Without a measured hashrate every valid challenge counts as feasible.
+
+        """
+        assert_type(challenge, Challenge)
+        assert_type(hashrate, float, allow_none=True)
+
+        seconds_left = cls.seconds_left(challenge, now=now)
+        if seconds_left <= 0:
+            return 0.0
+        # endif
+
+        if not hashrate:
+            return 1.0
+        # endif
+
+        return 1.0 - math.exp(-cls.reward_rate(challenge, hashrate) * seconds_left)
+    # enddef
+
+    @classmethod
+    def is_feasible(cls, challenge: Challenge, hashrate: Optional[float], now: Optional[datetime] = None) -> bool:
+        assert_type(challenge, Challenge)
+        assert_type(hashrate, float, allow_none=True)
+
+        return cls.success_probability(challenge, hashrate=hashrate, now=now) >= cls.MIN_SUCCESS_PROBABILITY
+    # enddef
+
+    @classmethod
+    def rank(cls, list__challenge: list[Challenge], hashrate: Optional[float]) -> list[Challenge]:
+        """
+        Feasible challenges, best first: highest reward per CPU-second, then earliest deadline.
+
+        """
+        assert_type(list__challenge, list, Challenge)
+        assert_type(hashrate, float, allow_none=True)
+
+        now = datetime.utcnow()
+        feasible = [ch for ch in list__challenge if cls.is_feasible(ch, hashrate=hashrate, now=now)]
+
+        return sorted(feasible, key=lambda ch: (-cls.success_probability_per_hash(ch), ch.latest_submission_dt))
+    # enddef
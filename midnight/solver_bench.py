@@ -0,0 +1,325 @@
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, Optional
+
+import numpy as np
+
+from midnight.ashmaize import PyRom
+from midnight.ashmaize_packed_solver import PackedJob, RomBatchPacker
+from midnight.ashmaize_rom_manager import AshMaizeROMManager
+from midnight.ashmaize_solver import AshMaizeSolver, JobStats, WorkerProfile
+from midnight.challenge import Challenge
+from midnight.nonce_cursor import NonceCursor
+from utils import assert_type
+
+
+class TimedRom:
+    """
+    Wraps a `PyRom` and accumulates the time spent inside the native `hash_batch` of the calling thread.
+
+    """
+
+    def __init__(self, rom: PyRom):
+        self.rom = rom
+        self._local = threading.local()
+    # enddef
+
+    def hash_batch(self, preimages: list[str]) -> list[str]:
+        time_start = time.perf_counter()
+        list__hash_hex = self.rom.hash_batch(preimages)
+        self._local.native_time = getattr(self._local, 'native_time', 0.0) + (time.perf_counter() - time_start)
+
+        return list__hash_hex
+    # enddef
+
+    def pop_native_time(self) -> float:
+        native_time = getattr(self._local, 'native_time', 0.0)
+        self._local.native_time = 0.0
+
+        return native_time
+    # enddef
+
+
+@dataclass
+class BenchResult:
+    engine: str
+    num_threads: int
+    batch_size: int
+    num_batches: int
+    hashes: int
+    seconds: float
+    hashrate: float  # H/s, all threads
+    latency_p50_ms: float
+    latency_p99_ms: float
+    python_overhead: float  # share of the batch time spent outside the native hash_batch
+
+
+class SolverBench:
+    """
+    Reproducible hashing throughput benchmark.
+
+    A ROM is built through `AshMaizeROMManager` with a fixed key, then every (engine, threads, batch size) combination
+    hashes for a fixed duration against a synthetic challenge whose difficulty cannot be met, so that every batch runs
+    in full. The thread and process engines go through `AshMaizeSolver.try_once_with_batch`, the packed engine through
+    `RomBatchPacker.hash_packed_batch` with one job per thread.
+
+    """
+    ROM_KEY = 'bench' + '0' * 59
+    ADDRESS_PREFIX = 'bench_address_'
+    CHALLENGE = Challenge(challenge_id='**BENCH',
+                          day=0,
+                          challenge_number=0,
+                          difficulty='00000000',  # every bit masked: p = 2^-32 per hash
+                          no_pre_mine=ROM_KEY,
+                          no_pre_mine_hour='0000000000',
+                          latest_submission='2099-12-31T23:59:59Z',
+                          )
+    WARMUP_BATCHES = 1
+    MIN_BATCHES = 3
+    CHILD_POLL_TIMEOUT = 1.0  # sec between liveness checks of the bench processes
+
+    def __init__(self, solver: AshMaizeSolver, seconds: float):
+        assert_type(solver, AshMaizeSolver)
+        assert_type(seconds, float)
+
+        self.solver = solver
+        self.seconds = seconds
+
+        self.rom = None  # type: Optional[TimedRom]
+        self.rom_build_seconds = None  # type: Optional[float]
+
+        # -------------------------
+        # packed engine only
+        # -------------------------
+        self._packer = None  # type: Optional[RomBatchPacker]
+        self._packed_jobs = []  # type: list[PackedJob]
+    # enddef
+
+    # -------------------------
+    # setup
+    # -------------------------
+    def build_rom(self):
+        time_start = time.perf_counter()
+        self.rom = TimedRom(AshMaizeROMManager.get_rom(self.ROM_KEY))
+        self.rom_build_seconds = time.perf_counter() - time_start
+    # enddef
+
+    @property
+    def difficulty_mask(self) -> int:
+        return ~int(self.CHALLENGE.difficulty[:8], 16) & 0xffffffff
+    # enddef
+
+    @classmethod
+    def address_of(cls, idx: int) -> str:
+        return f'{cls.ADDRESS_PREFIX}{idx:03d}'
+    # enddef
+
+    def new_worker_profile(self) -> WorkerProfile:
+        now = time.time()
+        job_stats = JobStats(challenge=self.CHALLENGE, tries=0, hashrate=None, started_at=now, updated_at=now,
+                             cursor=NonceCursor(base=0), checkpointed_at=now)
+
+        return WorkerProfile(job_stats=job_stats)
+    # enddef
+
+    # -------------------------
+    # run
+    # -------------------------
+    def run(self, engine: str, num_threads: int, batch_size: int) -> BenchResult:
+        assert_type(engine, str)
+        assert_type(num_threads, int)
+        assert_type(batch_size, int)
+
+        if engine == 'thread':
+            samples = self._run_threads(num_threads=num_threads, batch_size=batch_size, loop=self._solver_loop)
+        elif engine == 'process':
+            samples = self._run_processes(num_threads=num_threads, batch_size=batch_size)
+        elif engine == 'packed':
+            self._prepare_packed(num_threads=num_threads)
+            samples = self._run_threads(num_threads=num_threads, batch_size=batch_size, loop=self._packed_loop)
+        else:
+            raise NotImplementedError(engine)
+        # endif
+
+        return self.summarize(engine=engine, num_threads=num_threads, batch_size=batch_size, samples=samples)
+    # enddef
+
+    def _solver_loop(self, idx: int, batch_size: int) -> list[tuple[int, float, float]]:
+        solver = self.solver
+        worker_profile = self.new_worker_profile()
+        job_stats = worker_profile.job_stats
+        preimage_base = solver.get_preimage_base(address=self.address_of(idx), challenge=self.CHALLENGE)
+        difficulty_mask = self.difficulty_mask
+
+        def run_batch():
+            solver.try_once_with_batch(worker_profile=worker_profile, preimage_base=preimage_base, get_nonce_batch=job_stats.cursor.next_batch_hex,
+                                       rom=self.rom, difficulty_mask=difficulty_mask, batch_size=batch_size)
+        # enddef
+
+        return self._measure(run_batch=run_batch, batch_size=batch_size)
+    # enddef
+
+    def _packed_loop(self, idx: int, batch_size: int) -> list[tuple[int, float, float]]:
+        packer = self._packer
+        jobs = self._packed_jobs
+
+        def run_batch():
+            packer.hash_packed_batch(jobs, batch_size=batch_size)
+        # enddef
+
+        return self._measure(run_batch=run_batch, batch_size=batch_size)
+    # enddef
+
+    def _measure(self, run_batch: Callable[[], None], batch_size: int) -> list[tuple[int, float, float]]:
+        """
+        Returns:
+            (batch_size, latency, native time) per batch, after the warm-up batches
+
+        """
+        for _ in range(self.WARMUP_BATCHES):
+            run_batch()
+        # endfor
+        self.rom.pop_native_time()
+
+        samples = []
+        time_end = time.perf_counter() + self.seconds
+        while time.perf_counter() < time_end or len(samples) < self.MIN_BATCHES:
+            time_start = time.perf_counter()
+            run_batch()
+            latency = time.perf_counter() - time_start
+
+            samples.append((batch_size, latency, self.rom.pop_native_time()))
+        # endwhile
+
+        return samples
+    # enddef
+
+    def _prepare_packed(self, num_threads: int):
+        # one wallet per thread, all sharing the ROM; every lane hashes a slice of every wallet
+        self._packer = RomBatchPacker(solver=self.solver, key=self.ROM_KEY, rom=self.rom, node=None)
+        self._packed_jobs = []
+        for idx in range(num_threads):
+            worker_profile = self.new_worker_profile()
+            self._packed_jobs.append(PackedJob(address=self.address_of(idx),
+                                               worker_profile=worker_profile,
+                                               cursor=worker_profile.job_stats.cursor,
+                                               preimage_base=self.solver.get_preimage_base(address=self.address_of(idx), challenge=self.CHALLENGE),
+                                               difficulty_mask=self.difficulty_mask,
+                                               ))
+        # endfor
+    # enddef
+
+    def _run_threads(self, num_threads: int, batch_size: int, loop) -> list[tuple[int, float, float]]:
+        samples_by_idx = dict()
+
+        def target(idx: int):
+            samples_by_idx[idx] = loop(idx, batch_size)
+        # enddef
+
+        threads = [threading.Thread(target=target, args=(idx,), daemon=True) for idx in range(num_threads)]
+        for thread in threads:
+            thread.start()
+        # endfor
+        for thread in threads:
+            thread.join()
+        # endfor
+
+        return [sample for idx in sorted(samples_by_idx.keys()) for sample in samples_by_idx[idx]]
+    # enddef
+
+    def _run_processes(self, num_threads: int, batch_size: int) -> list[tuple[int, float, float]]:
+        # the ROM is built before forking, so the children share it through copy-on-write
+        ctx = mp.get_context('fork')
+        q = ctx.Queue()
+
+        def target(idx: int):
+            q.put(self._solver_loop(idx, batch_size))
+        # enddef
+
+        procs = [ctx.Process(target=target, args=(idx,), daemon=True) for idx in range(num_threads)]
+        for proc in procs:
+            proc.start()
+        # endfor
+
+        samples = []
+        num_received = 0
+        try:
+            while num_received < len(procs):
+                try:
+                    samples += q.get(timeout=self.CHILD_POLL_TIMEOUT)
+                    num_received += 1
+                except queue.Empty:
+                    # a child that crashed (e.g. OOM-killed while hashing) never reports
+                    list__exitcode = [proc.exitcode for proc in procs if proc.exitcode not in (None, 0)]
+                    if list__exitcode or all(proc.exitcode is not None for proc in procs):
+                        raise RuntimeError(f'{len(list__exitcode)} of {len(procs)} bench processes died (exit codes {list__exitcode})')
+                    # endif
+                # endtry
+            # endwhile
+        finally:
+            for proc in procs:
+                if num_received < len(procs) and proc.is_alive():
+                    proc.terminate()
+                # endif
+                proc.join()
+            # endfor
+            q.close()
+        # endtry
+
+        return samples
+    # enddef
+
+    # -------------------------
+    # summary
+    # -------------------------
+    def summarize(self, engine: str, num_threads: int, batch_size: int, samples: list[tuple[int, float, float]]) -> BenchResult:
+        if samples:
+            sizes = np.array([s[0] for s in samples], dtype=np.float64)
+            latencies = np.array([s[1] for s in samples], dtype=np.float64)
+            native_times = np.array([s[2] for s in samples], dtype=np.float64)
+
+            hashes = int(sizes.sum())
+            # the threads run side by side, so the busy time per thread approximates the wall time
+            seconds = float(latencies.sum()) / num_threads
+            hashrate = hashes / seconds if seconds > 0 else 0.0
+            latency_p50_ms = float(np.percentile(latencies, 50)) * 1e3
+            latency_p99_ms = float(np.percentile(latencies, 99)) * 1e3
+            python_overhead = max(0.0, 1.0 - float(native_times.sum()) / float(latencies.sum()))
+        else:
+            hashes, seconds, hashrate, latency_p50_ms, latency_p99_ms, python_overhead = 0, 0.0, 0.0, 0.0, 0.0, 0.0
+        # endif
+
+        return BenchResult(engine=engine,
+                           num_threads=num_threads,
+                           batch_size=batch_size,
+                           num_batches=len(samples),
+                           hashes=hashes,
+                           seconds=seconds,
+                           hashrate=hashrate,
+                           latency_p50_ms=latency_p50_ms,
+                           latency_p99_ms=latency_p99_ms,
+                           python_overhead=python_overhead,
+                           )
+    # enddef
+
+    def to_dict(self, list__result: list[BenchResult]) -> dict:
+        assert_type(list__result, list, BenchResult)
+
+        return {
+            'host': {
+                'cpu_count': os.cpu_count(),
+                },
+            'rom': {
+                'backend': AshMaizeROMManager.get_backend().value,
+                'key': self.ROM_KEY,
+                'size': AshMaizeROMManager.ROM_SIZE,
+                'build_seconds': self.rom_build_seconds,
+                },
+            'seconds_per_run': self.seconds,
+            'results': [asdict(result) for result in list__result],
+            }
+    # enddef
@@ -1,13 +1,17 @@
+import bisect
 import os.path
 import threading
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 from enum import Enum, auto
-from typing import Iterable, Optional
+from typing import Optional
 
-from peewee import DateTimeField, IntegerField, JOIN, Model, SqliteDatabase, TextField
+from peewee import BlobField, Case, CompositeKey, DateTimeField, FloatField, IntegerField, Model, SqliteDatabase, TextField, fn
 
 from logger import Logger, measure_time
 from midnight.challenge import Challenge
+from midnight.db_writer import DBWriter, DBWriterStats
+from midnight.nonce_cursor import NonceCursor
 from midnight.solution import Solution
 from project import Project
 from utils import assert_type, parse_iso8601_to_utc_naive
@@ -19,6 +23,7 @@ db = SqliteDatabase(
         'journal_mode': 'wal',
         'synchronous': 'normal',
         'busy_timeout': 30_000,  # ms
+        'auto_vacuum': 'incremental',  # only for a new file; an existing one is converted once by Tracker
         },
     timeout=30.0,
     # autostart=False,
@@ -28,6 +33,19 @@ db = SqliteDatabase(
 
 db_lock = threading.Lock()
 
+# expired, settled challenges and their solutions, moved out of the live DB by Tracker.archive
+archive_db = SqliteDatabase(
+    None,
+    pragmas={
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'busy_timeout': 30_000,  # ms
+        },
+    timeout=30.0,
+    )
+
+archive_lock = threading.Lock()
+
 
 class BaseModel(Model):
     class Meta:
@@ -80,7 +98,85 @@ class SolutionModel(BaseModel):
     # endclass
 
 
+class ProgressModel(BaseModel):
+    address: str = TextField()
+    challenge_id: str = TextField()
+    nonce_base: str = TextField()  # 64-bit unsigned does not fit into INTEGER, so hex
+    nonce_offset: int = IntegerField()
+    tries: int = IntegerField()
+    updated_at: datetime = DateTimeField()
+
+    class Meta:
+        primary_key = CompositeKey('address', 'challenge_id')
+    # endclass
+
+
+class BatchSizeModel(BaseModel):
+    hostname: str = TextField(primary_key=True)
+    batch_size: int = IntegerField()
+    hashrate: float = FloatField(null=True)
+    updated_at: datetime = DateTimeField()
+
+
+# -------------------------
+# archive:
+# nonces and hashes are stored as BLOBs (half the size of their hex); no_pre_mine is kept as the original text
+# -------------------------
+class ArchiveBaseModel(Model):
+    class Meta:
+        database = archive_db
+
+
+class ChallengeArchiveModel(ArchiveBaseModel):
+    challenge_id: str = TextField(primary_key=True)
+    day: int = IntegerField()
+    challenge_number: int = IntegerField()
+    difficulty: str = TextField()
+    no_pre_mine: str = TextField()
+    no_pre_mine_hour: str = TextField()
+    latest_submission: str = TextField()
+    latest_submission_dt: datetime = DateTimeField(index=True)
+    archived_at: datetime = DateTimeField()
+
+
+class SolutionArchiveModel(ArchiveBaseModel):
+    address: str = TextField()
+    challenge_id: str = TextField()
+    nonce: bytes = BlobField()
+    hash: bytes = BlobField()
+    tries: int = IntegerField()
+    status: int = IntegerField()
+
+    class Meta:
+        primary_key = CompositeKey('address', 'challenge_id', 'nonce')
+    # endclass
+
+
+@dataclass
+class ArchiveResult:
+    num_challenges: int
+    num_solutions: int
+    num_progress: int
+
+
 class Tracker:
+    """
+    Durable state in SQLite, plus a write-through in-memory index of the challenges and of the solutions per
+    (address, challenge_id). The index is loaded once here and updated by every write of this class, so the
+    scheduling and reporting reads never touch SQLite, and hand out the same (interned) `Challenge` objects.
+
+    Every write that changes which (address, challenge) pairs need work bumps a version and wakes `wait_for_work`.
+
+    The SQLite writes go through a single `DBWriter` thread that groups them into transactions. Writes whose result
+    or durability matters (wallets, challenges, found solutions) wait for their commit; status updates, progress
+    checkpoints and batch sizes are queued, and are flushed by `close` at the latest.
+
+    Challenges that expired long ago and whose solutions are settled are moved by `archive` into a separate archive DB,
+    so that the live tables (and the in-memory index) only hold the working set. `compact` then returns the freed
+    pages to the file system and truncates the WAL.
+
+    """
+
     @measure_time
     def __init__(self, project: Project, logger: Logger):
         assert_type(project, Project)
@@ -89,17 +185,135 @@ class Tracker:
         db.init(db_name)
         # db.start()
         db.connect(reuse_if_open=True)
-        db.create_tables([WalletModel, ChallengeModel, SolutionModel])
+        if db.execute_sql('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # a file created without incremental auto-vacuum: convert it once, so that `compact` can shrink it
+            db.execute_sql('PRAGMA auto_vacuum = INCREMENTAL')
+            db.execute_sql('VACUUM')
+        # endif
+        db.create_tables([WalletModel, ChallengeModel, SolutionModel, ProgressModel, BatchSizeModel])
+
+        archive_db.init(os.path.join('db', f'{project.name.lower()}_archive.sqlite3'))
+        archive_db.connect(reuse_if_open=True)
+        archive_db.create_tables([ChallengeArchiveModel, SolutionArchiveModel])
 
         self.db = db
         self.logger = logger
+        self._writer = DBWriter(db=db, lock=db_lock, logger=logger)
+
+        # -------------------------
+        # in-memory index
+        # -------------------------
+        self._index_lock = threading.Lock()
+        self._challenge_by_id = dict()  # type: dict[str, Challenge]  # in insertion order
+        self._list__challenge_by_deadline = []  # type: list[Challenge]  # sorted by latest_submission_dt
+        self._solutions_by_pair = dict()  # type: dict[tuple[str, str], dict[str, tuple[Solution, SolutionStatus]]]  # nonce_hex -> ...
+        self._load_index()
+
+        # -------------------------
+        # new-work notifications
+        # -------------------------
+        self._work_cond = threading.Condition()
+        self._work_version = 0
+    # enddef
+
+    # -------------------------
+    # new-work notifications
+    # -------------------------
+    def _notify_work(self):
+        with self._work_cond:
+            self._work_version += 1
+            self._work_cond.notify_all()
+        # endwith
+    # enddef
+
+    def wait_for_work(self, version: int, timeout: Optional[float] = None) -> int:
+        """
+        Block until the set of pairs that need work changed after `version` (a new challenge, an accepted or a rejected
+        solution), or until `timeout`.
+
+        Returns:
+            the current version, to pass to the next call
+
+        """
+        assert_type(version, int)
+        assert_type(timeout, float, allow_none=True)
+
+        with self._work_cond:
+            self._work_cond.wait_for(lambda: self._work_version != version, timeout=timeout)
+
+            return self._work_version
+        # endwith
+    # enddef
+
+    # -------------------------
+    # in-memory index
+    # -------------------------
+    @measure_time
+    def _load_index(self):
+        with self._index_lock:
+            for cm in ChallengeModel.select():
+                self._index_challenge(Challenge.from_challenge_model(cm))
+            # endfor
+
+            for sm in SolutionModel.select().order_by(SolutionModel.id):
+                solution = Solution(nonce_hex=sm.nonce_hex, hash_hex=sm.hash_hex, tries=sm.tries)
+                self._index_solution(address=sm.address, challenge_id=sm.challenge_id, solution=solution, status=SolutionStatus(int(sm.status)))
+            # endfor
+        # endwith
+    # enddef
+
+    def _index_challenge(self, challenge: Challenge) -> Challenge:
+        # under self._index_lock
+        if challenge.challenge_id not in self._challenge_by_id:
+            self._challenge_by_id[challenge.challenge_id] = challenge
+            bisect.insort(self._list__challenge_by_deadline, challenge, key=lambda ch: ch.latest_submission_dt)
+        # endif
+
+        return self._challenge_by_id[challenge.challenge_id]
+    # enddef
+
+    def _index_solution(self, address: str, challenge_id: str, solution: Solution, status: SolutionStatus):
+        # under self._index_lock
+        self._solutions_by_pair.setdefault((address, challenge_id), dict())[solution.nonce_hex] = (solution, status)
+    # enddef
+
+    def _get_statuses(self, address: str, challenge_id: str) -> list[SolutionStatus]:
+        # under self._index_lock
+        return [status for solution, status in self._solutions_by_pair.get((address, challenge_id), dict()).values()]
+    # enddef
+
+    def _get_valid_challenges(self) -> list[Challenge]:
+        # under self._index_lock; by deadline, the earliest first
+        return [ch for ch in self._list__challenge_by_deadline if ch.is_valid()]
     # enddef
 
     @measure_time
     def close(self):
+        self._writer.close()
+
         if not self.db.is_closed():
             self.db.close()
         # endif
+        if not archive_db.is_closed():
+            archive_db.close()
+        # endif
+    # enddef
+
+    def get_writer_stats(self) -> DBWriterStats:
+        return self._writer.stats()
+    # enddef
+
+    @staticmethod
+    def _insert_ignore(q) -> bool:
+        """
+        Run an `on_conflict_ignore` insert on the writer's connection.
+
+        Returns:
+            True if a row was inserted. `q.execute()` can not tell: it returns the last rowid of the connection,
+            which is that of an earlier insert when the row was ignored.
+
+        """
+        return db.execute(q).rowcount > 0
     # enddef
 
     # -------------------------
@@ -117,9 +331,7 @@ class Tracker:
             .on_conflict_ignore()
         )
 
-        with db_lock:
-            inserted = q.execute()
-        # endwith
+        inserted = self._writer.submit(lambda: self._insert_ignore(q), wait=True)
 
         return bool(inserted)
     # enddef
@@ -153,10 +365,16 @@ class Tracker:
             .on_conflict_ignore()
         )
 
-        with db_lock:
-            inserted = q.execute()
+        inserted = self._writer.submit(lambda: self._insert_ignore(q), wait=True)
+
+        with self._index_lock:
+            self._index_challenge(challenge)
         # endwith
 
+        if inserted:
+            self._notify_work()
+        # endif
+
         return bool(inserted)
     # enddef
 
@@ -170,53 +388,131 @@ class Tracker:
     # enddef
 
     @measure_time
-    def _query_challenge_models(self, address: str, list__status: list[SolutionStatus]) -> Iterable[ChallengeModel]:
+    def get_challenges(self, address: str, list__status: list[SolutionStatus]) -> list[Challenge]:
+        """
+        Valid challenges, the earliest deadline first, that `address` has no solution for or a solution in `list__status`.
+
+        """
         assert_type(address, str)
         assert_type(list__status, list, SolutionStatus)
 
-        allowed_status_values = [ss.value for ss in list__status]
-        SolutionAlias = SolutionModel.alias()
+        with self._index_lock:
+            list__challenge = []
+            for ch in self._get_valid_challenges():
+                list__ss = self._get_statuses(address=address, challenge_id=ch.challenge_id)
+                if not list__ss or any(ss in list__status for ss in list__ss):
+                    list__challenge.append(ch)
+                # endif
+            # endfor
+        # endwith
 
-        query = (
-            ChallengeModel
-            .select(ChallengeModel)
-            .join(
-                SolutionAlias,
-                JOIN.LEFT_OUTER,
-                on=(
-                        (SolutionAlias.challenge_id == ChallengeModel.challenge_id) &
-                        (SolutionAlias.address == address)
-                ),
-                )
-            .where(
-                (SolutionAlias.challenge_id.is_null(True)) |
-                (SolutionAlias.status.in_(allowed_status_values))
-                )
-            .where(Challenge.is_valid_dt(ChallengeModel.latest_submission_dt))
-            .order_by(ChallengeModel.latest_submission_dt.asc())
-        )
+        return list__challenge
+    # enddef
 
-        return query
+    @measure_time
+    def get_unsolved_pairs(self, list__address: list[str]) -> list[tuple[str, Challenge]]:
+        """
+        All (address, challenge) pairs that still need work, for every wallet at once.
+
+        """
+        assert_type(list__address, list, str)
+
+        with self._index_lock:
+            return [
+                (address, ch)
+                for ch in self._get_valid_challenges()
+                for address in list__address
+                if SolutionStatus.Validated not in self._get_statuses(address=address, challenge_id=ch.challenge_id)
+                ]
+        # endwith
     # enddef
 
+    # -------------------------
+    # reporting: every wallet at once
+    # -------------------------
+    STATUS_RANK = {SolutionStatus.Invalid: 0, SolutionStatus.Found: 1, SolutionStatus.Validated: 2}
+
     @measure_time
-    def get_challenges(self, address: str, list__status: list[SolutionStatus]) -> list[Challenge]:
-        assert_type(address, str)
-        assert_type(list__status, list, SolutionStatus)
+    def get_status_matrix(self, list__address: list[str]) -> dict[tuple[str, str], SolutionStatus]:
+        """
+        The status of every (address, challenge_id) pair of `list__address` that has a solution, in one pass;
+        pairs without a solution are absent. With several solutions for a pair, the most advanced status wins.
+
+        """
+        assert_type(list__address, list, str)
+
+        set__address = set(list__address)
+        with self._index_lock:
+            return {
+                (address, challenge_id): max((status for solution, status in solutions.values()), key=self.STATUS_RANK.get)
+                for (address, challenge_id), solutions in self._solutions_by_pair.items()
+                if address in set__address and solutions
+                }
+        # endwith
+    # enddef
 
-        list__challenge_models = self._query_challenge_models(address=address, list__status=list__status)
+    @measure_time
+    def count_statuses_by_address(self, list__address: list[str]) -> dict[str, dict[SolutionStatus, int]]:
+        """
+        Number of challenges per status, for every wallet of `list__address`.
+
+        """
+        assert_type(list__address, list, str)
 
-        list__challenge = []
-        for cm in list__challenge_models:
-            list__challenge.append(Challenge.from_challenge_model(challenge_model=cm))
+        count_by_address = {address: {ss: 0 for ss in SolutionStatus} for address in list__address}
+        for (address, challenge_id), status in self.get_status_matrix(list__address=list__address).items():
+            count_by_address[address][status] += 1
         # endfor
 
-        return list__challenge
+        return count_by_address
+    # enddef
+
+    @measure_time
+    def get_unsolved_challenges_by_address(self, list__address: list[str]) -> dict[str, list[Challenge]]:
+        """
+        Same as `get_challenges(address, [every status but Validated])` for every wallet of `list__address`, in one pass.
+
+        """
+        assert_type(list__address, list, str)
+
+        unsolved_by_address = {address: [] for address in list__address}  # type: dict[str, list[Challenge]]
+        for address, ch in self.get_unsolved_pairs(list__address=list__address):
+            unsolved_by_address[address].append(ch)
+        # endfor
+
+        return unsolved_by_address
+    # enddef
+
+    @measure_time
+    def count_archived_statuses_by_address(self, list__address: list[str]) -> dict[str, dict[SolutionStatus, int]]:
+        """
+        Same as `count_statuses_by_address`, over the archive, with one grouped query.
+
+        """
+        assert_type(list__address, list, str)
+
+        status_by_rank = {rank: ss for ss, rank in self.STATUS_RANK.items()}
+        rank = Case(None, [(SolutionArchiveModel.status == ss.value, rank) for ss, rank in self.STATUS_RANK.items()])
+        query = (
+            SolutionArchiveModel
+            .select(SolutionArchiveModel.address, fn.MAX(rank).alias('best_rank'))
+            .where(SolutionArchiveModel.address.in_(list__address))
+            .group_by(SolutionArchiveModel.address, SolutionArchiveModel.challenge_id)
+        )
+
+        count_by_address = {address: {ss: 0 for ss in SolutionStatus} for address in list__address}
+        for row in query.dicts():
+            count_by_address[row['address']][status_by_rank[row['best_rank']]] += 1
+        # endfor
+
+        return count_by_address
     # enddef
 
     @measure_time
     def get_all_challenges(self) -> list[Challenge]:
-        return [Challenge.from_challenge_model(cm) for cm in ChallengeModel.select()]
+        with self._index_lock:
+            return list(self._challenge_by_id.values())
+        # endwith
     # enddef
 
     @measure_time
@@ -224,34 +520,20 @@ class Tracker:
         assert_type(address, str)
         assert_type(challenge, Challenge)
 
-        sm = (
-            SolutionModel
-            .select()
-            .where(
-                (SolutionModel.address == address) &
-                (SolutionModel.challenge_id == challenge.challenge_id)
-                )
-            .first()
-        )  # type: SolutionModel
+        with self._index_lock:
+            list__ss = self._get_statuses(address=address, challenge_id=challenge.challenge_id)
+        # endwith
 
-        if sm:
-            return SolutionStatus(int(sm.status))
-        else:
-            return None
-        # endif
+        return list__ss[0] if list__ss else None
     # enddef
 
     @measure_time
     def get_oldest_unsolved_challenge(self, address: str) -> Optional[Challenge]:
         assert_type(address, str)
 
-        cm = self._query_challenge_models(address=address, list__status=[ss for ss in SolutionStatus if ss != SolutionStatus.Validated]).first()
+        list__challenge = self.get_challenges(address=address, list__status=[ss for ss in SolutionStatus if ss != SolutionStatus.Validated])
 
-        if cm is None:
-            return None
-        else:
-            return Challenge.from_challenge_model(cm)
-        # endif
+        return list__challenge[0] if list__challenge else None
     # enddef
 
     # -------------------------
@@ -272,8 +554,10 @@ class Tracker:
             status=SolutionStatus.Found.value,
             )
 
-        with db_lock:
-            SolutionModel.create(**data)
+        self._writer.submit(lambda: SolutionModel.create(**data), wait=True)
+
+        with self._index_lock:
+            self._index_solution(address=address, challenge_id=challenge.challenge_id, solution=solution, status=SolutionStatus.Found)
         # endwith
     # enddef
 
@@ -294,8 +578,19 @@ class Tracker:
                 )
         )
 
-        with db_lock:
-            q.execute()
+        self._writer.submit(q.execute)
+
+        self._update_index_status(address=address, challenge=challenge, solution=solution, status=status)
+        self._notify_work()
+    # enddef
+
+    def _update_index_status(self, address: str, challenge: Challenge, solution: Solution, status: SolutionStatus):
+        with self._index_lock:
+            solutions = self._solutions_by_pair.get((address, challenge.challenge_id), dict())
+            if solution.nonce_hex in solutions:
+                # keep the stored solution (it carries the hash and tries); only the status changes
+                solutions[solution.nonce_hex] = (solutions[solution.nonce_hex][0], status)
+            # endif
         # endwith
     # enddef
 
@@ -304,22 +599,15 @@ class Tracker:
         assert_type(address, str)
         assert_type(challenge, Challenge)
 
-        sm = (
-            SolutionModel
-            .select()
-            .where(
-                (SolutionModel.address == address) &
-                (SolutionModel.challenge_id == challenge.challenge_id) &
-                (SolutionModel.status == SolutionStatus.Found.value)
-                )
-            .first()
-        )  # type: Optional[SolutionModel]
+        with self._index_lock:
+            for solution, status in self._solutions_by_pair.get((address, challenge.challenge_id), dict()).values():
+                if status == SolutionStatus.Found:
+                    return solution
+                # endif
+            # endfor
+        # endwith
 
-        if sm:
-            return Solution(nonce_hex=sm.nonce_hex, hash_hex=sm.hash_hex, tries=sm.tries)
-        else:
-            return None
-        # endif
+        return None
     # enddef
 
     # -------------------------
@@ -331,9 +619,10 @@ class Tracker:
         assert_type(challenge, Challenge)
         assert_type(validated, bool)
 
+        status = SolutionStatus.Validated if validated else SolutionStatus.Invalid
         q = (
             SolutionModel
-            .update(status=(SolutionStatus.Validated if validated else SolutionStatus.Invalid).value)
+            .update(status=status.value)
             .where(
                 (SolutionModel.address == address) &
                 (SolutionModel.challenge_id == challenge.challenge_id) &
@@ -341,7 +630,218 @@ class Tracker:
                 )
         )
 
-        with db_lock:
-            q.execute()
+        self._writer.submit(q.execute)
+
+        self._update_index_status(address=address, challenge=challenge, solution=solution, status=status)
+        self._notify_work()
+    # enddef
+
+    # -------------------------
+    # archive
+    # -------------------------
+    ARCHIVE_DELETE_CHUNK = 500  # challenge ids per DELETE, well below SQLite's limit of bound variables
+
+    @measure_time
+    def archive(self, expired_for: timedelta) -> ArchiveResult:
+        """
+        Move the challenges whose deadline passed more than `expired_for` ago, and that have no solution waiting for
+        submission (status Found), into the archive DB together with their solutions; their progress is deleted.
+
+        The archive is written first and the live rows are deleted after, so a crash in between leaves duplicates that
+        the next run archives again (the archive writes are idempotent), never lost rows.
+
+        """
+        assert_type(expired_for, timedelta)
+
+        deadline = datetime.utcnow() - expired_for
+        with self._index_lock:
+            list__challenge = []
+            list__solution_row = []
+            for ch in self._list__challenge_by_deadline:
+                if ch.latest_submission_dt >= deadline:
+                    break  # sorted by deadline
+                # endif
+
+                rows = [
+                    (address, solution, status)
+                    for (address, challenge_id), solutions in self._solutions_by_pair.items()
+                    if challenge_id == ch.challenge_id
+                    for solution, status in solutions.values()
+                    ]
+                if any(status == SolutionStatus.Found for address, solution, status in rows):
+                    continue  # not settled yet
+                # endif
+
+                list__challenge.append(ch)
+                list__solution_row += [(address, ch.challenge_id, solution, status) for address, solution, status in rows]
+            # endfor
         # endwith
+
+        if not list__challenge:
+            return ArchiveResult(num_challenges=0, num_solutions=0, num_progress=0)
+        # endif
+
+        # -------------------------
+        # 1. archive DB
+        # -------------------------
+        now = datetime.utcnow()
+        with archive_lock:
+            with archive_db.atomic():
+                for ch in list__challenge:
+                    ChallengeArchiveModel.insert(
+                        challenge_id=ch.challenge_id,
+                        day=ch.day,
+                        challenge_number=ch.challenge_number,
+                        difficulty=ch.difficulty,
+                        no_pre_mine=ch.no_pre_mine,
+                        no_pre_mine_hour=ch.no_pre_mine_hour,
+                        latest_submission=ch.latest_submission,
+                        latest_submission_dt=ch.latest_submission_dt,
+                        archived_at=now,
+                        ).on_conflict_replace().execute()
+                # endfor
+
+                for address, challenge_id, solution, status in list__solution_row:
+                    SolutionArchiveModel.insert(
+                        address=address,
+                        challenge_id=challenge_id,
+                        nonce=bytes.fromhex(solution.nonce_hex),
+                        hash=bytes.fromhex(solution.hash_hex),
+                        tries=solution.tries,
+                        status=status.value,
+                        ).on_conflict_replace().execute()
+                # endfor
+            # endwith
+        # endwith
+
+        # -------------------------
+        # 2. live DB, then the index
+        # -------------------------
+        list__challenge_id = [ch.challenge_id for ch in list__challenge]
+
+        def delete_live() -> int:
+            num_progress = 0
+            for idx in range(0, len(list__challenge_id), self.ARCHIVE_DELETE_CHUNK):
+                chunk = list__challenge_id[idx:idx + self.ARCHIVE_DELETE_CHUNK]
+                SolutionModel.delete().where(SolutionModel.challenge_id.in_(chunk)).execute()
+                ChallengeModel.delete().where(ChallengeModel.challenge_id.in_(chunk)).execute()
+                num_progress += ProgressModel.delete().where(ProgressModel.challenge_id.in_(chunk)).execute()
+            # endfor
+
+            return num_progress
+        # enddef
+
+        num_progress = self._writer.submit(delete_live, wait=True)
+
+        set__challenge_id = set(list__challenge_id)
+        with self._index_lock:
+            for challenge_id in list__challenge_id:
+                del self._challenge_by_id[challenge_id]
+            # endfor
+            self._list__challenge_by_deadline = [ch for ch in self._list__challenge_by_deadline if ch.challenge_id not in set__challenge_id]
+            for pair in [pair for pair in self._solutions_by_pair.keys() if pair[1] in set__challenge_id]:
+                del self._solutions_by_pair[pair]
+            # endfor
+        # endwith
+
+        return ArchiveResult(num_challenges=len(list__challenge), num_solutions=len(list__solution_row), num_progress=num_progress)
+    # enddef
+
+    @measure_time
+    def compact(self) -> int:
+        """
+        Return the free pages of the live DB to the file system and truncate its WAL.
+
+        Returns:
+            the size of the live DB file in bytes, after compaction
+
+        """
+        def run() -> int:
+            self.db.execute_sql('PRAGMA incremental_vacuum')
+
+            return self.db.execute_sql('PRAGMA page_count').fetchone()[0] * self.db.execute_sql('PRAGMA page_size').fetchone()[0]
+        # enddef
+
+        size = self._writer.submit(run, wait=True)
+
+        # from this thread: the writer would run it inside its transaction, which keeps the WAL from being reset
+        self.db.execute_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+
+        return size
+    # enddef
+
+    # -------------------------
+    # progress
+    # -------------------------
+    @measure_time
+    def get_progress(self, address: str, challenge: Challenge) -> Optional[tuple[NonceCursor, int]]:
+        assert_type(address, str)
+        assert_type(challenge, Challenge)
+
+        self._writer.flush()  # a checkpoint of this pair may still be queued
+        pm = ProgressModel.get_or_none(
+            (ProgressModel.address == address) &
+            (ProgressModel.challenge_id == challenge.challenge_id)
+            )  # type: Optional[ProgressModel]
+
+        if pm:
+            return NonceCursor(base=int(pm.nonce_base, 16), offset=pm.nonce_offset), pm.tries
+        else:
+            return None
+        # endif
+    # enddef
+
+    @measure_time
+    def save_progress(self, address: str, challenge: Challenge, cursor: NonceCursor, tries: int):
+        assert_type(address, str)
+        assert_type(challenge, Challenge)
+        assert_type(cursor, NonceCursor)
+        assert_type(tries, int)
+
+        q = (
+            ProgressModel
+            .insert(
+                address=address,
+                challenge_id=challenge.challenge_id,
+                nonce_base=f'{cursor.base:016x}',
+                nonce_offset=cursor.offset,
+                tries=tries,
+                updated_at=datetime.utcnow(),
+                )
+            .on_conflict_replace()
+        )
+
+        self._writer.submit(q.execute, coalesce_key=('progress', address, challenge.challenge_id))
+    # enddef
+
+    # -------------------------
+    # batch size
+    # -------------------------
+    @measure_time
+    def get_batch_size(self, hostname: str) -> Optional[int]:
+        assert_type(hostname, str)
+
+        bsm = BatchSizeModel.get_or_none(BatchSizeModel.hostname == hostname)  # type: Optional[BatchSizeModel]
+
+        return bsm.batch_size if bsm else None
+    # enddef
+
+    @measure_time
+    def save_batch_size(self, hostname: str, batch_size: int, hashrate: Optional[float]):
+        assert_type(hostname, str)
+        assert_type(batch_size, int)
+        assert_type(hashrate, float, allow_none=True)
+
+        q = (
+            BatchSizeModel
+            .insert(
+                hostname=hostname,
+                batch_size=batch_size,
+                hashrate=hashrate,
+                updated_at=datetime.utcnow(),
+                )
+            .on_conflict_replace()
+        )
+
+        self._writer.submit(q.execute, coalesce_key=('batch_size', hostname))
     # enddef
@@ -0,0 +1,247 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter, defaultdict
+from typing import Callable, Optional
+
+from utils import assert_type, timestamp_to_str
+
+
+class StackSampler:
+    """
+    Sampling profiler for every thread of the process, including threads that were already running.
+
+    Every `interval` seconds the stacks of all threads are read through `sys._current_frames()`, so the cost is one
+    stack walk per thread per sample and nothing is traced in between. Time spent in the native hash shows up as
+    samples in its Python caller (`try_once_with_batch`, `hash_packed_batch`).
+
+    """
+    DEFAULT_INTERVAL = 0.01  # sec
+    TOP_N = 30
+
+    def __init__(self, log_dirname: str, interval: float = DEFAULT_INTERVAL):
+        assert_type(log_dirname, str)
+        assert_type(interval, float)
+
+        self.log_dirname = log_dirname
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+    # enddef
+
+    def is_running(self) -> bool:
+        with self._lock:
+            return self._thread is not None
+        # endwith
+    # enddef
+
+    def start(self, seconds: float, on_done: Callable[[list[str]], None]) -> bool:
+        """
+        Sample for `seconds` in a background thread, then write the report and call `on_done` with the file paths.
+
+        Returns:
+            False if a profile is already running
+
+        """
+        assert_type(seconds, float)
+
+        with self._lock:
+            if self._thread is not None:
+                return False
+            # endif
+
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, args=(seconds, on_done), daemon=True)
+            self._thread.start()
+        # endwith
+
+        return True
+    # enddef
+
+    def stop(self):
+        self._stop_event.set()
+    # enddef
+
+    def _run(self, seconds: float, on_done: Callable[[list[str]], None]):
+        try:
+            started_at = time.time()
+            stacks = Counter()  # type: Counter[tuple[str, ...]]
+            num_samples = 0
+            my_ident = threading.get_ident()
+
+            time_end = time.monotonic() + seconds
+            while time.monotonic() < time_end and not self._stop_event.is_set():
+                thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for ident, frame in sys._current_frames().items():
+                    if ident == my_ident:
+                        continue
+                    # endif
+
+                    stack = []
+                    while frame is not None:
+                        code = frame.f_code
+                        stack.append(f'{os.path.basename(code.co_filename)}:{code.co_qualname if hasattr(code, "co_qualname") else code.co_name}')
+                        frame = frame.f_back
+                    # endwhile
+                    stack.append(f'[{thread_names.get(ident, ident)}]')
+                    stacks[tuple(reversed(stack))] += 1
+                # endfor
+                num_samples += 1
+
+                time.sleep(self.interval)
+            # endwhile
+
+            on_done(self.write_report(stacks=stacks, num_samples=num_samples, started_at=started_at))
+        finally:
+            with self._lock:
+                self._thread = None
+            # endwith
+        # endtry
+    # enddef
+
+    def write_report(self, stacks: Counter, num_samples: int, started_at: float) -> list[str]:
+        self_samples = Counter()
+        total_samples = Counter()
+        samples_by_thread = defaultdict(int)
+        for stack, count in stacks.items():
+            samples_by_thread[stack[0]] += count
+            self_samples[stack[-1]] += count
+            for func in set(stack[1:]):
+                total_samples[func] += count
+            # endfor
+        # endfor
+        num_thread_samples = max(1, sum(stacks.values()))
+
+        lines = [
+            f'=== Stack Sampler ===',
+            f'started  : {timestamp_to_str(started_at)}',
+            f'duration : {time.time() - started_at:,.1f} sec',
+            f'interval : {self.interval * 1e3:,.1f} ms ({num_samples:,} samples)',
+            f'',
+            f'--- threads ---',
+            ]
+        lines += [f'{count:8,} {thread}' for thread, count in sorted(samples_by_thread.items(), key=lambda kv: -kv[1])]
+        lines += [f'', f'--- self (top {self.TOP_N}) ---']
+        lines += [f'{count / num_thread_samples:6.1%} {count:8,} {func}' for func, count in self_samples.most_common(self.TOP_N)]
+        lines += [f'', f'--- inclusive (top {self.TOP_N}) ---']
+        lines += [f'{count / num_thread_samples:6.1%} {count:8,} {func}' for func, count in total_samples.most_common(self.TOP_N)]
+
+        basename = os.path.join(self.log_dirname, f'profile_{timestamp_to_str(started_at, fmt="%Y%m%d_%H%M%S")}')
+        filepath_txt = basename + '.txt'
+        with open(filepath_txt, 'wt') as f:
+            f.write('\n'.join(lines) + '\n')
+        # endwith
+
+        # collapsed stacks, for flamegraph.pl / speedscope
+        filepath_folded = basename + '.folded'
+        with open(filepath_folded, 'wt') as f:
+            for stack, count in stacks.items():
+                f.write(f'{";".join(stack)} {count}\n')
+            # endfor
+        # endwith
+
+        return [filepath_txt, filepath_folded]
+    # enddef
+
+
+class MemoryTracer:
+    """
+    Runs `tracemalloc` for a while and reports the top allocation sites, and their growth since the start.
+    Only allocations made through Python's allocator are seen; the ROM buffers of the native library are not.
+
+    """
+    NUM_FRAMES = 10
+    TOP_N = 30
+
+    def __init__(self, log_dirname: str):
+        assert_type(log_dirname, str)
+
+        self.log_dirname = log_dirname
+
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None  # type: Optional[threading.Thread]
+    # enddef
+
+    def is_running(self) -> bool:
+        with self._lock:
+            return self._thread is not None
+        # endwith
+    # enddef
+
+    def start(self, seconds: float, on_done: Callable[[list[str]], None]) -> bool:
+        assert_type(seconds, float)
+
+        with self._lock:
+            if self._thread is not None or tracemalloc.is_tracing():
+                return False
+            # endif
+
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, args=(seconds, on_done), daemon=True)
+            self._thread.start()
+        # endwith
+
+        return True
+    # enddef
+
+    def stop(self):
+        self._stop_event.set()
+    # enddef
+
+    def _run(self, seconds: float, on_done: Callable[[list[str]], None]):
+        started_at = time.time()
+        tracemalloc.start(self.NUM_FRAMES)
+        try:
+            snapshot_start = tracemalloc.take_snapshot()
+            self._stop_event.wait(timeout=seconds)
+            snapshot_end = tracemalloc.take_snapshot()
+            traced_current, traced_peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        # endtry
+
+        try:
+            on_done(self.write_report(snapshot_start=snapshot_start, snapshot_end=snapshot_end,
+                                      traced_current=traced_current, traced_peak=traced_peak, started_at=started_at))
+        finally:
+            with self._lock:
+                self._thread = None
+            # endwith
+        # endtry
+    # enddef
+
+    def write_report(self, snapshot_start: tracemalloc.Snapshot, snapshot_end: tracemalloc.Snapshot,
+                     traced_current: int, traced_peak: int, started_at: float) -> list[str]:
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        snapshot_start = snapshot_start.filter_traces(filters)
+        snapshot_end = snapshot_end.filter_traces(filters)
+
+        lines = [
+            f'=== tracemalloc ===',
+            f'started  : {timestamp_to_str(started_at)}',
+            f'duration : {time.time() - started_at:,.1f} sec',
+            f'traced   : {traced_current / (1024 ** 2):,.1f} MiB (peak {traced_peak / (1024 ** 2):,.1f} MiB)',
+            f'',
+            f'--- top {self.TOP_N} by size ---',
+            ]
+        lines += [str(stat) for stat in snapshot_end.statistics('lineno')[:self.TOP_N]]
+        lines += [f'', f'--- top {self.TOP_N} by growth ---']
+        lines += [str(stat) for stat in snapshot_end.compare_to(snapshot_start, 'lineno')[:self.TOP_N]]
+        lines += [f'', f'--- largest traceback ---']
+        stats = snapshot_end.statistics('traceback')
+        if stats:
+            lines += stats[0].traceback.format()
+        # endif
+
+        filepath = os.path.join(self.log_dirname, f'tracemalloc_{timestamp_to_str(started_at, fmt="%Y%m%d_%H%M%S")}.txt')
+        with open(filepath, 'wt') as f:
+            f.write('\n'.join(lines) + '\n')
+        # endwith
+
+        return [filepath]
+    # enddef